@@ -0,0 +1,64 @@
+"""Formats of the tarballs of built packages.
+
+Packages are archived as .tar.gz, or as .tar.zst, which zstd unpacks several
+times faster at a similar size. A store may hold both: looking for the
+tarball of a package accepts any of ARCHIVE_FORMATS, and prefers the format
+the store is configured to write when there are several.
+"""
+import os
+import re
+import shutil
+from bits_helpers.utilities import resolve_store_path
+
+ARCHIVE_FORMATS = ("tar.gz", "tar.zst")
+DEFAULT_ARCHIVE_FORMAT = "tar.gz"
+# The extension of any supported tarball, for use in regular expressions.
+ARCHIVE_EXTENSION = r"\.(?:%s)" % "|".join(re.escape(f) for f in ARCHIVE_FORMATS)
+
+
+def archive_format(filename):
+  """The format of the tarball filename, or None if it is not a tarball."""
+  return next((f for f in ARCHIVE_FORMATS if filename.endswith("." + f)), None)
+
+
+def preferred_formats(archiveFormat=DEFAULT_ARCHIVE_FORMAT):
+  """All the supported formats, archiveFormat first."""
+  return (archiveFormat,) + tuple(f for f in ARCHIVE_FORMATS if f != archiveFormat)
+
+
+def sort_tarballs(names, archiveFormat=DEFAULT_ARCHIVE_FORMAT):
+  """The tarballs among names, those in archiveFormat first."""
+  order = preferred_formats(archiveFormat)
+  return sorted((name for name in names if archive_format(name)),
+                key=lambda name: order.index(archive_format(name)))
+
+
+def tarball_name(spec, archiveFormat=DEFAULT_ARCHIVE_FORMAT, arch=None):
+  return "{}-{}-{}.{}.{}".format(spec["package"], spec["version"], spec["revision"],
+                                 arch or spec["architecture"], archiveFormat)
+
+
+def find_tarball(directory, spec, archiveFormat=DEFAULT_ARCHIVE_FORMAT, arch=None):
+  """Name of the tarball of spec in directory, or None if there is none."""
+  for fmt in preferred_formats(archiveFormat):
+    name = tarball_name(spec, fmt, arch)
+    if os.path.exists(os.path.join(directory, name)):
+      return name
+  return None
+
+
+def stored_tarball(workDir, spec, archiveFormat=DEFAULT_ARCHIVE_FORMAT, arch=None):
+  """Name of the tarball of spec in the local store, in archiveFormat if it is not there."""
+  arch = arch or spec["architecture"]
+  return find_tarball(os.path.join(workDir, resolve_store_path(arch, spec["hash"])),
+                      spec, archiveFormat, arch) or tarball_name(spec, archiveFormat, arch)
+
+
+def extract_command(archiveFormat, source, destDir):
+  """Command unpacking source, a tarball or - for the standard input, in destDir."""
+  if archiveFormat == "tar.zst":
+    return ["tar", "--use-compress-program=zstd -d", "-xf", source, "-C", destDir]
+  # pigz decompresses in a thread of its own, and checksums in another one.
+  if shutil.which("pigz"):
+    return ["tar", "--use-compress-program=pigz", "-xf", source, "-C", destDir]
+  return ["tar", "-xzf", source, "-C", destDir]
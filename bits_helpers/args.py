@@ -1,6 +1,8 @@
 import argparse
 from bits_helpers.utilities import detectArch, normalise_multiple_options
 from bits_helpers.workarea import cleanup_git_log
+from bits_helpers.jobserver import default_jobserver_path
+from bits_helpers.archive import ARCHIVE_FORMATS, DEFAULT_ARCHIVE_FORMAT
 import multiprocessing
 
 import re
@@ -87,10 +89,44 @@ def doParseArgs():
   build_parser.add_argument("--builders", dest="builders", type=int, default=1,
                             help=("The number of independent packages to build in parallel. "
                                   "Default is: %(default)d."))
+  build_parser.add_argument("--jobserver", dest="jobserver", nargs="?", default=None,
+                            const=default_jobserver_path(), metavar="FIFO",
+                            help=("Share the --jobs compilation processes among all the builds, "
+                                  "including the ones of other bits processes using the same FIFO, "
+                                  "through a GNU make jobserver. Build scripts get its make flags in "
+                                  "BITS_MAKEFLAGS, recipes opt in with "
+                                  "MAKEFLAGS=\"${BITS_MAKEFLAGS:--j$JOBS}\" make. "
+                                  "Default FIFO is %(const)s."))
+  build_parser.add_argument("--plan", dest="plan", default=None, metavar="FILE",
+                            help=("Write the build plan (hashes, revision and whether each package is "
+                                  "already installed, available as a tarball, or has to be built) as "
+                                  "JSON to FILE, or to the standard output for -, and exit without "
+                                  "building anything."))
+  build_parser.add_argument("--schedule-graph", dest="scheduleGraph", default=None, metavar="FILE",
+                            help=("When using --builders, write the graph of the scheduled jobs to FILE, "
+                                  "to replay it with python -m bits_helpers.simulation."))
+  build_parser.add_argument("--fetch-jobs", dest="fetchJobs", type=int, default=2,
+                            help=("The number of tarballs to download at the same time from the "
+                                  "remote store. When using --builders, also the number of sources "
+                                  "to check out while packages are being built. Default is: "
+                                  "%(default)d."))
+  build_parser.add_argument("--stream-install", dest="streamInstall", action="store_true",
+                            help=("Unpack prebuilt tarballs from https:// and b3:// remote stores "
+                                  "straight into their final place while they are downloaded, rather "
+                                  "than storing them first. Tarballs are only kept if they are to be "
+                                  "uploaded."))
   build_parser.add_argument("--resource-monitoring", dest="resourceMonitoring", action="store_true",
-                            help="Enable resource monitoring for each built package.")
+                            help=("Enable resource monitoring for each built package. The usage of "
+                                  "each build is also added to WORKDIR/SPECS/ARCH/build-stats.json, "
+                                  "which can be passed to --resources."))
   build_parser.add_argument("--resources", dest="resources", default=None,
                             help="JSON files containing resources utilization of packages.")
+  build_parser.add_argument("--schedule-priority", dest="schedulePriority", default="default",
+                            choices=["default", "critical-path"],
+                            help=("Order in which packages are built when using --builders. "
+                                  "With critical-path, packages at the head of the longest chain "
+                                  "of dependent builds, weighted by the build times in --resources, "
+                                  "are started first. Default is: %(default)s."))
   build_parser.add_argument("-u", "--fetch-repos", dest="fetchRepos", action="store_true",
                             help=("Fetch updates to repositories in MIRRORDIR. Required but nonexistent "
                                   "repositories are always cloned, even if this option is not given."))
@@ -170,6 +206,11 @@ def doParseArgs():
                                   "except ::rw is not recognised. Implies --no-system."))
   build_remote.add_argument("--insecure", dest="insecure", action="store_true",
                             help="Don't validate TLS certificates when connecting to an https:// remote store.")
+  build_remote.add_argument("--archive-format", dest="archiveFormat", choices=ARCHIVE_FORMATS,
+                            default=DEFAULT_ARCHIVE_FORMAT,
+                            help=("Format of the tarballs of the packages built, which tar.zst unpacks "
+                                  "several times faster. Tarballs in any format are reused, this one is "
+                                  "preferred if the remote store has several. Default is %(default)s."))
 
   build_dirs = build_parser.add_argument_group(title="Customise bits directories")
   build_dirs.add_argument("-C", "--chdir", metavar="DIR", dest="chdir", default=DEFAULT_CHDIR,
@@ -191,11 +232,16 @@ def doParseArgs():
   build_cleanup.add_argument("--no-auto-cleanup", dest="autoCleanup", action="store_false",
                              help="Do not clean up build directories automatically after a build.")
 
-  build_system = build_parser.add_mutually_exclusive_group()
+  build_system_checks = build_parser.add_argument_group(title="Use system packages")
+  build_system = build_system_checks.add_mutually_exclusive_group()
   build_system.add_argument("--always-prefer-system", dest="preferSystem", action="store_true",
                             help="Always use system packages when compatible.")
   build_system.add_argument("--no-system", dest="noSystem", nargs="?", const="*", default=None, metavar="PACKAGES",
                             help="Never use system packages for the provided, command separated, PACKAGES, even if compatible.")
+  build_system_checks.add_argument("--refresh-system-checks", dest="refreshSystemChecks", action="store_true",
+                                   help=("Run all the system checks again, instead of using the results of previous "
+                                         "runs. Successful checks are otherwise reused for a day, failed ones for a "
+                                         "few minutes."))
 
   # Options for clean subcommand
   clean_parser.add_argument("-a", "--architecture", dest="architecture", metavar="ARCH", default=detectedArch,
@@ -277,11 +323,16 @@ def doParseArgs():
   doctor_parser.add_argument("-e", dest="environment", action="append", default=[],
                             help="KEY=VALUE binding to add to the build environment. May be specified multiple times.")
 
-  doctor_system = doctor_parser.add_mutually_exclusive_group()
+  doctor_system_checks = doctor_parser.add_argument_group(title="Use system packages")
+  doctor_system = doctor_system_checks.add_mutually_exclusive_group()
   doctor_system.add_argument("--always-prefer-system", dest="preferSystem", action="store_true",
                              help="Always use system packages when compatible.")
   doctor_system.add_argument("--no-system", dest="noSystem", nargs="?", const="*", default=None, metavar="PACKAGES",
                              help="Never use system packages for the provided, command separated, PACKAGES, even if compatible.")
+  doctor_system_checks.add_argument("--refresh-system-checks", dest="refreshSystemChecks", action="store_true",
+                                    help=("Run all the system checks again, instead of using the results of previous "
+                                          "runs. Successful checks are otherwise reused for a day, failed ones for a "
+                                          "few minutes."))
 
   doctor_docker = doctor_parser.add_argument_group(title="Use a Docker container", description="""\
   If you're planning to build inside a Docker container, e.g. using bits
@@ -513,11 +564,10 @@ def finaliseArgs(args, parser):
     args.configDir = args.configDir % {"prefix": args.develPrefix + "/"}
   elif args.action == "build":
     if args.resourceMonitoring:
-      try:
-        import psutil
-      except:
+      from bits_helpers.resource_monitor import monitoring_available
+      if not monitoring_available():
         args.resourceMonitoring = False
-        print("Warning: Unable to use psutil. Disabling resource monitoring")
+        print("Warning: Neither /proc nor psutil are available. Disabling resource monitoring")
     pass
   elif args.action == "clean":
     pass
@@ -6,7 +6,7 @@ from bits_helpers.analytics import report_event
 from bits_helpers.log import debug, info, banner, warning
 from bits_helpers.log import dieOnError
 from bits_helpers.cmd import execute, DockerRunner, BASH, install_wrapper_script, getstatusoutput
-from bits_helpers.utilities import prunePaths, symlink, call_ignoring_oserrors, topological_sort, detectArch
+from bits_helpers.utilities import prunePaths, symlink, call_ignoring_oserrors, topological_sort, topological_levels, detectArch
 from bits_helpers.utilities import resolve_store_path
 from bits_helpers.utilities import parseDefaults, readDefaults
 from bits_helpers.utilities import getPackageList, asList
@@ -16,8 +16,14 @@ from bits_helpers.utilities import resolve_tag, resolve_version, short_commit_ha
 from bits_helpers.git import Git, git
 from bits_helpers.sl import Sapling
 from bits_helpers.scm import SCMError
-from bits_helpers.sync import remote_from_url
+from bits_helpers.archive import ARCHIVE_EXTENSION, DEFAULT_ARCHIVE_FORMAT, sort_tarballs, stored_tarball
+from bits_helpers.sync import remote_from_url, stream_install, TarballPrefetch
 from bits_helpers.workarea import logged_scm, updateReferenceRepoSpec, checkout_sources
+from bits_helpers.build_stats import record_build, stats_store_path
+from bits_helpers.hash_cache import HashCache, cache_key, file_signature, hash_cache_path
+from bits_helpers.recipe_cache import RecipeCache, recipe_cache_path
+from bits_helpers.system_checks import SystemCheckCache, system_checks_path, system_fingerprint
+from bits_helpers.build_timings import format_summary, phase, read_timings, summarise_timings, timings_path
 try:
   from bits_helpers.resource_monitor import run_monitor_on_command
 except:
@@ -123,9 +129,11 @@ def createDistLinks(spec, specs, args, syncHelper, repoType, requiresType):
     .format(work_dir=args.workDir, arch=spec["architecture"], repo=repoType, **spec)
   shutil.rmtree(target_dir.encode("utf-8"), ignore_errors=True)
   makedirs(target_dir, exist_ok=True)
+  archiveFormat = getattr(args, "archiveFormat", DEFAULT_ARCHIVE_FORMAT)
   for pkg in [spec["package"]] + list(spec[requiresType]):
-    dep_tarball = "../../../../../TARS/{arch}/store/{short_hash}/{hash}/{package}-{version}-{revision}.{arch}.tar.gz" \
-      .format(arch=specs[pkg]["architecture"], short_hash=specs[pkg]["hash"][:2], **specs[pkg])
+    dep_tarball = "../../../../../TARS/{arch}/store/{short_hash}/{hash}/{tarball}".format(
+      arch=specs[pkg]["architecture"], short_hash=specs[pkg]["hash"][:2], hash=specs[pkg]["hash"],
+      tarball=stored_tarball(args.workDir, specs[pkg], archiveFormat))
     symlink(dep_tarball, target_dir)
 
 def storeHook(package, specs, defaults) -> bool:
@@ -154,10 +162,17 @@ def storeHook(package, specs, defaults) -> bool:
 
     return bool(spec["hook"])
 
-def storeHashes(package, specs, considerRelocation):
+def readHashInput(path):
+  with open(path) as ref:
+    return "".join(ref.readlines())
+
+
+def storeHashes(package, specs, considerRelocation, cache=None):
   """Calculate various hashes for package, and store them in specs[package].
 
   Assumes that all dependencies of the package already have a definitive hash.
+  If a HashCache is given, patches and file:// sources are only read when
+  they, or anything else the hashes depend on, changed.
   """
   spec = specs[package]
   "If hooks are used, store them as part of package spec so we can include them in the hash."
@@ -170,6 +185,27 @@ def storeHashes(package, specs, considerRelocation):
     # subsequent calculations.
     return
 
+  if cache is None or spec.get("force_rebuild", False):
+    spec.update(computeHashes(package, specs, considerRelocation, readHashInput))
+    return
+  key = cache_key(computeHashes(package, specs, considerRelocation, file_signature))
+  hashes = cache.get(key)
+  if hashes is None:
+    hashes = computeHashes(package, specs, considerRelocation, readHashInput)
+    cache.put(key, hashes)
+  else:
+    debug("Hashes of %s found in cache", package)
+  spec.update(hashes)
+
+
+def computeHashes(package, specs, considerRelocation, fileContent):
+  """Return the hashes storeHashes sets in specs[package].
+
+  fileContent(path) gives what is hashed for the patches and file:// sources.
+  """
+  spec = specs[package]
+  hashes = {}
+
   # For now, all the hashers share data -- they'll be split below.
   h_all = Hasher()
 
@@ -256,17 +292,13 @@ def storeHashes(package, specs, considerRelocation):
   if "sources" in spec:
     for src in spec["sources"]:
       if src.startswith("file://"):
-        with open(src.removeprefix("file:/")) as ref:
-          file_content = "".join(ref.readlines())
-          h_all(file_content)
+        h_all(fileContent(src.removeprefix("file:/")))
       else:
         h_all(src)
   if "patches" in spec:
     for patch in spec["patches"]:
       h_all(patch)
-      with open(os.path.join(spec["pkgdir"], "patches", patch)) as ref:
-        patch_content = "".join(ref.readlines())
-        h_all(patch_content)
+      h_all(fileContent(os.path.join(spec["pkgdir"], "patches", patch)))
   
   if not package.startswith("defaults-"):
     for hook_name in sorted(spec.get("hook", {})):
@@ -291,27 +323,28 @@ def storeHashes(package, specs, considerRelocation):
     h_all(spec["incremental_recipe"])
     ih = Hasher()
     ih(spec["incremental_recipe"])
-    spec["incremental_hash"] = ih.hexdigest()
+    hashes["incremental_hash"] = ih.hexdigest()
   elif spec["is_devel_pkg"]:
     h_all(spec["devel_hash"])
 
   if considerRelocation and "relocate_paths" in spec:
     h_all("relocate:"+" ".join(sorted(spec["relocate_paths"])))
 
-  spec["deps_hash"] = dh.hexdigest()
-  spec["remote_revision_hash"] = h_default.hexdigest()
+  hashes["deps_hash"] = dh.hexdigest()
+  hashes["remote_revision_hash"] = h_default.hexdigest()
   # Store hypothetical hashes of this spec if we were building it using other
   # tags that refer to the same commit that we're actually building. These are
   # later used when fetching from the remote store. The "primary" hash should
   # be the first in the list, so it's checked first by the remote stores.
-  spec["remote_hashes"] = [spec["remote_revision_hash"]] + \
-    list({h.hexdigest() for _, _, h in h_alternatives} - {spec["remote_revision_hash"]})
+  hashes["remote_hashes"] = [hashes["remote_revision_hash"]] + \
+    list({h.hexdigest() for _, _, h in h_alternatives} - {hashes["remote_revision_hash"]})
   # The local hash must differ from the remote hash to avoid conflicts where
   # the remote has a package with the same hash as an existing local revision.
   h_all("local")
-  spec["local_revision_hash"] = h_default.hexdigest()
-  spec["local_hashes"] = [spec["local_revision_hash"]] + \
-    list({h.hexdigest() for _, _, h, in h_alternatives} - {spec["local_revision_hash"]})
+  hashes["local_revision_hash"] = h_default.hexdigest()
+  hashes["local_hashes"] = [hashes["local_revision_hash"]] + \
+    list({h.hexdigest() for _, _, h, in h_alternatives} - {hashes["local_revision_hash"]})
+  return hashes
 
 
 def hash_local_changes(spec):
@@ -548,7 +581,16 @@ def runBuildCommand(scheduler, p, specs, args, build_command, cachedTarball, scr
       args.develPrefix if "develPrefix" in args and spec["is_devel_pkg"] else spec["version"])
     )
   if args.resourceMonitoring:
-    err = run_monitor_on_command(build_command, "{}/{}.json".format(scriptDir, p), printer=progress)
+    # Feed the live usage back to the scheduler, so that it does not start
+    # builds for which there is no room anymore.
+    usage = None
+    if scheduler and scheduler.resourceManager:
+      usage = lambda sample: scheduler.updateResourceUsage("build:%s" % p, sample)
+    monitorFile = "{}/{}.jsonl".format(scriptDir, p)
+    err = run_monitor_on_command(build_command, monitorFile, printer=progress, callback=usage)
+    # Unpacking a tarball says nothing about how expensive building is.
+    if not err and not cachedTarball:
+      record_build(stats_store_path(workDir, spec["architecture"]), spec["package"], monitorFile)
   else:
     err = execute(build_command, printer=progress)
   if args.builders==1:
@@ -713,6 +755,216 @@ def runBuildCommand(scheduler, p, specs, args, build_command, cachedTarball, scr
   doFinalSync(spec, specs, args, syncHelper)
 
 
+def fetchCachedTarball(spec, workDir, syncHelper, prefetch=None):
+  """Download a prebuilt tarball for spec from the remote store, if any.
+
+  Sets spec["cachedTarball"] to its path, or to "" if the package has to be
+  built from sources. If prefetch is given, the download may already have
+  been started by it. If spec["streamInstall"] is set, the tarball is
+  unpacked into its final place while it is downloaded, if possible, and
+  spec["streamedInstall"] tells if that was done.
+  """
+  pkg_arch = spec["architecture"]
+  tar_hash_dir = os.path.join(workDir, resolve_store_path(pkg_arch, spec["hash"]))
+  debug("Looking for cached tarball in %s", tar_hash_dir)
+  spec["cachedTarball"] = ""
+  spec["streamedInstall"] = False
+  if spec.get("streamInstall"):
+    with phase(spec, "download"):
+      # The tarball is only needed afterwards if it is to be uploaded.
+      tarball = stream_install(syncHelper, spec, workDir, packagePath(spec),
+                               keep=bool(getattr(syncHelper, "writeStore", "")))
+    if tarball:
+      spec["cachedTarball"] = tarball
+      spec["streamedInstall"] = True
+      return
+  if not spec["is_devel_pkg"]:
+    with phase(spec, "download"):
+      if prefetch:
+        prefetch.wait(spec)
+      else:
+        syncHelper.fetch_tarball(spec)
+    tarballs = sort_tarballs(glob(os.path.join(tar_hash_dir, "*.tar.*")),
+                             getattr(syncHelper, "archiveFormat", DEFAULT_ARCHIVE_FORMAT))
+    spec["cachedTarball"] = tarballs[0] if len(tarballs) else ""
+    debug("Found tarball in %s" % spec["cachedTarball"]
+          if spec["cachedTarball"] else "No cache tarballs found")
+
+
+def checkoutBuildSources(spec, workDir, args):
+  """Check out the sources of spec, unless it can be unpacked from a tarball."""
+  if not spec["cachedTarball"]:
+    with phase(spec, "checkout"):
+      checkout_sources(spec, workDir, args.referenceSources, args.docker)
+
+
+def reportBuildTimings(specs, buildTargets, args):
+  """Log how long each phase of the builds done in this run took."""
+  summaries = {}
+  for p in buildTargets:
+    spec = specs[p]
+    buildWorkDir = args.workDir if spec["is_devel_pkg"] else os.environ.get("BITS_BUILD_WORK_DIR", args.workDir)
+    timings = read_timings(timings_path(join(buildWorkDir, "BUILD", spec["hash"])))
+    summaries[p] = summarise_timings(timings + spec.get("phaseTimings", []))
+    debug("Timings of %s: %s", p, ", ".join("%s %.1fs" % (name, seconds)
+                                            for name, seconds in summaries[p]["phases"].items()))
+  summary = format_summary(summaries)
+  if summary:
+    info("Time spent in each phase of the builds:\n%s", summary)
+
+
+def createBuildCommand(p, specs, args, workDir, develPrefix, jobs=None):
+  """Write the build script for package p and return the command running it.
+
+  jobs is the number of compilation processes the build can use, args.jobs
+  if not given. Returns a (build_command, cachedTarball, scriptDir) tuple, as needed by
+  runBuildCommand.
+  """
+  spec = specs[p]
+  pkg_arch = spec["architecture"]
+
+  # The actual build script.
+  debug("spec = %r", spec)
+    
+  fp = open(dirname(realpath(__file__))+'/build_template.sh')
+  cmd_raw = fp.read()
+  fp.close()
+
+  container_workDir = ""
+  cachedTarball = spec["cachedTarball"]
+  if args.docker:
+    container_workDir = "/container/bits/sw" if not args.containerUseWorkDir else workDir
+    if not args.containerUseWorkDir:
+      cachedTarball = re.sub("^" + workDir, container_workDir, cachedTarball)
+
+  scriptDir = join(workDir, "SPECS", pkg_arch, spec["package"],
+                   spec["version"] + "-" + spec["revision"])
+
+  init_workDir = container_workDir if args.docker else args.workDir
+  makedirs(scriptDir, exist_ok=True)
+  writeAll("{}/{}.sh".format(scriptDir, spec["package"]), spec["recipe"])
+  hook_params_locals = "\n  ".join(
+    'export %s="%s"' % (k, v) for k, v in spec.get("hook_params", {}).items()
+  )
+  writeAll("%s/build.sh" % scriptDir, cmd_raw % {
+    "provenance": create_provenance_info(spec["package"], specs, args),
+    "initdotsh_deps": generate_initdotsh(p, specs, args.architecture, workDir=init_workDir, post_build=False),
+    "initdotsh_full": generate_initdotsh(p, specs, args.architecture, workDir=init_workDir, post_build=True),
+    "develPrefix": develPrefix,
+    "workDir": workDir,
+    "configDir": abspath(args.configDir),
+    "incremental_recipe": spec.get("incremental_recipe", ":"),
+    "requires": " ".join(spec["requires"]),
+    "build_requires": " ".join(spec["build_requires"]),
+    "runtime_requires": " ".join(spec["runtime_requires"]),
+    "BITS_HOOK_PARAMS": hook_params_locals,
+  })
+
+  # Define the environment so that it can be passed up to the
+  # actual build script
+  bits_dir = dirname(dirname(realpath(__file__)))
+  buildEnvironment = [
+    ("ARCHITECTURE", spec.get("architecture")),
+    ("BUILD_REQUIRES", " ".join(spec["build_requires"])),
+    ("CACHED_TARBALL", cachedTarball),
+    ("ARCHIVE_FORMAT", getattr(args, "archiveFormat", DEFAULT_ARCHIVE_FORMAT)),
+    ("CAN_DELETE", args.aggressiveCleanup and "1" or ""),
+    ("STREAMED_INSTALL", spec.get("streamedInstall") and "1" or ""),
+    ("COMMIT_HASH", short_commit_hash(spec)),
+    ("DEPS_HASH", spec.get("deps_hash", "")),
+    ("DEVEL_HASH", spec.get("devel_hash", "")),
+    ("DEVEL_PREFIX", develPrefix),
+    ("BUILD_FAMILY", spec["build_family"]),
+    ("PKGFAMILY", spec.get("package_family", "")),
+    ("GIT_COMMITTER_NAME", "unknown"),
+    ("GIT_COMMITTER_EMAIL", "unknown"),
+    ("INCREMENTAL_BUILD_HASH", spec.get("incremental_hash", "0")),
+    ("JOBS", str(jobs or args.jobs)),
+    ("PKGHASH", spec["hash"]),
+    ("PKGNAME", spec["package"]),
+    ("PKGDIR", spec["pkgdir"]),
+    ("PKGREVISION", spec["revision"]),
+    ("PKGVERSION", spec["version"]),
+    ("RELOCATE_PATHS", " ".join(spec.get("relocate_paths", []))),
+    ("REQUIRES", " ".join(spec["requires"])),
+    ("RUNTIME_REQUIRES", " ".join(spec["runtime_requires"])),
+    ("FULL_RUNTIME_REQUIRES", " ".join(spec["full_runtime_requires"])),
+    ("FULL_BUILD_REQUIRES", " ".join(spec["full_build_requires"])),
+    ("FULL_REQUIRES", " ".join(spec["full_requires"])),
+    ("BITS_PREFER_SYSTEM_KEY", spec.get("key", "")),
+    ("BITS_SCRIPT_DIR", "/bits" if args.docker else bits_dir),
+  ]
+  if "sources" in spec:
+    for idx, src in enumerate(spec["sources"]):
+      buildEnvironment.append(("SOURCE%s" % idx, basename(src)))
+    buildEnvironment.append(("SOURCE_COUNT", str(len(spec["sources"]))))
+  else:
+    buildEnvironment.append(("SOURCE_COUNT", "0"))
+  if "patches" in spec:
+    for idx, src in enumerate(spec["patches"]):
+      buildEnvironment.append(("PATCH%s" % idx, basename(src)))
+    buildEnvironment.append(("PATCH_COUNT", str(len(spec["patches"]))))
+  else:
+    buildEnvironment.append(("PATCH_COUNT", "0"))
+  # Add resolved hooks as environment variables (POST_INSTALL -> POST_INSTALL_HOOKS)
+  for hook_name, hook_value in spec.get("hook", {}).items():
+    buildEnvironment.append((hook_name + "_HOOKS", hook_value))
+
+  # Add the extra environment as passed from the command line.
+  buildEnvironment += [e.partition('=')[::2] for e in args.environment]
+
+  # Add the computed track_env environment
+  buildEnvironment += [(key, value) for key, value in spec.get("track_env", {}).items()]
+
+  # Let the build script pass the shared jobserver to make.
+  jobserverVolumes = []
+  if getattr(args, "jobserver", None):
+    buildEnvironment.append(("BITS_JOBSERVER", args.jobserver))
+    jobserverVolumes.append("{0}:{0}".format(args.jobserver))
+
+  # In case the --docker options is passed, we setup a docker container which
+  # will perform the actual build. Otherwise build as usual using bash.
+  if args.docker:
+    build_command = (
+      "docker run --rm --entrypoint= --user $(id -u):$(id -g) "
+      "-v {workdir}:{container_workDir} -v{configDir}:/pkgdist.bits:ro "
+      "-v {scriptDir}/build.sh:/build.sh:ro "
+      "-v {bits_dir}:/bits "
+      "{mirrorVolume} {develVolumes} {additionalEnv} {additionalVolumes} "
+      "-e WORK_DIR_OVERRIDE={container_workDir} -e BITS_CONFIG_DIR_OVERRIDE=/pkgdist.bits {extraArgs} {image} bash -ex /build.sh"
+    ).format(
+      image=quote(args.dockerImage),
+      workdir=quote(abspath(args.workDir)),
+      container_workDir=container_workDir,
+      bits_dir=bits_dir,
+      configDir=quote(abspath(args.configDir)),
+      scriptDir=quote(scriptDir),
+      extraArgs=" ".join(map(quote, args.docker_extra_args)),
+      additionalEnv=" ".join(
+        f"-e {var}={quote(value)}" for var, value in buildEnvironment),
+      # Used e.g. by O2DPG-sim-tests to find the O2DPG repository.
+      develVolumes=" ".join(
+        '-v "$PWD/$(readlink {pkg} || echo {pkg})":/{pkg}:rw'.format(pkg=quote(spec["package"]))
+        for spec in specs.values() if spec["is_devel_pkg"]),
+      additionalVolumes=" ".join(
+        "-v %s" % quote(volume) for volume in args.volumes + jobserverVolumes),
+      mirrorVolume=("-v %s:/mirror" % quote(dirname(spec["reference"]))
+                    if "reference" in spec else ""),
+    )
+  else:
+    buildEnvironment = ([key, (val if isinstance(val, str) else "_".join(val))] for key, val in buildEnvironment)
+    env_vars = " ".join(["{}={}".format(key, quote(val)) for key, val in buildEnvironment])
+    build_command =  "env {} {} -e -x {}/build.sh 2>&1".format(env_vars, BASH, quote(scriptDir))
+  return build_command, cachedTarball, scriptDir
+
+
+def runBuildTask(scheduler, p, specs, args, workDir, develPrefix, syncHelper):
+  """Scheduler task: create the build script for p, then run it."""
+  jobs = scheduler.buildJobs("build:%s" % p, args.jobs)
+  build_command, cachedTarball, scriptDir = createBuildCommand(p, specs, args, workDir, develPrefix, jobs)
+  return runBuildCommand(scheduler, p, specs, args, build_command, cachedTarball, scriptDir, workDir, syncHelper)
+
+
 def doFinalSync(spec, specs, args, syncHelper):
   # We need to create 2 sets of links, once with the full requires,
   # once with only direct dependencies, since that's required to
@@ -727,9 +979,223 @@ def doFinalSync(spec, specs, args, syncHelper):
     syncHelper.upload_symlinks_and_tarball(spec)
 
 
+def planPackage(p, specs, args, syncHelper, workDir, hashCache, writeStore, possibleDevelPrefix):
+  """Compute the hashes of package p, and decide how to get it.
+
+  Sets the hashes, revision and build family of p in specs, and returns its
+  entry in the build plan. All the dependencies of p must have been planned
+  already. Nothing is changed on disk, besides the symlinks fetched from the
+  remote store. writeStore is the store packages will be uploaded to, if any.
+  """
+  spec = specs[p]
+  pkg_arch = spec["architecture"]
+  # Calculate the hashes. This is done in build order, so that we can
+  # guarantee that the hashes of the dependencies are calculated first, and
+  # that our dependencies have been assigned a single, definitive hash.
+  debug("Calculating hash.")
+  debug("spec = %r", spec)
+  debug("develPkgs = %r", sorted(spec["package"] for spec in specs.values() if spec["is_devel_pkg"]))
+  storeHook(p, specs, args.defaults[0])
+  storeHashes(p, specs, considerRelocation=args.architecture.startswith("osx"), cache=hashCache)
+  debug("Hashes for recipe %s are %s (remote); %s (local)", p,
+        ", ".join(spec["remote_hashes"]), ", ".join(spec["local_hashes"]))
+
+  # Since we can execute this multiple times for a given package, in order to
+  # ensure consistency, we need to reset things and make them pristine.
+  spec.pop("revision", None)
+
+  debug("Updating from tarballs")
+  # If we arrived here it really means we have a tarball which was created
+  # using the same recipe. We will use it as a cache for the build. This means
+  # that while we will still perform the build process, rather than
+  # executing the build itself we will:
+  #
+  # - Unpack it in a temporary place.
+  # - Invoke the relocation specifying the correct work_dir and the
+  #   correct path which should have been used.
+  # - Move the version directory to its final destination, including the
+  #   correct revision.
+  # - Repack it and put it in the store with the
+  #
+  # this will result in a new package which has the same binary contents of
+  # the old one but where the relocation will work for the new dictory. Here
+  # we simply store the fact that we can reuse the contents of cachedTarball.
+  syncHelper.fetch_symlinks(spec)
+
+  # Decide how it should be called, based on the hash and what is already
+  # available.
+  debug("Checking for packages already built.")
+
+  # Make sure this regex broadly matches the regex below that parses the
+  # symlink's target. Overly-broadly matching the version, for example, can
+  # lead to false positives that trigger a warning below.
+  links_regex = re.compile(r"{package}-{version}-(?:local)?[0-9]+\.{arch}{extension}".format(
+    package=re.escape(spec["package"]),
+    version=re.escape(spec["version"]),
+    arch=re.escape(pkg_arch),
+    extension=ARCHIVE_EXTENSION,
+  ))
+  symlink_dir = join(workDir, "TARS", pkg_arch, spec["package"])
+  try:
+    packages = [join(symlink_dir, symlink_path)
+                for symlink_path in os.listdir(symlink_dir)
+                if links_regex.fullmatch(symlink_path)]
+  except OSError:
+    # If symlink_dir does not exist or cannot be accessed, return an empty
+    # list of packages.
+    packages = []
+  del links_regex, symlink_dir
+
+  # In case there is no installed software, revision is 1
+  # If there is already an installed package:
+  # - Remove it if we do not know its hash
+  # - Use the latest number in the version, to decide its revision
+  debug("Packages already built using this version\n%s", "\n".join(packages))
+
+  # Calculate the build_family for the package
+  #
+  # If the package is a devel package, we need to associate it a devel
+  # prefix, either via the -z option or using its checked out branch. This
+  # affects its build hash.
+  #
+  # Moreover we need to define a global "buildFamily" which is used
+  # to tag all the packages incurred in the build, this way we can have
+  # a latest-<buildFamily> link for all of them an we will not incur in the
+  # flip - flopping described in https://github.com/alisw/alibuild/issues/325.
+  if possibleDevelPrefix:
+    spec["build_family"] = "{}-{}".format(possibleDevelPrefix, "_".join(args.defaults))
+  else:
+    spec["build_family"] = "_".join(args.defaults)
+
+  candidate = None
+  busyRevisions = set()
+  # We can tell that the remote store is read-only if it has an empty or
+  # no writeStore property. See below for explanation of why we need this.
+  revisionPrefix = "" if writeStore else "local"
+  for symlink_path in packages:
+    realPath = readlink(symlink_path)
+    matcher = "../../{arch}/store/[0-9a-f]{{2}}/([0-9a-f]+)/{package}-{version}-((?:local)?[0-9]+).{arch}{extension}$" \
+      .format(arch=pkg_arch, extension=ARCHIVE_EXTENSION, **spec)
+    match = re.match(matcher, realPath)
+    if not match:
+      warning("Symlink %s -> %s couldn't be parsed", symlink_path, realPath)
+      continue
+    rev_hash, revision = match.groups()
+
+    if not (("local" in revision and rev_hash in spec["local_hashes"]) or
+            ("local" not in revision and rev_hash in spec["remote_hashes"])):
+      # This tarball's hash doesn't match what we need. Remember that its
+      # revision number is taken, in case we assign our own later.
+      if revision.startswith(revisionPrefix) and revision[len(revisionPrefix):].isdigit():
+        # Strip revisionPrefix; the rest is an integer. Convert it to an int
+        # so we can get a sensible max() existing revision below.
+        busyRevisions.add(int(revision[len(revisionPrefix):]))
+      continue
+
+    # Don't re-use local revisions when we have a read-write store, so that
+    # packages we'll upload later don't depend on local revisions.
+    if writeStore and "local" in revision:
+      debug("Skipping revision %s because we want to upload later", revision)
+      continue
+
+    # If we have an hash match, we use the old revision for the package
+    # and we do not need to build it. Because we prefer reusing remote
+    # revisions, only store a local revision if there is no other candidate
+    # for reuse yet.
+    candidate = better_tarball(spec, candidate, (revision, rev_hash, symlink_path))
+
+  try:
+    revision, rev_hash, symlink_path = candidate
+  except TypeError:  # raised if candidate is still None
+    # If we can't reuse an existing revision, assign the next free revision
+    # to this package. If we're not uploading it, name it localN to avoid
+    # interference with the remote store -- in case this package is built
+    # somewhere else, the next revision N might be assigned there, and would
+    # conflict with our revision N.
+    # The code finding busyRevisions above already ensures that revision
+    # numbers start with revisionPrefix, and has left us plain ints.
+    spec["revision"] = revisionPrefix + str(
+      min(set(range(1, max(busyRevisions) + 2)) - busyRevisions)
+      if busyRevisions else 1)
+  else:
+    spec["revision"] = revision
+    # Remember what hash we're actually using.
+    spec["local_revision_hash" if revision.startswith("local")
+         else "remote_revision_hash"] = rev_hash
+    if spec["is_devel_pkg"] and "incremental_recipe" in spec:
+      spec["obsolete_tarball"] = symlink_path
+
+  # Now we know whether we're using a local or remote package, so we can set
+  # the proper hash and tarball directory.
+  if spec["revision"].startswith("local"):
+    spec["hash"] = spec["local_revision_hash"]
+  else:
+    spec["hash"] = spec["remote_revision_hash"]
+
+  # The tarball we reuse is the one symlinked, in whichever format it is.
+  tarball = join(workDir, resolve_store_path(pkg_arch, spec["hash"]),
+                 basename(readlink(candidate[2])) if candidate else
+                 stored_tarball(workDir, spec, getattr(args, "archiveFormat", DEFAULT_ARCHIVE_FORMAT)))
+  if spec["is_devel_pkg"]:
+    buildRoot = join(args.workDir, "BUILD", spec["hash"])
+    upToDate = spec["devel_hash"] + spec["deps_hash"] == readHashFile(join(buildRoot, spec["package"], ".build_succeeded"))
+    action = "installed" if upToDate else "build"
+  elif readInstalledHash(spec, workDir) == spec["hash"]:
+    action = "installed"
+  elif candidate:
+    action = "cached" if exists(tarball) else "remote"
+  else:
+    action = "build"
+  return {
+    "package": p,
+    "version": spec["version"],
+    "revision": spec["revision"],
+    "hash": spec["hash"],
+    "remote_hashes": spec["remote_hashes"],
+    "local_hashes": spec["local_hashes"],
+    "deps_hash": spec["deps_hash"],
+    "requires": spec.get("requires", []),
+    "action": action,
+    "tarball": tarball,
+    "symlink": candidate[2] if candidate else None,
+  }
+
+
+def packagePath(spec):
+  """Path of the installation of spec, relative to the work directory."""
+  return join(spec["architecture"], spec.get("package_family", ""), spec["package"],
+              "{}-{}".format(spec["version"], spec["revision"]))
+
+
+def installedHashPath(spec, workDir):
+  """Path to the installation of spec, which contains its .build-hash."""
+  # Include package_family in path if set
+  pkg_family = spec.get("package_family", "")
+  family_path = "/" + pkg_family if pkg_family else ""
+  return "{}/{}{}/{}/{}{}".format(workDir,
+                                  spec["architecture"],
+                                  family_path,
+                                  spec["package"],
+                                  spec["version"],
+                                  spec["revision"])
+
+
+def readInstalledHash(spec, workDir):
+  hashPath = installedHashPath(spec, workDir)
+  # If the folder is a symlink, we consider it to be to CVMFS and
+  # take the hash for good.
+  if os.path.islink(hashPath):
+    return spec["hash"]
+  return readHashFile(hashPath + "/.build-hash")
+
+
 def doBuild(args, parser):
   syncHelper = remote_from_url(args.remoteStore, args.writeStore, args.architecture,
-                               args.workDir, getattr(args, "insecure", False))
+                               args.workDir, getattr(args, "insecure", False),
+                               getattr(args, "archiveFormat", DEFAULT_ARCHIVE_FORMAT))
+  dieOnError(getattr(args, "archiveFormat", DEFAULT_ARCHIVE_FORMAT) == "tar.zst" and
+             not args.docker and not shutil.which("zstd"),
+             "zstd must be installed to create tar.zst tarballs.")
 
   packages = args.pkgname
   specs = {}
@@ -787,11 +1253,16 @@ def doBuild(args, parser):
   extra_env = {"BITS_CONFIG_DIR": "/pkgdist.bits" if args.docker else os.path.abspath(args.configDir)}
   extra_env.update(dict([e.partition('=')[::2] for e in args.environment]))
 
+  checkCache = SystemCheckCache(system_checks_path(workDir, args.architecture),
+                                system_fingerprint(args.dockerImage, [extra_env, args.docker_extra_args]),
+                                refresh=args.refreshSystemChecks)
   with DockerRunner(args.dockerImage, args.docker_extra_args, extra_env=extra_env, extra_volumes=[f"{os.path.abspath(args.configDir)}:/pkgdist.bits:ro"] if args.docker else []) as getstatusoutput_docker:
-    def performPreferCheckWithTempDir(pkg, cmd):
+    runSystemCheck = checkCache.wrap(getstatusoutput_docker)
+    def performPreferCheckWithTempDir(pkg, cmd, run=runSystemCheck):
       with tempfile.TemporaryDirectory(prefix=f"bits_prefer_check_{pkg['package']}_") as temp_dir:
-        return getstatusoutput_docker(cmd, cwd=temp_dir)
+        return run(cmd, cwd=temp_dir)
 
+    recipeCache = RecipeCache(recipe_cache_path(workDir))
     systemPackages, ownPackages, failed, validDefaults = \
       getPackageList(packages                = packages,
                      specs                   = specs,
@@ -804,11 +1275,17 @@ def doBuild(args, parser):
                      defaults                = args.defaults,
                      performPreferCheck      = performPreferCheckWithTempDir,
                      performRequirementCheck = performPreferCheckWithTempDir,
+                     # What track_env captures depends on the environment,
+                     # which the cache of system checks does not look at.
+                     performTrackEnv         = lambda pkg, cmd: performPreferCheckWithTempDir(pkg, cmd, getstatusoutput_docker),
                      performValidateDefaults = lambda spec: validateDefaults(spec, args.defaults),
                      overrides               = overrides,
                      taps                    = taps,
                      log                     = debug,
-                     defaultPackageFamily    = defaultPackageFamily)
+                     defaultPackageFamily    = defaultPackageFamily,
+                     recipeCache             = recipeCache)
+  recipeCache.save()
+  checkCache.save()
 
   dieOnError(validDefaults and any(d not in validDefaults for d in args.defaults),
              "Specified default `%s' is not compatible with the packages you want to build.\n"
@@ -1074,163 +1551,84 @@ def doBuild(args, parser):
   if (args.builders > 1) and buildOrder:
     from bits_helpers.scheduler import Scheduler
     from bits_helpers.log import logger
-    scheduler = Scheduler(args.builders, logDelegate=logger, buildStats=args.resources)
-
-  while buildOrder:
-    p = buildOrder.pop(0)
-    spec = specs[p]
-    pkg_arch = spec["architecture"]
-    log_current_package(p, mainPackage, specs, getattr(args, "develPrefix", None))
-
-    # Calculate the hashes. We do this in build order so that we can guarantee
-    # that the hashes of the dependencies are calculated first. Do this inside
-    # the main build loop to make sure that our dependencies have been assigned
-    # a single, definitive hash.
-    debug("Calculating hash.")
-    debug("spec = %r", spec)
-    debug("develPkgs = %r", sorted(spec["package"] for spec in specs.values() if spec["is_devel_pkg"]))
-    storeHook(p, specs, args.defaults[0])
-    storeHashes(p, specs, considerRelocation=args.architecture.startswith("osx"))
-    debug("Hashes for recipe %s are %s (remote); %s (local)", p,
-          ", ".join(spec["remote_hashes"]), ", ".join(spec["local_hashes"]))
-
-    if spec["is_devel_pkg"] and getattr(syncHelper, "writeStore", None):
-      warning("Disabling remote write store from now since %s is a development package.", spec["package"])
-      syncHelper.writeStore = ""
-
-    # Since we can execute this multiple times for a given package, in order to
-    # ensure consistency, we need to reset things and make them pristine.
-    spec.pop("revision", None)
-
-    debug("Updating from tarballs")
-    # If we arrived here it really means we have a tarball which was created
-    # using the same recipe. We will use it as a cache for the build. This means
-    # that while we will still perform the build process, rather than
-    # executing the build itself we will:
-    #
-    # - Unpack it in a temporary place.
-    # - Invoke the relocation specifying the correct work_dir and the
-    #   correct path which should have been used.
-    # - Move the version directory to its final destination, including the
-    #   correct revision.
-    # - Repack it and put it in the store with the
-    #
-    # this will result in a new package which has the same binary contents of
-    # the old one but where the relocation will work for the new dictory. Here
-    # we simply store the fact that we can reuse the contents of cachedTarball.
-    syncHelper.fetch_symlinks(spec)
-
-    # Decide how it should be called, based on the hash and what is already
-    # available.
-    debug("Checking for packages already built.")
-
-    # Make sure this regex broadly matches the regex below that parses the
-    # symlink's target. Overly-broadly matching the version, for example, can
-    # lead to false positives that trigger a warning below.
-    links_regex = re.compile(r"{package}-{version}-(?:local)?[0-9]+\.{arch}\.tar\.gz".format(
-      package=re.escape(spec["package"]),
-      version=re.escape(spec["version"]),
-      arch=re.escape(pkg_arch),
-    ))
-    symlink_dir = join(workDir, "TARS", pkg_arch, spec["package"])
-    try:
-      packages = [join(symlink_dir, symlink_path)
-                  for symlink_path in os.listdir(symlink_dir)
-                  if links_regex.fullmatch(symlink_path)]
-    except OSError:
-      # If symlink_dir does not exist or cannot be accessed, return an empty
-      # list of packages.
-      packages = []
-    del links_regex, symlink_dir
-
-    # In case there is no installed software, revision is 1
-    # If there is already an installed package:
-    # - Remove it if we do not know its hash
-    # - Use the latest number in the version, to decide its revision
-    debug("Packages already built using this version\n%s", "\n".join(packages))
-
-    # Calculate the build_family for the package
-    #
-    # If the package is a devel package, we need to associate it a devel
-    # prefix, either via the -z option or using its checked out branch. This
-    # affects its build hash.
-    #
-    # Moreover we need to define a global "buildFamily" which is used
-    # to tag all the packages incurred in the build, this way we can have
-    # a latest-<buildFamily> link for all of them an we will not incur in the
-    # flip - flopping described in https://github.com/alisw/alibuild/issues/325.
-    develPrefix = ""
+    scheduler = Scheduler(args.builders, logDelegate=logger, buildStats=args.resources,
+                          priority=getattr(args, "schedulePriority", "default"),
+                          parallelDownloads=getattr(args, "fetchJobs", 2),
+                          parallelFetches=getattr(args, "fetchJobs", 2),
+                          jobs=args.jobs)
+
+  # Host (or join) the jobserver shared by all the builds on this machine.
+  # Every make can run one process without a token, hence one per builder.
+  jobserver = None
+  if getattr(args, "jobserver", None):
+    from bits_helpers.jobserver import JobServer
+    jobserver = JobServer(args.jobserver, args.jobs - args.builders).start()
+
+  # Failed builds exit through dieOnError: stop the downloads still queued,
+  # and the jobserver, on the way out too.
+  prefetch = None
+  try:
+    # Plan the whole build before starting it: compute the hashes of all the
+    # packages, in build order, and decide which ones need to be built. Later
+    # packages must not be uploaded once a development package is found, see
+    # below.
+    hashCache = HashCache(hash_cache_path(workDir, args.architecture))
     possibleDevelPrefix = getattr(args, "develPrefix", develPackageBranch)
-    if spec["is_devel_pkg"]:
-      develPrefix = possibleDevelPrefix
-
-    if possibleDevelPrefix:
-      spec["build_family"] = "{}-{}".format(possibleDevelPrefix, "_".join(args.defaults))
-    else:
-      spec["build_family"] = "_".join(args.defaults)
-    if spec["package"] == mainPackage:
-      mainBuildFamily = spec["build_family"]
-
-    candidate = None
-    busyRevisions = set()
-    # We can tell that the remote store is read-only if it has an empty or
-    # no writeStore property. See below for explanation of why we need this.
-    revisionPrefix = "" if getattr(syncHelper, "writeStore", "") else "local"
-    for symlink_path in packages:
-      realPath = readlink(symlink_path)
-      matcher = "../../{arch}/store/[0-9a-f]{{2}}/([0-9a-f]+)/{package}-{version}-((?:local)?[0-9]+).{arch}.tar.gz$" \
-        .format(arch=pkg_arch, **spec)
-      match = re.match(matcher, realPath)
-      if not match:
-        warning("Symlink %s -> %s couldn't be parsed", symlink_path, realPath)
-        continue
-      rev_hash, revision = match.groups()
-
-      if not (("local" in revision and rev_hash in spec["local_hashes"]) or
-              ("local" not in revision and rev_hash in spec["remote_hashes"])):
-        # This tarball's hash doesn't match what we need. Remember that its
-        # revision number is taken, in case we assign our own later.
-        if revision.startswith(revisionPrefix) and revision[len(revisionPrefix):].isdigit():
-          # Strip revisionPrefix; the rest is an integer. Convert it to an int
-          # so we can get a sensible max() existing revision below.
-          busyRevisions.add(int(revision[len(revisionPrefix):]))
-        continue
-
-      # Don't re-use local revisions when we have a read-write store, so that
-      # packages we'll upload later don't depend on local revisions.
-      if getattr(syncHelper, "writeStore", False) and "local" in revision:
-        debug("Skipping revision %s because we want to upload later", revision)
-        continue
+    writeStore = getattr(syncHelper, "writeStore", "")
+    buildPlan = OrderedDict()
+    # Packages in the same level do not depend on each other.
+    buildLevel = {p: i for i, level in enumerate(topological_levels(specs)) for p in level}
+    for p in buildOrder:
+      log_current_package(p, mainPackage, specs, getattr(args, "develPrefix", None))
+      if specs[p]["is_devel_pkg"]:
+        writeStore = ""
+      buildPlan[p] = planPackage(p, specs, args, syncHelper, workDir, hashCache, writeStore, possibleDevelPrefix)
+      buildPlan[p]["level"] = buildLevel[p]
+      if p == mainPackage:
+        mainBuildFamily = specs[p]["build_family"]
+    hashCache.save()
+
+    if getattr(args, "plan", None):
+      planJson = json.dumps(list(buildPlan.values()), indent=2)
+      if args.plan == "-":
+        print(planJson)
+      else:
+        with open(args.plan, "w") as planFile:
+          planFile.write(planJson + "\n")
+      info("Build plan written to %s. Not building.", "standard output" if args.plan == "-" else args.plan)
+      return
+
+    # With --stream-install, tarballs which are not in the local store yet are
+    # unpacked into their final place while they are downloaded. This does not
+    # work if the install path is not the one the tarball was made with.
+    streamInstall = getattr(args, "streamInstall", False) and hasattr(syncHelper, "open_tarball") \
+      and "FORCE_REVISION" not in os.environ
+    for p in buildOrder:
+      specs[p]["streamInstall"] = streamInstall and buildPlan[p]["action"] == "remote"
+
+    # Download every tarball the build may use from the remote store now, a few
+    # at a time, rather than each one only when its package is reached.
+    if getattr(syncHelper, "remoteStore", None):
+      prefetch = TarballPrefetch(syncHelper, getattr(args, "fetchJobs", 2)).start(
+        specs[p] for p in buildOrder
+        if buildPlan[p]["action"] in ("remote", "build") and not specs[p]["is_devel_pkg"]
+        and not specs[p]["streamInstall"])
+
+    while buildOrder:
+      p = buildOrder.pop(0)
+      spec = specs[p]
+      pkg_arch = spec["architecture"]
+      log_current_package(p, mainPackage, specs, getattr(args, "develPrefix", None))
 
-      # If we have an hash match, we use the old revision for the package
-      # and we do not need to build it. Because we prefer reusing remote
-      # revisions, only store a local revision if there is no other candidate
-      # for reuse yet.
-      candidate = better_tarball(spec, candidate, (revision, rev_hash, symlink_path))
+      plan = buildPlan[p]
+      if spec["is_devel_pkg"] and getattr(syncHelper, "writeStore", None):
+        warning("Disabling remote write store from now since %s is a development package.", spec["package"])
+        syncHelper.writeStore = ""
+      develPrefix = possibleDevelPrefix if spec["is_devel_pkg"] else ""
 
-    try:
-      revision, rev_hash, symlink_path = candidate
-    except TypeError:  # raised if candidate is still None
-      # If we can't reuse an existing revision, assign the next free revision
-      # to this package. If we're not uploading it, name it localN to avoid
-      # interference with the remote store -- in case this package is built
-      # somewhere else, the next revision N might be assigned there, and would
-      # conflict with our revision N.
-      # The code finding busyRevisions above already ensures that revision
-      # numbers start with revisionPrefix, and has left us plain ints.
-      spec["revision"] = revisionPrefix + str(
-        min(set(range(1, max(busyRevisions) + 2)) - busyRevisions)
-        if busyRevisions else 1)
-    else:
-      spec["revision"] = revision
-      # Remember what hash we're actually using.
-      spec["local_revision_hash" if revision.startswith("local")
-           else "remote_revision_hash"] = rev_hash
-      if spec["is_devel_pkg"] and "incremental_recipe" in spec:
-        spec["obsolete_tarball"] = symlink_path
-      else:
+      if plan["symlink"] and not (spec["is_devel_pkg"] and "incremental_recipe" in spec):
         debug("Package %s with hash %s is already found in %s. Not building.",
-              p, rev_hash, symlink_path)
+              p, spec["hash"], plan["symlink"])
         # Ignore errors here, because the path we're linking to might not
         # exist (if this is the first run through the loop). On the second run
         # through, the path should have been created by the build process.
@@ -1242,417 +1640,282 @@ def doBuild(args, parser):
         call_ignoring_oserrors(symlink, "{}{}".format(spec["version"], ("-" + symlink_revision) if symlink_revision else ""),
                                "{wd}/{architecture}{family}/{package}/latest".format(wd=workDir, family=pkg_family_path, **spec))
 
-    # Now we know whether we're using a local or remote package, so we can set
-    # the proper hash and tarball directory.
-    if spec["revision"].startswith("local"):
-      spec["hash"] = spec["local_revision_hash"]
-    else:
-      spec["hash"] = spec["remote_revision_hash"]
-
-    # We do not use the override for devel packages, because we
-    # want to avoid having to rebuild things when the /tmp gets cleaned.
-    if spec["is_devel_pkg"]:
-        buildWorkDir = args.workDir
-    else:
-        buildWorkDir = os.environ.get("BITS_BUILD_WORK_DIR", args.workDir)
+      # We do not use the override for devel packages, because we
+      # want to avoid having to rebuild things when the /tmp gets cleaned.
+      if spec["is_devel_pkg"]:
+          buildWorkDir = args.workDir
+      else:
+          buildWorkDir = os.environ.get("BITS_BUILD_WORK_DIR", args.workDir)
 
-    buildRoot = join(buildWorkDir, "BUILD", spec["hash"])
+      buildRoot = join(buildWorkDir, "BUILD", spec["hash"])
 
-    spec["old_devel_hash"] = readHashFile(join(
-      buildRoot, spec["package"], ".build_succeeded"))
+      spec["old_devel_hash"] = readHashFile(join(
+        buildRoot, spec["package"], ".build_succeeded"))
 
-    # Recreate symlinks to this development package builds.
-    if spec["is_devel_pkg"]:
-      debug("Creating symlinks to builds of devel package %s", spec["package"])
-      # Ignore errors here, because the path we're linking to might not exist
-      # (if this is the first run through the loop). On the second run
-      # through, the path should have been created by the build process.
-      call_ignoring_oserrors(symlink, spec["hash"], join(buildWorkDir, "BUILD", spec["package"] + "-latest"))
-      if develPrefix:
-        call_ignoring_oserrors(symlink, spec["hash"], join(buildWorkDir, "BUILD", spec["package"] + "-latest-" + develPrefix))
-      # Last package built gets a "latest" mark.
-      devel_symlink_revision = spec.get(spec["revision"])
-      # Include package_family in symlink path if set
-      devel_family = spec.get("package_family", "")
-      devel_family_parts = [pkg_arch, devel_family, spec["package"]] if devel_family else [pkg_arch, spec["package"]]
-      call_ignoring_oserrors(symlink, "{}{}".format(spec["version"], ("-" + devel_symlink_revision) if devel_symlink_revision else ""),
-                             join(workDir, *devel_family_parts, "latest"))
-      # Latest package built for a given devel prefix gets a "latest-<family>" mark.
-      if spec["build_family"]:
+      # Recreate symlinks to this development package builds.
+      if spec["is_devel_pkg"]:
+        debug("Creating symlinks to builds of devel package %s", spec["package"])
+        # Ignore errors here, because the path we're linking to might not exist
+        # (if this is the first run through the loop). On the second run
+        # through, the path should have been created by the build process.
+        call_ignoring_oserrors(symlink, spec["hash"], join(buildWorkDir, "BUILD", spec["package"] + "-latest"))
+        if develPrefix:
+          call_ignoring_oserrors(symlink, spec["hash"], join(buildWorkDir, "BUILD", spec["package"] + "-latest-" + develPrefix))
+        # Last package built gets a "latest" mark.
+        devel_symlink_revision = spec.get(spec["revision"])
+        # Include package_family in symlink path if set
+        devel_family = spec.get("package_family", "")
+        devel_family_parts = [pkg_arch, devel_family, spec["package"]] if devel_family else [pkg_arch, spec["package"]]
         call_ignoring_oserrors(symlink, "{}{}".format(spec["version"], ("-" + devel_symlink_revision) if devel_symlink_revision else ""),
-                               join(workDir, *devel_family_parts, "latest-" + spec["build_family"]))
+                               join(workDir, *devel_family_parts, "latest"))
+        # Latest package built for a given devel prefix gets a "latest-<family>" mark.
+        if spec["build_family"]:
+          call_ignoring_oserrors(symlink, "{}{}".format(spec["version"], ("-" + devel_symlink_revision) if devel_symlink_revision else ""),
+                                 join(workDir, *devel_family_parts, "latest-" + spec["build_family"]))
 
-    # Check if this development package needs to be rebuilt.
-    if spec["is_devel_pkg"]:
-      debug("Checking if devel package %s needs rebuild", spec["package"])
-      if spec["devel_hash"]+spec["deps_hash"] == spec["old_devel_hash"]:
-        info("Development package %s does not need rebuild", spec["package"])
+      # Check if this development package needs to be rebuilt.
+      if spec["is_devel_pkg"]:
+        debug("Checking if devel package %s needs rebuild", spec["package"])
+        if spec["devel_hash"]+spec["deps_hash"] == spec["old_devel_hash"]:
+          info("Development package %s does not need rebuild", spec["package"])
+          continue
+
+      # Now that we have all the information about the package we want to build, let's
+      # check if it wasn't built / unpacked already.
+      hashFile = installedHashPath(spec, workDir) + "/.build-hash"
+      fileHash = readInstalledHash(spec, workDir)
+      # Development packages have their own rebuild-detection logic above.
+      # spec["hash"] is only useful here for regular packages.
+      if fileHash == spec["hash"] and not spec["is_devel_pkg"]:
+        # If we get here, we know we are in sync with whatever remote store.  We
+        # can therefore create a directory which contains all the packages which
+        # were used to compile this one.
+        debug("Package %s was correctly compiled. Moving to next one.", spec["package"])
+        # If using incremental builds, next time we execute the script we need to remove
+        # the placeholders which avoid rebuilds.
+        if spec["is_devel_pkg"] and "incremental_recipe" in spec:
+          unlink(hashFile)
+        if "obsolete_tarball" in spec:
+          unlink(realpath(spec["obsolete_tarball"]))
+          unlink(spec["obsolete_tarball"])
+        # We can now delete the INSTALLROOT and BUILD directories,
+        # assuming the package is not a development one. We also can
+        # delete the SOURCES in case we have aggressive-cleanup enabled.
+        if not spec["is_devel_pkg"] and args.autoCleanup:
+          cleanupDirs = [buildRoot,
+                         join(workDir, "INSTALLROOT", spec["hash"])]
+          if args.aggressiveCleanup:
+            cleanupDirs.append(join(workDir, "SOURCES", spec["package"]))
+          debug("Cleaning up:\n%s", "\n".join(cleanupDirs))
+
+          for d in cleanupDirs:
+            shutil.rmtree(d.encode("utf8"), True)
+          try:
+            unlink(join(buildWorkDir, "BUILD", spec["package"] + "-latest"))
+            if "develPrefix" in args:
+              unlink(join(buildWorkDir, "BUILD", spec["package"] + "-latest-" + args.develPrefix))
+          except Exception:
+            pass
+          try:
+            rmdir(join(buildWorkDir, "BUILD"))
+            rmdir(join(workDir, "INSTALLROOT"))
+          except Exception:
+            pass
         continue
 
-    # Now that we have all the information about the package we want to build, let's
-    # check if it wasn't built / unpacked already.
-    # Include package_family in path if set
-    pkg_family = spec.get("package_family", "")
-    family_path = "/" + pkg_family if pkg_family else ""
-    hashPath= "{}/{}{}/{}/{}{}".format(workDir,
-                                  pkg_arch,
-                                  family_path,
-                                  spec["package"],
-                                  spec["version"],
-                                  spec["revision"])
-    hashFile = hashPath + "/.build-hash"
-    # If the folder is a symlink, we consider it to be to CVMFS and
-    # take the hash for good.
-    if os.path.islink(hashPath):
-      fileHash = spec["hash"]
-    else:
-      fileHash = readHashFile(hashFile)
-    # Development packages have their own rebuild-detection logic above.
-    # spec["hash"] is only useful here for regular packages.
-    if fileHash == spec["hash"] and not spec["is_devel_pkg"]:
-      # If we get here, we know we are in sync with whatever remote store.  We
-      # can therefore create a directory which contains all the packages which
-      # were used to compile this one.
-      debug("Package %s was correctly compiled. Moving to next one.", spec["package"])
-      # If using incremental builds, next time we execute the script we need to remove
-      # the placeholders which avoid rebuilds.
-      if spec["is_devel_pkg"] and "incremental_recipe" in spec:
-        unlink(hashFile)
-      if "obsolete_tarball" in spec:
-        unlink(realpath(spec["obsolete_tarball"]))
-        unlink(spec["obsolete_tarball"])
-      # We can now delete the INSTALLROOT and BUILD directories,
-      # assuming the package is not a development one. We also can
-      # delete the SOURCES in case we have aggressive-cleanup enabled.
-      if not spec["is_devel_pkg"] and args.autoCleanup:
-        cleanupDirs = [buildRoot,
-                       join(workDir, "INSTALLROOT", spec["hash"])]
-        if args.aggressiveCleanup:
-          cleanupDirs.append(join(workDir, "SOURCES", spec["package"]))
-        debug("Cleaning up:\n%s", "\n".join(cleanupDirs))
-
-        for d in cleanupDirs:
-          shutil.rmtree(d.encode("utf8"), True)
-        try:
-          unlink(join(buildWorkDir, "BUILD", spec["package"] + "-latest"))
-          if "develPrefix" in args:
-            unlink(join(buildWorkDir, "BUILD", spec["package"] + "-latest-" + args.develPrefix))
-        except Exception:
-          pass
-        try:
-          rmdir(join(buildWorkDir, "BUILD"))
-          rmdir(join(workDir, "INSTALLROOT"))
-        except Exception:
-          pass
-      continue
-
-    if fileHash != "0":
-      debug("Mismatch between local area (%s) and the one which I should build (%s). Redoing.",
-            fileHash, spec["hash"])
-    # shutil.rmtree under Python 2 fails when hashFile is unicode and the
-    # directory contains files with non-ASCII names, e.g. Golang/Boost.
-    shutil.rmtree(dirname(hashFile).encode("utf-8"), True)
-
-    tar_hash_dir = os.path.join(workDir, resolve_store_path(pkg_arch, spec["hash"]))
-    debug("Looking for cached tarball in %s", tar_hash_dir)
-    spec["cachedTarball"] = ""
-    if not spec["is_devel_pkg"]:
-      syncHelper.fetch_tarball(spec)
-      tarballs = glob(os.path.join(tar_hash_dir, "*gz"))
-      spec["cachedTarball"] = tarballs[0] if len(tarballs) else ""
-      debug("Found tarball in %s" % spec["cachedTarball"]
-            if spec["cachedTarball"] else "No cache tarballs found")
-
-    # The actual build script.
-    debug("spec = %r", spec)
-    
-    fp = open(dirname(realpath(__file__))+'/build_template.sh')
-    cmd_raw = fp.read()
-    fp.close()
-
-    container_workDir = ""
-    cachedTarball = spec["cachedTarball"]
-    if args.docker:
-      container_workDir = "/container/bits/sw" if not args.containerUseWorkDir else workDir
-      if not args.containerUseWorkDir:
-        cachedTarball = re.sub("^" + workDir, container_workDir, cachedTarball)
-
-    if not cachedTarball:
-      checkout_sources(spec, workDir, args.referenceSources, args.docker)
-
-    scriptDir = join(workDir, "SPECS", pkg_arch, spec["package"],
-                     spec["version"] + "-" + spec["revision"])
-
-    init_workDir = container_workDir if args.docker else args.workDir
-    makedirs(scriptDir, exist_ok=True)
-    writeAll("{}/{}.sh".format(scriptDir, spec["package"]), spec["recipe"])
-    hook_params_locals = "\n  ".join(
-      'export %s="%s"' % (k, v) for k, v in spec.get("hook_params", {}).items()
-    )
-    writeAll("%s/build.sh" % scriptDir, cmd_raw % {
-      "provenance": create_provenance_info(spec["package"], specs, args),
-      "initdotsh_deps": generate_initdotsh(p, specs, args.architecture, workDir=init_workDir, post_build=False),
-      "initdotsh_full": generate_initdotsh(p, specs, args.architecture, workDir=init_workDir, post_build=True),
-      "develPrefix": develPrefix,
-      "workDir": workDir,
-      "configDir": abspath(args.configDir),
-      "incremental_recipe": spec.get("incremental_recipe", ":"),
-      "requires": " ".join(spec["requires"]),
-      "build_requires": " ".join(spec["build_requires"]),
-      "runtime_requires": " ".join(spec["runtime_requires"]),
-      "BITS_HOOK_PARAMS": hook_params_locals,
-    })
-
-    # Define the environment so that it can be passed up to the
-    # actual build script
-    bits_dir = dirname(dirname(realpath(__file__)))
-    buildEnvironment = [
-      ("ARCHITECTURE", spec.get("architecture")),
-      ("BUILD_REQUIRES", " ".join(spec["build_requires"])),
-      ("CACHED_TARBALL", cachedTarball),
-      ("CAN_DELETE", args.aggressiveCleanup and "1" or ""),
-      ("COMMIT_HASH", short_commit_hash(spec)),
-      ("DEPS_HASH", spec.get("deps_hash", "")),
-      ("DEVEL_HASH", spec.get("devel_hash", "")),
-      ("DEVEL_PREFIX", develPrefix),
-      ("BUILD_FAMILY", spec["build_family"]),
-      ("PKGFAMILY", spec.get("package_family", "")),
-      ("GIT_COMMITTER_NAME", "unknown"),
-      ("GIT_COMMITTER_EMAIL", "unknown"),
-      ("INCREMENTAL_BUILD_HASH", spec.get("incremental_hash", "0")),
-      ("JOBS", str(args.jobs)),
-      ("PKGHASH", spec["hash"]),
-      ("PKGNAME", spec["package"]),
-      ("PKGDIR", spec["pkgdir"]),
-      ("PKGREVISION", spec["revision"]),
-      ("PKGVERSION", spec["version"]),
-      ("RELOCATE_PATHS", " ".join(spec.get("relocate_paths", []))),
-      ("REQUIRES", " ".join(spec["requires"])),
-      ("RUNTIME_REQUIRES", " ".join(spec["runtime_requires"])),
-      ("FULL_RUNTIME_REQUIRES", " ".join(spec["full_runtime_requires"])),
-      ("FULL_BUILD_REQUIRES", " ".join(spec["full_build_requires"])),
-      ("FULL_REQUIRES", " ".join(spec["full_requires"])),
-      ("BITS_PREFER_SYSTEM_KEY", spec.get("key", "")),
-      ("BITS_SCRIPT_DIR", "/bits" if args.docker else bits_dir),
-    ]
-    if "sources" in spec:
-      for idx, src in enumerate(spec["sources"]):
-        buildEnvironment.append(("SOURCE%s" % idx, basename(src)))
-      buildEnvironment.append(("SOURCE_COUNT", str(len(spec["sources"]))))
-    else:
-      buildEnvironment.append(("SOURCE_COUNT", "0"))
-    if "patches" in spec:
-      for idx, src in enumerate(spec["patches"]):
-        buildEnvironment.append(("PATCH%s" % idx, basename(src)))
-      buildEnvironment.append(("PATCH_COUNT", str(len(spec["patches"]))))
-    else:
-      buildEnvironment.append(("PATCH_COUNT", "0"))
-    # Add resolved hooks as environment variables (POST_INSTALL -> POST_INSTALL_HOOKS)
-    for hook_name, hook_value in spec.get("hook", {}).items():
-      buildEnvironment.append((hook_name + "_HOOKS", hook_value))
-
-    # Add the extra environment as passed from the command line.
-    buildEnvironment += [e.partition('=')[::2] for e in args.environment]
-
-    # Add the computed track_env environment
-    buildEnvironment += [(key, value) for key, value in spec.get("track_env", {}).items()]
-
-    # In case the --docker options is passed, we setup a docker container which
-    # will perform the actual build. Otherwise build as usual using bash.
-    if args.docker:
-      build_command = (
-        "docker run --rm --entrypoint= --user $(id -u):$(id -g) "
-        "-v {workdir}:{container_workDir} -v{configDir}:/pkgdist.bits:ro "
-        "-v {scriptDir}/build.sh:/build.sh:ro "
-        "-v {bits_dir}:/bits "
-        "{mirrorVolume} {develVolumes} {additionalEnv} {additionalVolumes} "
-        "-e WORK_DIR_OVERRIDE={container_workDir} -e BITS_CONFIG_DIR_OVERRIDE=/pkgdist.bits {extraArgs} {image} bash -ex /build.sh"
-      ).format(
-        image=quote(args.dockerImage),
-        workdir=quote(abspath(args.workDir)),
-        container_workDir=container_workDir,
-        bits_dir=bits_dir,
-        configDir=quote(abspath(args.configDir)),
-        scriptDir=quote(scriptDir),
-        extraArgs=" ".join(map(quote, args.docker_extra_args)),
-        additionalEnv=" ".join(
-          f"-e {var}={quote(value)}" for var, value in buildEnvironment),
-        # Used e.g. by O2DPG-sim-tests to find the O2DPG repository.
-        develVolumes=" ".join(
-          '-v "$PWD/$(readlink {pkg} || echo {pkg})":/{pkg}:rw'.format(pkg=quote(spec["package"]))
-          for spec in specs.values() if spec["is_devel_pkg"]),
-        additionalVolumes=" ".join(
-          "-v %s" % quote(volume) for volume in args.volumes),
-        mirrorVolume=("-v %s:/mirror" % quote(dirname(spec["reference"]))
-                      if "reference" in spec else ""),
-      )
-    else:
-      buildEnvironment = ([key, (val if isinstance(val, str) else "_".join(val))] for key, val in buildEnvironment)
-      env_vars = " ".join(["{}={}".format(key, quote(val)) for key, val in buildEnvironment])
-      build_command =  "env {} {} -e -x {}/build.sh 2>&1".format(env_vars, BASH, quote(scriptDir))
-
-    buildTargets.append(p)
-    if not args.makeflow:
-      if args.builders == 1:
-        runBuildCommand(scheduler, p, specs, args, build_command, cachedTarball, scriptDir, workDir, syncHelper)
+      if fileHash != "0":
+        debug("Mismatch between local area (%s) and the one which I should build (%s). Redoing.",
+              fileHash, spec["hash"])
+      # shutil.rmtree under Python 2 fails when hashFile is unicode and the
+      # directory contains files with non-ASCII names, e.g. Golang/Boost.
+      shutil.rmtree(dirname(hashFile).encode("utf-8"), True)
+
+      # With multiple builders, downloading the tarball (or checking out the
+      # sources) and building are separate scheduler jobs, so that later
+      # packages are fetched while earlier ones are compiling. Otherwise, and
+      # for makeflow, everything is done here, one package at a time.
+      if args.builders == 1 or args.makeflow:
+        fetchCachedTarball(spec, workDir, syncHelper, prefetch)
+        checkoutBuildSources(spec, workDir, args)
+        build_command, cachedTarball, scriptDir = createBuildCommand(p, specs, args, workDir, develPrefix)
+
+      buildTargets.append(p)
+      if not args.makeflow:
+        if args.builders == 1:
+          runBuildCommand(scheduler, p, specs, args, build_command, cachedTarball, scriptDir, workDir, syncHelper)
+        else:
+          build_deps = ["build:%s" % d for d in specs[p]["full_requires"] if d in buildTargets]
+          scheduler.parallel("download:%s" % p, [], "download", fetchCachedTarball, spec, workDir, syncHelper, prefetch)
+          scheduler.parallel("fetch:%s" % p, ["download:%s" % p], "fetch", checkoutBuildSources, spec, workDir, args)
+          scheduler.parallel("build:%s" % p, build_deps + ["fetch:%s" % p], "build", runBuildTask,
+                             scheduler, p, specs, args, workDir, develPrefix, syncHelper)
       else:
-        build_deps = ["build:%s" % d for d in specs[p]["full_requires"] if d in buildTargets]
-        scheduler.parallel("build:%s" % p, build_deps, "build", runBuildCommand, scheduler, p, specs, args, build_command,cachedTarball, scriptDir, workDir, syncHelper)
-    else:
-      breq  = " ".join([str(element) + ".build" for element in spec["full_requires"] if element in buildTargets])
-      buildList.append((p,build_command,cachedTarball,breq))
-
-  if (not args.makeflow) and (args.builders > 1) and buildTargets:
-    scheduler.run()
-    for (action, error) in scheduler.errors.items():
-      info("* The action \"{}\" was not completed successfully because {}".format(action, error))
-    if scheduler.brokenJobs:
-      dieOnError(True, "Please fix the above errors.")
-  elif args.makeflow and buildTargets:
-    mFlow = "makeflow"
-    mfDir = join(workDir, "BUILD", spec["hash"], "makeflow")
-    mfFile = mfDir + "/Makeflow"
-    mfCmd = "(cd {}; {} --clean; {})".format(mfDir, mFlow,mFlow)  
-    makedirs(mfDir, exist_ok=True)
-    jnj = ""
-    try:
-      fp = open(dirname(realpath(__file__))+'/Makeflow.jnj')
-      jnj = fp.read()
-      fp.close()
-    except:
-      from pkg_resources import resource_string
-      jnj = resource_string("bits_helpers", 'Makeflow.jnj')
-    with open(mfFile, 'w') as mf:
-      mf.write (SandboxedEnvironment(autoescape=False)
-              .from_string(jnj)
-              .render(specs=specs, args=args, ToDo=buildList)
-              )
-    for (p, build_command, cachedTarball, breq) in buildList:
-      spec = specs[p]
-      print (
-        ("Unpacking %s@%s" if cachedTarball else
-        "Compiling %s@%s (use --debug for full output)") %
-        (spec["package"],
-        args.develPrefix if "develPrefix" in args and spec["is_devel_pkg"] else spec["version"])
-      )
-    child = subprocess.run(mfCmd, shell=True, capture_output=True, text=True)
-    err = child.returncode
+        breq  = " ".join([str(element) + ".build" for element in spec["full_requires"] if element in buildTargets])
+        buildList.append((p,build_command,cachedTarball,breq))
+
+    if (not args.makeflow) and (args.builders > 1) and buildTargets:
+      if getattr(args, "scheduleGraph", None):
+        with open(args.scheduleGraph, "w") as graphFile:
+          json.dump(scheduler.graph(), graphFile, indent=2, sort_keys=True)
+      scheduler.run()
+      for (action, error) in scheduler.errors.items():
+        info("* The action \"{}\" was not completed successfully because {}".format(action, error))
+      if scheduler.brokenJobs:
+        dieOnError(True, "Please fix the above errors.")
+    elif args.makeflow and buildTargets:
+      mFlow = "makeflow"
+      mfDir = join(workDir, "BUILD", spec["hash"], "makeflow")
+      mfFile = mfDir + "/Makeflow"
+      mfCmd = "(cd {}; {} --clean; {})".format(mfDir, mFlow,mFlow)  
+      makedirs(mfDir, exist_ok=True)
+      jnj = ""
+      try:
+        fp = open(dirname(realpath(__file__))+'/Makeflow.jnj')
+        jnj = fp.read()
+        fp.close()
+      except:
+        from pkg_resources import resource_string
+        jnj = resource_string("bits_helpers", 'Makeflow.jnj')
+      levels = {}
+      for todo in buildList:
+        levels.setdefault(buildLevel[todo[0]], []).append(todo)
+      with open(mfFile, 'w') as mf:
+        mf.write (SandboxedEnvironment(autoescape=False)
+                .from_string(jnj)
+                .render(specs=specs, args=args, ToDo=buildList, Levels=[levels[l] for l in sorted(levels)])
+                )
+      for (p, build_command, cachedTarball, breq) in buildList:
+        spec = specs[p]
+        print (
+          ("Unpacking %s@%s" if cachedTarball else
+          "Compiling %s@%s (use --debug for full output)") %
+          (spec["package"],
+          args.develPrefix if "develPrefix" in args and spec["is_devel_pkg"] else spec["version"])
+        )
+      child = subprocess.run(mfCmd, shell=True, capture_output=True, text=True)
+      err = child.returncode
     
-    buildErrMsg = ""
-    if(err):
-      print(child.stdout)
+      buildErrMsg = ""
+      if(err):
+        print(child.stdout)
       
-      # Color codes for error message (if TTY)
-      bold = "\033[1m" if sys.stderr.isatty() else ""
-      red = "\033[31m" if sys.stderr.isatty() else ""
-      reset = "\033[0m" if sys.stderr.isatty() else ""
+        # Color codes for error message (if TTY)
+        bold = "\033[1m" if sys.stderr.isatty() else ""
+        red = "\033[31m" if sys.stderr.isatty() else ""
+        reset = "\033[0m" if sys.stderr.isatty() else ""
       
-      # Determine paths
-      log_path = f"{mfDir}/log"
+        # Determine paths
+        log_path = f"{mfDir}/log"
       
-      # Use relative paths if we're inside the work directory
-      try:
-        from os.path import relpath
-        log_path = relpath(log_path, os.getcwd())
-        mfDir_rel = relpath(mfDir, os.getcwd())
-      except (ValueError, OSError):
-        mfDir_rel = mfDir  # Keep absolute paths if relpath fails
+        # Use relative paths if we're inside the work directory
+        try:
+          from os.path import relpath
+          log_path = relpath(log_path, os.getcwd())
+          mfDir_rel = relpath(mfDir, os.getcwd())
+        except (ValueError, OSError):
+          mfDir_rel = mfDir  # Keep absolute paths if relpath fails
       
-      # Build the error message
-      buildErrMsg = f"{red}{bold}MAKEFLOW BUILD FAILED{reset}\n"
-      buildErrMsg += "=" * 70 + "\n\n"
+        # Build the error message
+        buildErrMsg = f"{red}{bold}MAKEFLOW BUILD FAILED{reset}\n"
+        buildErrMsg += "=" * 70 + "\n\n"
       
-      buildErrMsg += f"{bold}Makeflow Command:{reset}\n"
-      buildErrMsg += f"  {mfCmd}\n\n"
+        buildErrMsg += f"{bold}Makeflow Command:{reset}\n"
+        buildErrMsg += f"  {mfCmd}\n\n"
       
-      buildErrMsg += f"{bold}Log File:{reset}\n"
-      buildErrMsg += f"  {log_path}\n\n"
+        buildErrMsg += f"{bold}Log File:{reset}\n"
+        buildErrMsg += f"  {log_path}\n\n"
       
-      buildErrMsg += f"{bold}Makeflow Directory:{reset}\n"
-      buildErrMsg += f"  {mfDir_rel}\n"
+        buildErrMsg += f"{bold}Makeflow Directory:{reset}\n"
+        buildErrMsg += f"  {mfDir_rel}\n"
       
-      # Gather build info for the error message
-      try:
-        detected_arch = detectArch()
-
-        # Only show safe arguments (no tokens/secrets) in CLI-usable format
-        safe_args = {
-          "pkgname", "defaults", "architecture", "forceUnknownArch",
-          "develPrefix", "jobs", "noSystem", "noDevel", "forceTracked", "plugin",
-          "disable", "annotate", "onlyDeps", "docker", "makeflow"
-        }
+        # Gather build info for the error message
+        try:
+          detected_arch = detectArch()
+
+          # Only show safe arguments (no tokens/secrets) in CLI-usable format
+          safe_args = {
+            "pkgname", "defaults", "architecture", "forceUnknownArch",
+            "develPrefix", "jobs", "noSystem", "noDevel", "forceTracked", "plugin",
+            "disable", "annotate", "onlyDeps", "docker", "makeflow"
+          }
         
-        cli_args = []
-        for k, v in vars(args).items():
-          if not v or k not in safe_args:
-            continue
+          cli_args = []
+          for k, v in vars(args).items():
+            if not v or k not in safe_args:
+              continue
           
-          # Format based on type for CLI usage
-          if isinstance(v, bool):
-            if v:  # Only show if True
-              cli_args.append(f"--{k}")
-          elif isinstance(v, list):
-            if v:  # Only show non-empty lists
-              for item in v:
-                cli_args.append(f"--{k}={quote(str(item))}")
-          else:
-            # Quote if needed
-            cli_args.append(f"--{k}={quote(str(v))}")
+            # Format based on type for CLI usage
+            if isinstance(v, bool):
+              if v:  # Only show if True
+                cli_args.append(f"--{k}")
+            elif isinstance(v, list):
+              if v:  # Only show non-empty lists
+                for item in v:
+                  cli_args.append(f"--{k}={quote(str(item))}")
+            else:
+              # Quote if needed
+              cli_args.append(f"--{k}={quote(str(v))}")
         
-        args_str = " ".join(cli_args)
-
-        buildErrMsg += f"\n{bold}Environment:{reset}\n"
-        buildErrMsg += f"  OS: {detected_arch}\n"
-        buildErrMsg += f"  bits: {__version__ or 'unknown'} (bits@{os.environ['BITS_DIST_HASH'][:10]})\n"
-
-        if detected_arch.startswith("osx"):
-          xcode_info = getstatusoutput("xcodebuild -version")[1]
-          # Combine XCode version lines into one
-          xcode_lines = xcode_info.strip().split('\n')
-          if len(xcode_lines) >= 2:
-            xcode_str = f"{xcode_lines[0]} ({xcode_lines[1]})"
-          else:
-            xcode_str = xcode_lines[0] if xcode_lines else "Unknown"
-          buildErrMsg += f"  XCode: {xcode_str}\n"
-
-        buildErrMsg += f"  Arguments: {args_str}\n"
-
-      except Exception as exc:
-        warning("Failed to gather build info", exc_info=exc)
+          args_str = " ".join(cli_args)
+
+          buildErrMsg += f"\n{bold}Environment:{reset}\n"
+          buildErrMsg += f"  OS: {detected_arch}\n"
+          buildErrMsg += f"  bits: {__version__ or 'unknown'} (bits@{os.environ['BITS_DIST_HASH'][:10]})\n"
+
+          if detected_arch.startswith("osx"):
+            xcode_info = getstatusoutput("xcodebuild -version")[1]
+            # Combine XCode version lines into one
+            xcode_lines = xcode_info.strip().split('\n')
+            if len(xcode_lines) >= 2:
+              xcode_str = f"{xcode_lines[0]} ({xcode_lines[1]})"
+            else:
+              xcode_str = xcode_lines[0] if xcode_lines else "Unknown"
+            buildErrMsg += f"  XCode: {xcode_str}\n"
+
+          buildErrMsg += f"  Arguments: {args_str}\n"
+
+        except Exception as exc:
+          warning("Failed to gather build info", exc_info=exc)
       
-      # Add Next Steps section
-      buildErrMsg += f"\n{bold}Next Steps:{reset}\n"
-      buildErrMsg += f"  • View makeflow log:       cat {log_path}\n"
-      buildErrMsg += f"  • View makeflow file:      cat {mfDir_rel}/Makeflow\n"
-      if not args.debug:
-        buildErrMsg += f"  • Rebuild with debug:      bitsBuild build {' '.join(args.pkgname)} --debug --makeflow\n"
-      buildErrMsg += f"  • Please upload the full log to CERNBox/Dropbox if you intend to request support.\n"
+        # Add Next Steps section
+        buildErrMsg += f"\n{bold}Next Steps:{reset}\n"
+        buildErrMsg += f"  • View makeflow log:       cat {log_path}\n"
+        buildErrMsg += f"  • View makeflow file:      cat {mfDir_rel}/Makeflow\n"
+        if not args.debug:
+          buildErrMsg += f"  • Rebuild with debug:      bitsBuild build {' '.join(args.pkgname)} --debug --makeflow\n"
+        buildErrMsg += f"  • Please upload the full log to CERNBox/Dropbox if you intend to request support.\n"
       
+      else:
+        debug(child.stdout)
+      dieOnError(err, buildErrMsg.strip())
+      for (p, _, _, _) in buildList:
+        doFinalSync(specs[p], specs, args, syncHelper)
+
+    reportBuildTimings(specs, buildTargets, args)
+
+    if not args.onlyDeps:
+        banner(f"Build of {mainPackage} successfully completed on `{socket.gethostname()}'.\n"
+               "Your software installation is at:"
+               f"\n\n  {abspath(join(args.workDir, args.architecture))}\n\n"
+               "You can use this package by loading the environment:"
+               f"\n\n  bits enter {mainPackage}/latest-{mainBuildFamily}",
+               )
     else:
-      debug(child.stdout)
-    dieOnError(err, buildErrMsg.strip())
-    for (p, _, _, _) in buildList:
-      doFinalSync(specs[p], specs, args, syncHelper)
-
-  if not args.onlyDeps:
-      banner(f"Build of {mainPackage} successfully completed on `{socket.gethostname()}'.\n"
-             "Your software installation is at:"
-             f"\n\n  {abspath(join(args.workDir, args.architecture))}\n\n"
-             "You can use this package by loading the environment:"
-             f"\n\n  bits enter {mainPackage}/latest-{mainBuildFamily}",
-             )
-  else:
-      banner("Successfully built dependencies for package %s on `%s'.\n",
-             mainPackage, socket.gethostname()
-            )
-  for spec in specs.values():
-    if spec["is_devel_pkg"]:
-      banner("Build directory for devel package %s:\n%s/BUILD/%s-latest%s/%s",
-             spec["package"], abspath(buildWorkDir), spec["package"],
-             ("-" + args.develPrefix) if "develPrefix" in args else "",
-             spec["package"])
-  if untrackedFilesDirectories:
-    banner("Untracked files in the following directories resulted in a rebuild of "
-           "the associated package and its dependencies:\n%s\n\nPlease commit or remove them to avoid useless rebuilds.", "\n".join(untrackedFilesDirectories))
-  debug("Everything done")
-
+        banner("Successfully built dependencies for package %s on `%s'.\n",
+               mainPackage, socket.gethostname()
+              )
+    for spec in specs.values():
+      if spec["is_devel_pkg"]:
+        banner("Build directory for devel package %s:\n%s/BUILD/%s-latest%s/%s",
+               spec["package"], abspath(buildWorkDir), spec["package"],
+               ("-" + args.develPrefix) if "develPrefix" in args else "",
+               spec["package"])
+    if untrackedFilesDirectories:
+      banner("Untracked files in the following directories resulted in a rebuild of "
+             "the associated package and its dependencies:\n%s\n\nPlease commit or remove them to avoid useless rebuilds.", "\n".join(untrackedFilesDirectories))
+    debug("Everything done")
+  finally:
+    if jobserver:
+      jobserver.stop()
+    if prefetch:
+      prefetch.stop()
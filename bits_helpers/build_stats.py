@@ -0,0 +1,156 @@
+"""Build stats store, aggregated from the --resource-monitoring output.
+
+Every monitored build writes the samples of its resource usage to
+SPECS/<arch>/<package>/<version>-<revision>/<package>.jsonl (<package>.json
+for older versions of bits). The store keeps,
+for each package, a summary of its last few builds (95th percentile over time
+of the CPU usage, peak RSS in MB and duration in seconds) in the format expected by
+--resources, with the capacity of the host filled in:
+
+  bits build --builders 4 --resources sw/SPECS/<arch>/build-stats.json ...
+
+The store is updated after every monitored build, and can be regenerated
+from the monitoring files with:
+
+  python -m bits_helpers.build_stats WORKDIR ARCHITECTURE
+"""
+import json
+import math
+import os
+import sys
+import tempfile
+import threading
+from glob import glob
+from os.path import basename, dirname, exists, join, splitext
+from bits_helpers.resource_monitor import read_samples
+
+# Number of builds of a package the stats are based on.
+HISTORY_LENGTH = 5
+DEFAULT_STATS = {"cpu": [100, 400], "rss": [1024, 4096], "time": [60, 600]}
+_store_lock = threading.Lock()
+
+
+def stats_store_path(workDir, architecture):
+  return join(workDir, "SPECS", architecture, "build-stats.json")
+
+
+def host_resources():
+  """CPU (in percent of a core) and memory (in MB) of this machine."""
+  resources = {"cpu": (os.cpu_count() or 1) * 100}
+  try:
+    resources["rss"] = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") // (1024 * 1024)
+  except (ValueError, OSError, AttributeError):
+    pass  # Keep whatever the store says.
+  return resources
+
+
+def weighted_percentile(values, weights, percentile):
+  """The smallest of values below which percentile of the total weight lies."""
+  pairs = sorted(zip(values, weights))
+  total = sum(weights)
+  if total <= 0:
+    pairs = [(value, 1) for value, _ in pairs]
+    total = len(pairs)
+  cumulated = 0
+  for value, weight in pairs:
+    cumulated += weight
+    if cumulated >= percentile * total:
+      return value
+  return pairs[-1][0]
+
+
+def summarise_samples(samples):
+  """Summarise the samples of one monitored build.
+
+  Samples are not taken at regular intervals, and only the ends of a stretch
+  of similar ones are kept: each sample counts for the time until the next
+  one. Returns None if there are no samples (e.g. the build was too short).
+  """
+  if not samples:
+    return None
+  times = [sample.get("time", 0) for sample in samples]
+  durations = [max(0, end - start) for start, end in zip(times, times[1:])] + [0]
+  return {
+    "cpu": weighted_percentile([sample.get("cpu", 0) for sample in samples], durations, 0.95),
+    "rss": int(math.ceil(max(sample.get("rss", 0) for sample in samples) / (1024 * 1024))),
+    "time": max(sample.get("time", 0) for sample in samples),
+  }
+
+
+def load_store(path):
+  try:
+    with open(path) as ref:
+      return json.load(ref)
+  except (OSError, ValueError):
+    return {}
+
+
+def _merge_summary(store, package, summary, buildType):
+  packages = store.setdefault("packages", {}).setdefault(buildType, {})
+  entry = packages.setdefault(package.lower(), {})
+  history = (entry.get("history", []) + [summary])[-HISTORY_LENGTH:]
+  # Be conservative with what can kill a build (memory) or slow down others
+  # (CPU), take the average for the duration.
+  entry.update({
+    "cpu": max(run["cpu"] for run in history),
+    "rss": max(run["rss"] for run in history),
+    "time": int(round(sum(run["time"] for run in history) / len(history))),
+    "history": history,
+  })
+
+
+def _save_store(path, store):
+  store["resources"] = dict(store.get("resources", {"rss": DEFAULT_STATS["rss"][-1]}), **host_resources())
+  store.setdefault("defaults", DEFAULT_STATS)
+  store.setdefault("known", [])
+  os.makedirs(dirname(path), exist_ok=True)
+  # Write to a temporary file first, so that concurrent readers never see a
+  # partially written store.
+  fd, tmp = tempfile.mkstemp(dir=dirname(path), prefix=".build-stats")
+  with os.fdopen(fd, "w") as out:
+    json.dump(store, out, indent=2, sort_keys=True)
+  os.replace(tmp, path)
+
+
+def record_build(path, package, monitorFile, buildType="build"):
+  """Add the monitored build of package to the store in path.
+
+  Returns the summary of the build, or None if nothing was recorded.
+  """
+  try:
+    summary = summarise_samples(read_samples(monitorFile))
+  except (OSError, ValueError):
+    return None
+  if not summary:
+    return None
+  with _store_lock:
+    store = load_store(path)
+    _merge_summary(store, package, summary, buildType)
+    _save_store(path, store)
+  return summary
+
+
+def collect(workDir, architecture):
+  """Regenerate the store from all the monitoring files in workDir."""
+  path = stats_store_path(workDir, architecture)
+  store = {}
+  pattern = join(workDir, "SPECS", architecture, "*", "*", "*.json*")
+  for monitorFile in sorted(glob(pattern), key=lambda f: (os.path.getmtime(f), f)):
+    package = basename(dirname(dirname(monitorFile)))
+    name, ext = splitext(basename(monitorFile))
+    if name != package or ext not in (".json", ".jsonl"):
+      continue
+    try:
+      summary = summarise_samples(read_samples(monitorFile))
+    except (OSError, ValueError):
+      continue
+    if summary:
+      _merge_summary(store, package, summary, "build")
+  _save_store(path, store)
+  return path
+
+
+if __name__ == "__main__":
+  if len(sys.argv) != 3 or not exists(sys.argv[1]):
+    sys.exit("usage: python -m bits_helpers.build_stats WORKDIR ARCHITECTURE")
+  print(collect(sys.argv[1], sys.argv[2]))
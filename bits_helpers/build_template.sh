@@ -29,8 +29,26 @@ run_hooks() {
   done
 }
 
+# Per phase timings, one JSON object per line in $BITS_TIMINGS_FILE, next to
+# the log. bits adds them up at the end of the build.
+bits_now() {
+  if [ -n "$EPOCHREALTIME" ]; then echo "${EPOCHREALTIME/,/.}"; else date +%%s; fi
+}
+bits_timing() { # phase start end [background]
+  [ -n "$BITS_TIMINGS_FILE" ] || return 0
+  echo "{\"phase\": \"$1\", \"start\": $2, \"end\": $3${4:+, \"background\": true}}" >> "$BITS_TIMINGS_FILE" || true
+}
+bits_phase() { # end the current phase and start the one given, if any
+  local now=$(bits_now)
+  [ -z "$BITS_PHASE" ] || bits_timing "$BITS_PHASE" "$BITS_PHASE_START" "$now"
+  BITS_PHASE=$1
+  BITS_PHASE_START=$now
+}
+bits_phase setup
+
 cleanup() {
   local exit_code=$?
+  bits_phase ""
   BITS_END_TIMESTAMP=$(date +%%s)
   BITS_DELTA_TIME=$(($BITS_END_TIMESTAMP - $BITS_START_TIMESTAMP))
   echo "bits: done building $PKGNAME-$PKGVERSION-$PKGREVISION at $BITS_START_TIMESTAMP (${BITS_DELTA_TIME} s)"
@@ -58,20 +76,33 @@ export BITS_CONFIG_DIR="${BITS_CONFIG_DIR_OVERRIDE:-%(configDir)s}"
 # instead of the one we build ourselves.
 export PATH=$WORK_DIR/wrapper-scripts:$PATH
 
+# If bits shares a make jobserver among all the builds, open it and give the
+# make flags (old and new style) pointing to it in BITS_MAKEFLAGS. Recipes opt
+# in with MAKEFLAGS="${BITS_MAKEFLAGS:--j$JOBS}" make; MAKEFLAGS itself is left
+# alone, as recipes running make without -j may rely on it being serial, and
+# JOBS keeps its value for the others.
+if [ -n "$BITS_JOBSERVER" ] && [ -p "$BITS_JOBSERVER" ]; then
+  exec 7<>"$BITS_JOBSERVER"
+  export BITS_MAKEFLAGS="-j --jobserver-fds=7,7 --jobserver-auth=7,7${MAKEFLAGS:+ $MAKEFLAGS}"
+fi
+
 # The following environment variables are setup by
 # the bits script itself
 #
 # - ARCHITECTURE
+# - ARCHIVE_FORMAT
 # - BITS_SCRIPT_DIR
 # - BUILD_REQUIRES
 # - CACHED_TARBALL
 # - CAN_DELETE
+# - STREAMED_INSTALL
 # - COMMIT_HASH
 # - DEPS_HASH
 # - DEVEL_HASH
 # - DEVEL_PREFIX
 # - INCREMENTAL_BUILD_HASH
 # - JOBS
+# - BITS_JOBSERVER (only with --jobserver)
 # - PKGHASH
 # - PKGNAME
 # - PKGREVISION
@@ -101,6 +132,11 @@ mkdir -p "$WORK_DIR/BUILD" "$WORK_DIR/SOURCES" "$WORK_DIR/TARS" \
 if [ -n "$DEVEL_HASH" ]; then
   export BITS_BUILD_WORK_DIR="${WORK_DIR}"
   export INSTALLROOT="$WORK_DIR/$PKGPATH"
+elif [ -n "$STREAMED_INSTALL" ]; then
+  # The cached tarball was already unpacked in $WORK_DIR/$PKGPATH while it
+  # was downloaded, there is nothing to copy there.
+  export INSTALLROOT="$WORK_DIR/$PKGPATH"
+  export BITS_BUILD_WORK_DIR="${BITS_BUILD_WORK_DIR:-$WORK_DIR}"
 else
   export INSTALLROOT="$WORK_DIR/INSTALLROOT/$PKGHASH/$PKGPATH"
   export BITS_BUILD_WORK_DIR="${BITS_BUILD_WORK_DIR:-$WORK_DIR}"
@@ -119,6 +155,8 @@ if [[ "$INCREMENTAL_BUILD_HASH" == 0 ]] && ! rm -rf "$BUILDROOT"; then
   rm -rf "$BUILDROOT"
 fi
 mkdir -p "$INSTALLROOT" "$BUILDROOT" "$BUILDDIR" "$WORK_DIR/INSTALLROOT/$PKGHASH/$PKGPATH"
+export BITS_TIMINGS_FILE="$BUILDROOT/timings.jsonl"
+: > "$BITS_TIMINGS_FILE"
 
 cd "$WORK_DIR/INSTALLROOT/$PKGHASH"
 cat > "$INSTALLROOT/.meta.json" <<\EOF
@@ -134,7 +172,9 @@ cat <<\EOF > "$INSTALLROOT/etc/profile.d/init.sh"
 EOF
 
 # Apply dependency initialisation now, but skip setting the variables below until after the build.
+bits_phase init
 . "$INSTALLROOT/etc/profile.d/init.sh"
+bits_phase setup
 
 # Add support for direnv https://github.com/direnv/direnv/
 #
@@ -179,6 +219,19 @@ function Run() { # dummy function
     true
 }
 
+# Unpack the tarball $1 in $2, decompressing it in parallel if we can.
+function bits_untar() {
+  case "$1" in
+    *.tar.zst) tar --use-compress-program="zstd -d" -xf "$1" -C "$2" ;;
+    *) if command -v pigz > /dev/null; then
+         tar --use-compress-program=pigz -xf "$1" -C "$2"
+       else
+         tar -xzf "$1" -C "$2"
+       fi ;;
+  esac
+}
+
+if [[ "$CACHED_TARBALL" == "" ]]; then bits_phase build; else bits_phase unpack; fi
 if [[ "$CACHED_TARBALL" == "" && ! -f $BUILDROOT/log ]]; then
   set -o pipefail
   set -x;
@@ -198,21 +251,32 @@ else
   # Unpack the cached tarball in the $INSTALLROOT and remove the unrelocated
   # files.
   rm -rf "$BUILDROOT/log"
-  mkdir -p $WORK_DIR/TMP/$PKGHASH
-  tar -xzf "$CACHED_TARBALL" -C "$WORK_DIR/TMP/$PKGHASH"
-  mkdir -p $(dirname $INSTALLROOT)
-  rm -rf $INSTALLROOT
-  # Use PKGPATH which includes family if set
-  mv "$WORK_DIR/TMP/$PKGHASH/$PKGPATH" "$INSTALLROOT"
+  # relocate-me.sh runs the post-relocate.sh hook of packages found in
+  # WORK_DIR. Like for tarballs unpacked in INSTALLROOT, the hook of streamed
+  # installs only runs in the final relocation below.
+  UNPACKED_WORK_DIR=$WORK_DIR
+  if [ -n "$STREAMED_INSTALL" ]; then
+    UNPACKED_WORK_DIR=$WORK_DIR/INSTALLROOT/$PKGHASH
+  else
+    mkdir -p $WORK_DIR/TMP/$PKGHASH
+    bits_untar "$CACHED_TARBALL" "$WORK_DIR/TMP/$PKGHASH"
+    mkdir -p $(dirname $INSTALLROOT)
+    rm -rf $INSTALLROOT
+    # Use PKGPATH which includes family if set
+    mv "$WORK_DIR/TMP/$PKGHASH/$PKGPATH" "$INSTALLROOT"
+  fi
   pushd $WORK_DIR/INSTALLROOT/$PKGHASH
+  bits_phase relocate
   if [ -w "$INSTALLROOT" ]; then
-      WORK_DIR=$WORK_DIR /bin/bash -ex $INSTALLROOT/relocate-me.sh
+      WORK_DIR=$UNPACKED_WORK_DIR /bin/bash -ex $INSTALLROOT/relocate-me.sh
   fi
+  bits_phase unpack
   popd
   find $INSTALLROOT -name "*.unrelocated" -delete
   rm -rf $WORK_DIR/TMP/$PKGHASH
 fi
 
+bits_phase setup
 # Regenerate init.sh, in case the package build clobbered it. This
 # particularly happens in the AliEn-Runtime package, since it copies other
 # packages into its installroot wholesale.
@@ -242,9 +306,21 @@ cat > "$INSTALLROOT/.meta.json" <<\EOF
 %(provenance)s
 EOF
 
-cd "$WORK_DIR/INSTALLROOT/$PKGHASH/$PKGPATH"
-# Find which files need relocation.
-{ grep -I -H -l -R "\($WORK_DIR\|[@][@]PKGREVISION[@]$PKGHASH[@][@]\)" . || true; } | sed -e 's|^\./||' > "$INSTALLROOT/etc/profile.d/.bits-relocate"
+if [ -n "$STREAMED_INSTALL" ]; then
+  cd "$INSTALLROOT"
+else
+  cd "$WORK_DIR/INSTALLROOT/$PKGHASH/$PKGPATH"
+fi
+# Find which files need relocation. relocate.py looks for both patterns in one
+# pass over each file, and also records where WORK_DIR is in them, so that
+# relocate-me.sh does not have to search for it again.
+bits_phase relocation-scan
+if command -v python3 > /dev/null; then
+  python3 "${BITS_SCRIPT_DIR}/bits_helpers/relocate.py" scan . "$WORK_DIR" "@@PKGREVISION@$PKGHASH@@"
+else
+  rm -f "$INSTALLROOT/etc/profile.d/.bits-relocate-offsets"
+  { grep -I -H -l -R "\($WORK_DIR\|[@][@]PKGREVISION[@]$PKGHASH[@][@]\)" . || true; } | sed -e 's|^\./||' > "$INSTALLROOT/etc/profile.d/.bits-relocate"
+fi
 
 # Relocate script for <arch>/<pkgname>/<pkgver> structure
 
@@ -257,6 +333,7 @@ PKG_DIR="$WORK_DIR"
 EoF
 
 install "${BITS_SCRIPT_DIR}/bits_helpers/relocate-me.sh" "$INSTALLROOT/"
+install "${BITS_SCRIPT_DIR}/bits_helpers/relocate.py" "$INSTALLROOT/relocate-me.py"
 
 # Always relocate the modulefile (if present) so that it works also in devel mode.
 if [[ ! -s "$INSTALLROOT/etc/profile.d/.bits-relocate" && -f "$INSTALLROOT/etc/modulefiles/$PKGNAME" ]]; then
@@ -320,9 +397,11 @@ fi
 cd "$WORK_DIR/INSTALLROOT/$PKGHASH"
 
 # Run post-install hooks
+bits_phase post-install
 if [[ $PKGNAME != defaults-* ]]; then
   run_hooks "POST_INSTALL"
 fi
+bits_phase archive
 
 # Archive creation
 HASHPREFIX=`echo $PKGHASH | cut -b1,2`
@@ -330,33 +409,47 @@ HASH_PATH=$ARCHITECTURE/store/$HASHPREFIX/$PKGHASH
 mkdir -p "${WORK_DIR}/TARS/$HASH_PATH" \
          "${WORK_DIR}/TARS/$ARCHITECTURE/$PKGNAME"
 
-PACKAGE_WITH_REV=$PKGNAME-$PKGVERSION-$PKGREVISION.$ARCHITECTURE.tar.gz
+PACKAGE_WITH_REV=$PKGNAME-$PKGVERSION-$PKGREVISION.$ARCHITECTURE.${ARCHIVE_FORMAT:-tar.gz}
 # Copy and tar/compress (if applicable) in parallel.
 # Use -H to match tar's behaviour of preserving hardlinks.
-rsync -aH "$WORK_DIR/INSTALLROOT/$PKGHASH/" "$WORK_DIR" & rsync_pid=$!
+# The copy runs in the background, it is timed on its own.
+{
+  rsync_start=$(bits_now)
+  rsync -aH "$WORK_DIR/INSTALLROOT/$PKGHASH/" "$WORK_DIR"
+  bits_timing rsync "$rsync_start" "$(bits_now)" background
+} & rsync_pid=$!
 if [ "$CAN_DELETE" = 1 ]; then
   # We're deleting the tarball anyway, so no point in creating a new one.
-  # There might be an old existing tarball, and we should delete it.
-  rm -f "$WORK_DIR/TARS/$HASH_PATH/$PACKAGE_WITH_REV"
+  # There might be an old existing tarball, in any format, and we should
+  # delete it.
+  rm -f "$WORK_DIR/TARS/$HASH_PATH/$PKGNAME-$PKGVERSION-$PKGREVISION.$ARCHITECTURE".tar.*
 elif [ -z "$CACHED_TARBALL" ]; then
-  # Use pigz to compress, if we can, because it's multicore.
-  gzip=$(command -v pigz) || gzip=$(command -v gzip)
+  case "$ARCHIVE_FORMAT" in
+    # zstd uses all the cores with -T0.
+    tar.zst) compress="zstd -T0 -q -c" ;;
+    # Use pigz to compress, if we can, because it's multicore.
+    *) compress=$(command -v pigz) || compress=$(command -v gzip)
+       compress="$compress -c" ;;
+  esac
   # We don't have an existing tarball, and we want to keep the one we create now.
   tar -cC "$WORK_DIR/INSTALLROOT/$PKGHASH" . |
     # Avoid having broken left overs if the tar fails.
-    $gzip -c > "$WORK_DIR/TARS/$HASH_PATH/$PACKAGE_WITH_REV.processing"
+    $compress > "$WORK_DIR/TARS/$HASH_PATH/$PACKAGE_WITH_REV.processing"
   mv "$WORK_DIR/TARS/$HASH_PATH/$PACKAGE_WITH_REV.processing" \
      "$WORK_DIR/TARS/$HASH_PATH/$PACKAGE_WITH_REV"
   ln -nfs "../../$HASH_PATH/$PACKAGE_WITH_REV" \
      "$WORK_DIR/TARS/$ARCHITECTURE/$PKGNAME/$PACKAGE_WITH_REV"
 fi
+bits_phase rsync-wait
 wait "$rsync_pid"
 
 # We've copied files into their final place; now relocate.
+bits_phase relocate
 cd "$WORK_DIR"
 if [ -w "$WORK_DIR/$PKGPATH" ]; then
   bash -ex "$PKGPATH/relocate-me.sh"
 fi
+bits_phase finalise
 
 # Construct the base path for symlinks (includes family if set)
 if [ -n "$PKGFAMILY" ]; then
@@ -0,0 +1,96 @@
+"""Per phase timings of package builds.
+
+The build script appends one JSON object per phase to timings.jsonl, next to
+the log of the build in BUILD/<hash>:
+
+  {"phase": "build", "start": 1700000000.12, "end": 1700000042.5}
+
+Phases are sequential, except those marked "background" (the copy of the
+installation to WORK_DIR, which runs while the tarball is created). What
+happens in bits itself before the script runs (downloading a tarball,
+checking out the sources) is timed with phase() and kept in the spec.
+"""
+import json
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from os.path import join
+
+TIMINGS_FILE = "timings.jsonl"
+# The order in which phases happen, for display.
+PHASES = ("download", "checkout", "setup", "init", "build", "unpack", "relocation-scan",
+          "post-install", "archive", "rsync-wait", "relocate", "finalise", "rsync")
+
+
+def timings_path(buildRoot):
+  return join(buildRoot, TIMINGS_FILE)
+
+
+@contextmanager
+def phase(spec, name):
+  """Time what happens in the block as phase name of the build of spec."""
+  start = time.time()
+  try:
+    yield
+  finally:
+    spec.setdefault("phaseTimings", []).append({"phase": name, "start": start, "end": time.time()})
+
+
+def read_timings(path):
+  """Phases recorded in path, skipping unreadable lines. [] if there is no file."""
+  timings = []
+  try:
+    with open(path) as f:
+      for line in f:
+        try:
+          timing = json.loads(line)
+        except ValueError:
+          continue
+        if isinstance(timing, dict) and {"phase", "start", "end"} <= set(timing):
+          timings.append(timing)
+  except OSError:
+    pass
+  return timings
+
+
+def summarise_timings(timings):
+  """Seconds spent in each phase, and in total, for the timings of one build.
+
+  Background phases overlap with the others, they are not part of the total.
+  """
+  phases = OrderedDict()
+  background = set()
+  total = 0
+  for timing in sorted(timings, key=lambda t: t["start"]):
+    seconds = max(0, timing["end"] - timing["start"])
+    phases[timing["phase"]] = phases.get(timing["phase"], 0) + seconds
+    if timing.get("background"):
+      background.add(timing["phase"])
+    else:
+      total += seconds
+  return {"phases": phases, "background": sorted(background), "total": total}
+
+
+def _sorted_phases(names):
+  return sorted(names, key=lambda name: (PHASES.index(name) if name in PHASES else len(PHASES), name))
+
+
+def format_summary(summaries):
+  """Table of the time spent in each phase, for the builds in summaries.
+
+  summaries maps package names to the result of summarise_timings. Each
+  phase is shown with its share of the total time of all the builds.
+  """
+  summaries = {package: s for package, s in summaries.items() if s["total"]}
+  if not summaries:
+    return ""
+  grandTotal = sum(s["total"] for s in summaries.values())
+  phases = _sorted_phases(set(name for s in summaries.values() for name in s["phases"]))
+  background = set(name for s in summaries.values() for name in s["background"])
+  lines = ["%-16s %10s %6s" % ("phase", "seconds", "share")]
+  for name in phases:
+    seconds = sum(s["phases"].get(name, 0) for s in summaries.values())
+    lines.append("%-16s %10.1f %5.1f%%%s" % (name, seconds, 100 * seconds / grandTotal,
+                                             " (in background)" if name in background else ""))
+  lines.append("%-16s %10.1f (%d packages)" % ("total", grandTotal, len(summaries)))
+  return "\n".join(lines)
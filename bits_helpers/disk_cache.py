@@ -0,0 +1,86 @@
+"""Caches kept on disk between runs of bits.
+
+DiskCache holds the entries of a cache in memory, in least recently used
+order, and takes care of reading them from and writing them to their file.
+The file is written to a temporary file first and then moved in place, so
+that concurrent runs never see a partially written cache. A cache written by
+another version of its format, damaged or missing, starts empty. Subclasses
+decide what the keys are and whether an entry is still valid.
+"""
+import json
+import os
+import pickle
+import tempfile
+import threading
+from os.path import basename, dirname
+from bits_helpers.log import debug
+
+
+class DiskCache:
+  def __init__(self, path, version, maxEntries=None, binary=False) -> None:
+    """Load the cache in path, if it was written with the same version.
+
+    At most maxEntries are kept, if given. Binary caches are pickled, the
+    others are written as JSON.
+    """
+    self.path = path
+    self.version = version
+    self.maxEntries = maxEntries
+    self.binary = binary
+    self.entries = {}
+    self.dirty = False
+    # Caches are used by several threads at the same time.
+    self.lock = threading.Lock()
+    try:
+      with open(path, "rb" if binary else "r") as ref:
+        data = (pickle if binary else json).load(ref)
+      if data.get("version") == version:
+        self.entries = dict(data["entries"])
+    except Exception:  # A damaged or foreign cache is simply ignored.
+      pass
+
+  def peek(self, key):
+    """The entry for key, or None, without marking it as used."""
+    with self.lock:
+      return self.entries.get(key)
+
+  def get(self, key):
+    """The entry for key, or None."""
+    with self.lock:
+      entry = self.entries.pop(key, None)
+      if entry is not None:
+        # Most recently used entries go last, the first ones are dropped.
+        self.entries[key] = entry
+      return entry
+
+  def put(self, key, entry):
+    with self.lock:
+      self.entries.pop(key, None)
+      self.entries[key] = entry
+      while self.maxEntries is not None and len(self.entries) > self.maxEntries:
+        del self.entries[next(iter(self.entries))]
+      self.dirty = True
+
+  def save(self, keep=None):
+    """Write the entries to disk, if anything changed, leaving out those keep() rejects."""
+    if not self.dirty:
+      return
+    with self.lock:
+      entries = {key: entry for key, entry in self.entries.items() if keep is None or keep(entry)}
+    try:
+      os.makedirs(dirname(self.path), exist_ok=True)
+      fd, tmp = tempfile.mkstemp(dir=dirname(self.path), prefix="." + basename(self.path))
+      try:
+        with os.fdopen(fd, "wb" if self.binary else "w") as out:
+          data = {"version": self.version, "entries": entries}
+          if self.binary:
+            pickle.dump(data, out, pickle.HIGHEST_PROTOCOL)
+          else:
+            json.dump(data, out)
+        os.replace(tmp, self.path)
+      except BaseException:
+        os.unlink(tmp)
+        raise
+      self.dirty = False
+    except OSError as e:
+      debug("Cannot save %s: %s", self.path, e)
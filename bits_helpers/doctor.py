@@ -8,6 +8,8 @@ from bits_helpers.log import debug, error, banner, info, success, warning
 from bits_helpers.log import logger
 from bits_helpers.utilities import getPackageList, parseDefaults, readDefaults, validateDefaults
 from bits_helpers.cmd import getstatusoutput, DockerRunner
+from bits_helpers.recipe_cache import RecipeCache, recipe_cache_path
+from bits_helpers.system_checks import SystemCheckCache, system_checks_path, system_fingerprint
 import tempfile
 
 def prunePaths(workDir) -> None:
@@ -149,7 +151,12 @@ def doDoctor(args, parser):
   extra_env = {"BITS_CONFIG_DIR": "/alidist.bits" if args.docker else os.path.abspath(args.configDir)}
   extra_env.update(dict([e.partition('=')[::2] for e in args.environment]))
 
+  recipeCache = RecipeCache(recipe_cache_path(args.workDir))
+  checkCache = SystemCheckCache(system_checks_path(args.workDir, args.architecture),
+                                system_fingerprint(args.dockerImage, [extra_env, args.docker_extra_args]),
+                                refresh=args.refreshSystemChecks)
   with DockerRunner(args.dockerImage, args.docker_extra_args, extra_env=extra_env, extra_volumes=[f"{os.path.abspath(args.configDir)}:/alidist.bits:ro"] if args.docker else []) as getstatusoutput_docker:
+    runSystemCheck = checkCache.wrap(getstatusoutput_docker)
     fromSystem, own, failed, validDefaults = \
       getPackageList(packages                = packages,
                      specs                   = specs,
@@ -159,12 +166,19 @@ def doDoctor(args, parser):
                      architecture            = args.architecture,
                      disable                 = args.disable,
                      defaults                = args.defaults,
-                     performPreferCheck      = lambda pkg, cmd: checkPreferSystem(pkg, cmd, homebrew_replacement, getstatusoutput_docker),
-                     performRequirementCheck = lambda pkg, cmd: checkRequirements(pkg, cmd, homebrew_replacement, getstatusoutput_docker),
+                     performPreferCheck      = lambda pkg, cmd: checkPreferSystem(pkg, cmd, homebrew_replacement, runSystemCheck),
+                     performRequirementCheck = lambda pkg, cmd: checkRequirements(pkg, cmd, homebrew_replacement, runSystemCheck),
+                     # track_env depends on the environment, never cache it.
+                     performTrackEnv         = lambda pkg, cmd: checkPreferSystem(pkg, cmd, homebrew_replacement, getstatusoutput_docker),
                      performValidateDefaults = performValidateDefaults,
                      overrides               = overrides,
                      taps                    = taps,
-                     log                     = info)
+                     log                     = info,
+                     recipeCache             = recipeCache,
+                     # Keep the report of each check in order.
+                     concurrentChecks        = False)
+  recipeCache.save()
+  checkCache.save()
 
   alwaysBuilt = {x for x in specs} - fromSystem - own - failed
   if alwaysBuilt:
@@ -0,0 +1,41 @@
+"""On disk cache of the hashes computed by storeHashes.
+
+The hashes of a package are a pure function of its recipe, of the files it
+uses (patches and file:// sources) and of the hashes of its dependencies.
+storeHashes first hashes all of this with each file replaced by its
+signature (path, size, modification time and inode), which is cheap, and
+uses the result as the key in this cache. The files themselves are only read
+when the key is not found.
+"""
+import hashlib
+import json
+import os
+from os.path import abspath, join
+from bits_helpers.disk_cache import DiskCache
+
+HASH_CACHE_VERSION = 1
+# Keep the entries of the last few versions of a few hundred packages.
+MAX_ENTRIES = 5000
+
+
+def hash_cache_path(workDir, architecture):
+  return join(workDir, "SPECS", architecture, "hash-cache.json")
+
+
+def file_signature(path):
+  """What stands for the content of path in cache keys."""
+  st = os.stat(path)
+  return "file:%s:%d:%d:%d" % (abspath(path), st.st_size, st.st_mtime_ns, st.st_ino)
+
+
+def cache_key(hashes):
+  """Digest of the hashes computed with file signatures instead of contents."""
+  # The order of the alternative hashes is not meaningful.
+  data = {key: sorted(value) if isinstance(value, list) else value for key, value in hashes.items()}
+  return hashlib.sha1(json.dumps(data, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+class HashCache(DiskCache):
+  """Hashes of packages by cache_key(), see storeHashes."""
+  def __init__(self, path) -> None:
+    super().__init__(path, HASH_CACHE_VERSION, MAX_ENTRIES)
@@ -0,0 +1,83 @@
+"""A GNU make jobserver shared by all the builds running on a host.
+
+The jobserver is a named pipe holding one byte per compilation process which
+may be started on top of the one every make is always allowed to run. Build
+scripts open the pipe and give the make flags pointing to it in
+BITS_MAKEFLAGS; the makes (and jobserver-aware tools) of the recipes passing
+them in MAKEFLAGS, in all the concurrent builds, draw from the same pool of
+tokens.
+
+The first bits process using a given pipe hosts it: it holds a lock next to
+the pipe and fills the pipe with tokens. Other bits processes on the same host
+find the lock taken and simply use the pipe as it is.
+"""
+import fcntl
+import os
+import stat
+import tempfile
+from bits_helpers.log import debug
+
+JOBSERVER_TOKEN = b"+"
+
+
+def default_jobserver_path():
+  return os.path.join(tempfile.gettempdir(), "bits-jobserver-%d" % os.getuid())
+
+
+class JobServer:
+  """Host, or join, the make jobserver backed by the named pipe at path.
+
+  tokens is the number of processes which can be started on top of the one
+  every make runs without asking. It is only used if this process ends up
+  hosting the jobserver.
+  """
+
+  def __init__(self, path, tokens) -> None:
+    self.path = path
+    self.tokens = max(0, tokens)
+    self.hosting = False
+    self._lock_fd = None
+    self._fifo_fd = None
+
+  def start(self):
+    self._lock_fd = os.open(self.path + ".lock", os.O_RDWR | os.O_CREAT, 0o600)
+    try:
+      fcntl.flock(self._lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+      # Some other bits process hosts the jobserver already.
+      os.close(self._lock_fd)
+      self._lock_fd = None
+      debug("Using the jobserver hosted by another process in %s", self.path)
+      return self
+    try:
+      if not stat.S_ISFIFO(os.stat(self.path).st_mode):
+        os.unlink(self.path)
+        os.mkfifo(self.path, 0o600)
+    except FileNotFoundError:
+      os.mkfifo(self.path, 0o600)
+    # Opening for both reading and writing never blocks and keeps the tokens
+    # in the pipe as long as we are alive, even when no build is running.
+    self._fifo_fd = os.open(self.path, os.O_RDWR | os.O_NONBLOCK)
+    # Drop tokens left over by a previous host before adding ours.
+    try:
+      while os.read(self._fifo_fd, 4096):
+        pass
+    except BlockingIOError:
+      pass
+    os.write(self._fifo_fd, JOBSERVER_TOKEN * self.tokens)
+    self.hosting = True
+    debug("Hosting a jobserver with %d tokens in %s", self.tokens, self.path)
+    return self
+
+  def stop(self):
+    for fd in (self._fifo_fd, self._lock_fd):
+      if fd is not None:
+        os.close(fd)
+    self._fifo_fd = self._lock_fd = None
+    self.hosting = False
+
+  def __enter__(self):
+    return self.start()
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.stop()
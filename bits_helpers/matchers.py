@@ -0,0 +1,61 @@
+"""Match strings against many regular expressions at once.
+
+Overrides in defaults files and the "known" patterns of the resource stats
+are lists of regular expressions which every package is checked against.
+RegexList compiles them once, together with a single alternation of all of
+them: one regular expression call tells which is the first one to match,
+if any, and results are memoised by string.
+"""
+import re
+from functools import lru_cache
+
+# Patterns which cannot be combined: back references and conditionals on a
+# group number would point to the wrong group, and global inline flags like
+# (?i) would apply to all the patterns (before Python 3.11, they only warn
+# when not at the start).
+_NOT_COMBINABLE = re.compile(r"\\[1-9]|\(\?P=|\(\?\([0-9]|\(\?[aiLmsux]+\)")
+
+
+@lru_cache(maxsize=None)
+def compiled(pattern):
+  """re.compile(pattern), without going through the size limited cache of re."""
+  return re.compile(pattern)
+
+
+class RegexList:
+  def __init__(self, patterns, fullmatch=False) -> None:
+    self.patterns = list(patterns)
+    self.fullmatch = fullmatch
+    self.compiled = [compiled(p) for p in self.patterns]
+    self.combined = None
+    self.memo = {}
+    if self.patterns and not any(_NOT_COMBINABLE.search(p) for p in self.patterns):
+      try:
+        # With alternatives, the first one which matches wins, just like
+        # trying the patterns one by one. The group which closes last is the
+        # one around the alternative, which tells which pattern matched.
+        self.combined = re.compile("|".join("(?P<_%d>%s)" % (i, p) for i, p in enumerate(self.patterns)))
+      except re.error:
+        pass
+
+  def _match(self, regex, string):
+    return regex.fullmatch(string) if self.fullmatch else regex.match(string)
+
+  def first(self, string):
+    """Index of the first pattern matching string, or None."""
+    if string not in self.memo:
+      if self.combined is not None:
+        match = self._match(self.combined, string)
+        self.memo[string] = int(match.lastgroup[1:]) if match else None
+      else:
+        self.memo[string] = next((i for i, regex in enumerate(self.compiled)
+                                  if self._match(regex, string)), None)
+    return self.memo[string]
+
+  def matching(self, string):
+    """All the patterns matching string, in order."""
+    first = self.first(string)
+    if first is None:
+      return []
+    return [self.patterns[first]] + [p for p, regex in zip(self.patterns[first + 1:], self.compiled[first + 1:])
+                                     if self._match(regex, string)]
@@ -0,0 +1,70 @@
+"""On disk cache of parsed recipes.
+
+Reading, splitting and parsing the YAML header of every recipe is most of
+what happens before the first build starts. parseRecipe reports what its
+result depends on: the recipe itself (a file, or a blob in a git reference
+for dist: recipes), the files pulled in with !include and the recipes it
+inherits from with from:. Each of them is stored with its signature (path,
+size, modification time and inode for files, the blob id in git), and the
+parsed recipe is reused as long as all the signatures are unchanged.
+
+Recipes coming from packages.py generators are never cached, as there is no
+way of knowing what they depend on.
+"""
+import os
+import pickle
+from os.path import join
+from bits_helpers.disk_cache import DiskCache
+from bits_helpers.log import debug
+from bits_helpers.utilities import dependencySignature, parseRecipe
+
+RECIPE_CACHE_VERSION = 1
+MAX_ENTRIES = 5000
+
+
+def recipe_cache_path(workDir):
+  return join(workDir, "SPECS", "recipe-cache.pickle")
+
+
+def _cache_key(dependency, generatePackages):
+  # How from: parents are found depends on where bits runs from, on the
+  # environment and on which packages are generated.
+  generated = tuple(sorted((pkgdir, pkg, meta.get("version"))
+                           for pkgdir, pkgs in (generatePackages or {}).items()
+                           for pkg, meta in pkgs.items()))
+  return (dependency, os.getcwd(), os.environ.get("BITS_REPO_DIR"),
+          os.environ.get("BITS_PATH"), generated)
+
+
+class RecipeCache(DiskCache):
+  def __init__(self, path) -> None:
+    super().__init__(path, RECIPE_CACHE_VERSION, MAX_ENTRIES, binary=True)
+    self.hits = self.misses = 0
+
+  def parse(self, reader, generatePackages=None):
+    """Same as parseRecipe(reader, generatePackages), reusing previous results."""
+    dependency = getattr(reader, "dependency", lambda: None)()
+    if dependency is None:
+      return parseRecipe(reader, generatePackages)
+    key = _cache_key(dependency, generatePackages)
+    entry = self.peek(key)
+    if entry is not None:
+      dependencies, parsed = entry
+      if all(dependencySignature(dep) == signature for dep, signature in dependencies):
+        self.get(key)
+        with self.lock:
+          self.hits += 1
+        # Callers modify the spec, give them a copy of their own.
+        return (None,) + pickle.loads(parsed)
+    with self.lock:
+      self.misses += 1
+    dependencies = []
+    err, spec, recipe = parseRecipe(reader, generatePackages, dependencies=dependencies)
+    if not err and None not in dependencies and all(signature for _, signature in dependencies):
+      self.put(key, (dependencies, pickle.dumps((spec, recipe), pickle.HIGHEST_PROTOCOL)))
+    return err, spec, recipe
+
+  def save(self):
+    if self.dirty:
+      debug("Parsed %d recipes, %d from the cache", self.hits + self.misses, self.hits)
+    super().save()
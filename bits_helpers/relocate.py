@@ -0,0 +1,179 @@
+"""Relocate the text files of a package in a single pass.
+
+Packages are built in WORK_DIR/INSTALLROOT/<hash>, and the text files which
+mention that path need to be changed once the package is installed somewhere
+else. Rather than grep -I -l -R to find them and two sed -i per file to
+change them:
+
+- scan, used by the build script when the package is packed, looks for all
+  the patterns at once in every file, several files at a time. It writes the
+  files with matches to .bits-relocate, like grep did, and where the first
+  pattern (the old WORK_DIR) is in each of them to .bits-relocate-offsets.
+- apply, used by relocate-me.sh, makes the same substitutions as the sed
+  commands did, in one process and several files at a time. Where the
+  offsets recorded at packing time are still valid, it goes straight to them
+  rather than searching the file again.
+
+This script is installed in every package, next to relocate-me.sh, so it
+only uses the standard library.
+"""
+import json
+import mmap
+import os
+import re
+import sys
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+RELOCATE_LIST = "etc/profile.d/.bits-relocate"
+RELOCATE_OFFSETS = "etc/profile.d/.bits-relocate-offsets"
+# Files with a NUL byte in their first block are binary, as for grep -I.
+BINARY_CHECK_SIZE = 32768
+
+
+def parallel_map(function, items, jobs=None):
+  """map(function, items), in jobs processes if we can start them."""
+  items = list(items)
+  if len(items) > 1 and (jobs or os.cpu_count() or 1) > 1:
+    try:
+      with ProcessPoolExecutor(max_workers=jobs) as executor:
+        return list(executor.map(function, items, chunksize=max(1, len(items) // 64)))
+    except (OSError, NotImplementedError, ImportError):
+      pass  # e.g. no /dev/shm: do it here
+  return [function(item) for item in items]
+
+
+def scan_file(args):
+  """Offsets of the first pattern in path, or None if no pattern is in it."""
+  path, regex, first = args
+  try:
+    with open(path, "rb") as f:
+      if os.fstat(f.fileno()).st_size == 0:
+        return None
+      with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        if data.find(b"\0", 0, BINARY_CHECK_SIZE) != -1:
+          return None
+        found = False
+        offsets = []
+        for match in re.finditer(regex, data):
+          found = True
+          if match.group() == first:
+            offsets.append(match.start())
+        return (len(data), offsets) if found else None
+  except (OSError, ValueError):
+    return None
+
+
+def scan(root, patterns, jobs=None):
+  """Files under root which contain any of patterns, with the offsets of the first one.
+
+  Returns a dictionary from the paths, relative to root, to (size, offsets)
+  tuples. Symlinks are not followed.
+  """
+  patterns = [p.encode() if isinstance(p, str) else p for p in patterns]
+  # Longer patterns first, so that a pattern which is a prefix of another one
+  # does not hide it.
+  regex = re.compile(b"|".join(re.escape(p) for p in sorted(patterns, key=len, reverse=True)))
+  paths = []
+  for directory, _, files in os.walk(root):
+    for name in files:
+      path = os.path.join(directory, name)
+      if not os.path.islink(path) and os.path.isfile(path):
+        paths.append(path)
+  results = parallel_map(scan_file, ((p, regex, patterns[0]) for p in paths), jobs)
+  return {os.path.relpath(path, root): result
+          for path, result in zip(paths, results) if result is not None}
+
+
+def write_scan(root, patterns, jobs=None):
+  """Write .bits-relocate and .bits-relocate-offsets for the package in root."""
+  found = scan(root, patterns, jobs)
+  for name in (RELOCATE_LIST, RELOCATE_OFFSETS):
+    found.pop(name, None)
+  os.makedirs(os.path.join(root, os.path.dirname(RELOCATE_LIST)), exist_ok=True)
+  with open(os.path.join(root, RELOCATE_LIST), "w") as out:
+    out.writelines(path + "\n" for path in sorted(found))
+  with open(os.path.join(root, RELOCATE_OFFSETS), "w") as out:
+    json.dump({"pattern": patterns[0], "files": found}, out, sort_keys=True)
+
+
+def offsets_usable(old_long, old, new):
+  """Whether replacing at the offsets of old gives the same result as sed.
+
+  The build script runs s|old_long|new|g, then s|old|new|g, where old_long
+  starts with old. Matches of old cannot overlap each other or the end of
+  old_long, and new cannot make new matches of old appear, so the result is
+  the same as replacing old_long or old at each offset of old.
+  """
+  if not old or not old_long.startswith(old) or old_long.find(old, 1) != -1 or old in new or new in old:
+    return False
+  for k in range(1, len(old)):
+    if old[:k] == old[-k:] or old[-k:] == new[:k] or old[:k] == new[-k:] or old_long.endswith(old[:k]):
+      return False
+  return True
+
+
+def relocate_file(args):
+  """Substitute old_long, then old, with new in path. Returns whether it changed."""
+  path, old_long, old, new, offsets = args
+  with open(path, "rb") as f:
+    data = f.read()
+  if offsets is not None and offsets[0] == len(data) and \
+     all(data.startswith(old, offset) for offset in offsets[1]):
+    pieces = []
+    position = 0
+    for offset in offsets[1]:
+      pieces.append(data[position:offset])
+      position = offset + (len(old_long) if data.startswith(old_long, offset) else len(old))
+      pieces.append(new)
+    pieces.append(data[position:])
+    relocated = b"".join(pieces)
+  else:
+    relocated = data.replace(old_long, new).replace(old, new)
+  if relocated == data:
+    return False
+  # Like sed -i: write a new file with the same permissions, and move it in place.
+  mode = os.stat(path).st_mode
+  fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".relocating-")
+  try:
+    with os.fdopen(fd, "wb") as out:
+      out.write(relocated)
+    os.chmod(tmp, mode & 0o7777)
+    os.replace(tmp, path)
+  except BaseException:
+    os.unlink(tmp)
+    raise
+  return True
+
+
+def apply(root, old_long, old, new, jobs=None):
+  """Relocate the files listed in .bits-relocate in root, as relocate-me.sh's sed did."""
+  with open(os.path.join(root, RELOCATE_LIST)) as listing:
+    paths = listing.read().split()
+  recorded = {}
+  try:
+    with open(os.path.join(root, RELOCATE_OFFSETS)) as offsets:
+      data = json.load(offsets)
+    if data["pattern"] == old:
+      recorded = data["files"]
+  except (OSError, ValueError, KeyError, TypeError):
+    pass
+  old_long, old, new = old_long.encode(), old.encode(), new.encode()
+  if not offsets_usable(old_long, old, new):
+    recorded = {}
+  return sum(parallel_map(relocate_file, ((os.path.join(root, path), old_long, old, new, recorded.get(path))
+                                          for path in paths), jobs))
+
+
+def main(argv):
+  if len(argv) >= 3 and argv[0] == "scan":
+    write_scan(argv[1], argv[2:])
+  elif len(argv) == 5 and argv[0] == "apply":
+    apply(*argv[1:])
+  else:
+    sys.exit("usage: relocate.py scan ROOT PATTERN...\n"
+             "       relocate.py apply ROOT OLD_PATH_IN_INSTALLROOT OLD_PATH NEW_PATH")
+
+
+if __name__ == "__main__":
+  main(sys.argv[1:])
@@ -1,13 +1,38 @@
-import re, copy
+import copy, math
+from bits_helpers.matchers import RegexList
+
+# resource_monitor samples rss in bytes, stats are in MB.
+RSS_UNIT = 1024 * 1024
+
 class ResourceManager:
-    def __init__(self, ESstats, scheduler, highestPriortyOnly = False):
+    def __init__(self, ESstats, scheduler, highestPriortyOnly = False, backfill = True):
         self.esStats = ESstats
         self.scheduler = scheduler
         self.machineResources = ESstats["resources"]
+        self.totalResources = dict(self.machineResources)
         self.resouceList = ["cpu", "rss"]
         self.allocated = {}
+        self.allocatedAt = {}
         self.highestPriortyOnly = highestPriortyOnly
+        # EASY backfill: when the highest priority external does not fit, reserve
+        # resources for it at the time enough of them will be released, and only
+        # start others which do not delay it.
+        self.backfill = backfill
+        # Live usage of the running externals. Once samples come in, an
+        # external is charged its peak usage plus usageMargin rather than its
+        # estimate: more if it turns out to need more, less (but no less than
+        # minChargedFraction of the estimate) if it runs well under it for
+        # at least releaseAfter of its expected time. Nothing new is admitted
+        # while the actual rss is above memoryPressure of the machine.
+        self.estimates = {}
+        self.liveUsage = {}
+        self.peakUsage = {}
+        self.usageMargin = 0.2
+        self.minChargedFraction = 0.5
+        self.releaseAfter = 0.5
+        self.memoryPressure = 0.9
         self.seenPackages = {}
+        self.knownMatcher = None
         self.priorityList = ["time"] # can be any list from the stat keys
         # Make sure required package resources are not larger
         # then systems available resources
@@ -18,54 +43,114 @@ class ResourceManager:
                 self.esStats["packages"][xtype][pkg][res] = self.machineResources[res]
         return
 
+    def getStats(self, ext_full): # return the recorded (or default) stats for a task
+        stats = {"name": ext_full}
+        ext_items = ext_full.split(":", 1)
+        ext = ext_items[-1].lower()
+        build_type = ext_items[0] if ext_items[0] in ["prep", "build", "install", "srpm", "rpms"] else "build"
+        pkg_stats = self.esStats["packages"].get(build_type, {})
+        if ext not in pkg_stats:
+          idx = -1
+          ext = "{}:{}".format(build_type, ext)
+          if self.knownMatcher is None:
+            self.knownMatcher = RegexList(exp[0] for exp in self.esStats["known"])
+          known = self.knownMatcher.first(ext)
+          if known is not None:
+            idx = self.esStats["known"][known][1]
+          for k in self.esStats["defaults"]:
+            stats[k] = self.esStats["defaults"][k][idx]
+          self.scheduler.debug("New external found, creating default entry %s" % stats)
+        else:
+          for k in self.esStats["defaults"]:
+            stats[k] = pkg_stats[ext][k]
+        return stats
+
     def allocResourcesForExternals(self, externalsList, count=1000): # return ordered list for externals that can be started
         externals_to_run = []
         if count<=0: return externals_to_run
+        liveRss = sum(usage["rss"] for usage in self.liveUsage.values())
+        if liveRss >= self.memoryPressure * self.totalResources["rss"]:
+          self.scheduler.debug("Memory pressure (%d MB in use), not starting anything" % liveRss)
+          return externals_to_run
         for ext_full in externalsList:
-          stats = {"name": ext_full}
-          ext_items = ext_full.split(":", 1)
-          ext = ext_items[-1].lower()
-          build_type = ext_items[0] if ext_items[0] in ["prep", "build", "install", "srpm", "rpms"] else "build"
-          pkg_stats = self.esStats["packages"].get(build_type, {})
           if ext_full in self.seenPackages:
             stats = self.seenPackages[ext_full]
           else:
-            if ext not in pkg_stats:
-              idx = -1
-              ext = "{}:{}".format(build_type, ext)
-              for exp in self.esStats["known"]:
-                if re.match(exp[0], ext):
-                  idx = exp[1]
-                  break
-              for k in self.esStats["defaults"]:
-                stats[k] = self.esStats["defaults"][k][idx]
-              self.scheduler.debug("New external found, creating default entry %s" % stats)
-            else:
-              for k in self.esStats["defaults"]:
-                stats[k] = pkg_stats[ext][k]
+            stats = self.getStats(ext_full)
             self.seenPackages[ext_full] = copy.deepcopy(stats)
           externals_to_run.append(stats)
 
         # first order them by metric and then run over to alloc resources
         externalsList_sorted = [ext for ext in sorted(externals_to_run, key=lambda x: tuple(x[k] for k in self.priorityList), reverse=True)]
         externals_ordered = []
+        reservation = None
+        now = self.scheduler.now()
         for ex_stats in externalsList_sorted:
-          if not [r for r in self.resouceList if ex_stats[r]>self.machineResources[r]]:
+          fits = not [r for r in self.resouceList if ex_stats[r]>self.machineResources[r]]
+          if fits and reservation:
+            shadow_time, spare = reservation
+            if now + ex_stats["time"] > shadow_time:
+              # Still running when the reserved external should start: it can
+              # only use what the reserved one will leave.
+              if [r for r in self.resouceList if ex_stats[r]>spare[r]]:
+                continue
+              for prm in self.resouceList:
+                spare[prm] -= ex_stats[prm]
+            self.scheduler.debug("Backfilling %s" % ex_stats["name"])
+          if fits:
             for prm in self.resouceList:
               self.machineResources[prm] -= ex_stats[prm]
             externals_ordered.append(ex_stats["name"])
             self.allocated[ex_stats["name"]] = ex_stats
+            self.allocatedAt[ex_stats["name"]] = now
+            self.estimates[ex_stats["name"]] = {r: ex_stats[r] for r in self.resouceList}
             self.scheduler.debug("Allocating resources %s" % ex_stats)
             count-=1
             if count<=0:
               break
           elif self.highestPriortyOnly:
             break
+          elif self.backfill and not reservation:
+            reservation = self.reserveResources(ex_stats, now)
         if externals_ordered:
           self.scheduler.debug("Available resources %s" % self.machineResources)
           self.scheduler.debug("Buildable tasks {}: {}".format(len(externals_ordered), ",".join(externals_ordered)))
         return externals_ordered
 
+    def reserveResources(self, ex_stats, now): # return (shadow time, spare resources at that time)
+        # Walk the running externals by expected end time, until enough
+        # resources are released for ex_stats to start.
+        available = dict(self.machineResources)
+        running = sorted((max(now, self.allocatedAt[name] + stats["time"]), name)
+                         for name, stats in self.allocated.items())
+        for end_time, name in running:
+          for prm in self.resouceList:
+            available[prm] += self.allocated[name][prm]
+          if not [r for r in self.resouceList if ex_stats[r]>available[r]]:
+            self.scheduler.debug("Reserving resources for %s at %s" % (ex_stats["name"], end_time))
+            return end_time, {r: available[r]-ex_stats[r] for r in self.resouceList}
+        return None
+
+    def updateUsage(self, external, sample): # sample from resource_monitor
+        if external not in self.allocated: return
+        live = {"cpu": sample.get("cpu", 0), "rss": sample.get("rss", 0) / RSS_UNIT}
+        self.liveUsage[external] = live
+        peak = self.peakUsage.setdefault(external, dict(live))
+        stats = self.allocated[external]
+        estimate = self.estimates[external]
+        elapsed = self.scheduler.now() - self.allocatedAt[external]
+        for prm in self.resouceList:
+          peak[prm] = max(peak[prm], live[prm])
+          charge = int(math.ceil(peak[prm] * (1 + self.usageMargin)))
+          if charge < estimate[prm] and elapsed < self.releaseAfter * stats["time"]:
+            continue # too early to tell it will not need what was estimated
+          charge = max(charge, int(math.ceil(estimate[prm] * self.minChargedFraction)))
+          charge = min(charge, self.totalResources[prm])
+          if charge != stats[prm]:
+            self.machineResources[prm] -= charge - stats[prm]
+            stats[prm] = charge
+        self.scheduler.debug("Live usage of %s: %s, now charged %s" % (external, live, {r: stats[r] for r in self.resouceList}))
+
     def releaseResourcesForExternal(self, external):
         if external not in self.allocated: return
         for prm in self.resouceList:
@@ -73,3 +158,7 @@ class ResourceManager:
         self.scheduler.debug("Released resources: {} , {}".format(self.allocated[external], self.machineResources))
         del self.seenPackages[external]
         del self.allocated[external]
+        del self.allocatedAt[external]
+        del self.estimates[external]
+        self.liveUsage.pop(external, None)
+        self.peakUsage.pop(external, None)
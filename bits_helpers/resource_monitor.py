@@ -1,83 +1,424 @@
+"""Sample the resources used by a build while it runs.
+
+Each build gets its own monitor, using the cheapest backend available:
+
+- cgroup: if a cgroup v2 hierarchy is delegated to us, every build runs in a
+  cgroup of its own and the kernel accounting of that cgroup is read
+  (cpu.stat, memory.stat, io.stat). It includes processes which ended between
+  two samples.
+- proc: the process tree of the build is found with a single pass over /proc.
+  The CPU time includes the children each process has waited for, so that
+  short lived compilers are accounted for too.
+- psutil: for systems without /proc.
+
+Samples are taken every SAMPLE_INTERVAL seconds, less and less often while
+the usage of the build stays the same. They are appended, one JSON object per
+line, to the monitoring file as soon as they are taken, so that nothing is
+lost if bits is interrupted. Of a stretch of similar samples, only the first
+and the last ones are written. Use read_samples() or read_columns() to read
+the file back.
+"""
+import itertools
+import json
+import os
 import subprocess
-from threading import Thread
-import psutil
-from json import dump as json_dump
+from array import array
+from functools import lru_cache
+from os.path import isdir, join
+from shlex import quote
+from threading import Event, Thread
 from time import time, sleep
 from bits_helpers.cmd import monitor_progress
+from bits_helpers.log import debug
+
+try:
+  import psutil
+except ImportError:
+  psutil = None
+try:
+  import numpy
+except ImportError:
+  numpy = None
 
-# Sampling interval in seconds
+# Sampling interval in seconds. It doubles, up to MAX_SAMPLE_INTERVAL, every
+# time a sample is close to the previous one, and goes back to SAMPLE_INTERVAL
+# as soon as the usage changes.
 SAMPLE_INTERVAL = 1.0
-cpu_initialized = set()
-
-def update_monitor_stats(proc):
-    global cpu_initialized
-    children = []
-    try: children = proc.children(recursive=True)
-    except: return {}
-    stats = {"rss": 0, "vms": 0, "shared": 0, "data": 0, "uss": 0, "pss": 0, "num_fds": 0, "num_threads": 0, "processes": 0, "cpu": 0}
-    clds = len(children)
-    if clds==0: return stats
-    stats['processes'] = clds
-
-    # Step 1: Initialize CPU counters for new PIDs
-    current_pids = set()
-    for p in children:
-        pid = p.pid
-        current_pids.add(pid)
-        if pid not in cpu_initialized:
-            try:
-                p.cpu_percent(interval=None)
-                cpu_initialized.add(pid)
-            except:
-                continue
-
-    # Step 2: Sleep once to allow CPU measurement
-    sleep(SAMPLE_INTERVAL)
-
-    # Step 3: Collect CPU%, memory, threads, FDs
-    for p in children:
-        try:
-            stats["cpu"] += int(p.cpu_percent(interval=None))
-            try:
-                mem = p.memory_full_info()
-                stats["uss"] += getattr(mem, "uss", 0)
-                stats["pss"] += getattr(mem, "pss", 0)
-            except:
-                mem = p.memory_info()
-            for a in ["rss", "vms", "shared", "data"]:
-                stats[a] += getattr(mem, a)
-            stats["num_threads"] += p.num_threads()
-            try:
-                stats["num_fds"] += p.num_fds()
-            except:
-                pass
-        except:
-            continue
-
-    # Step 4: Cleanup exited PIDs
-    cpu_initialized.intersection_update(current_pids)
+MAX_SAMPLE_INTERVAL = 8.0
+# Changes below SAMPLE_CHANGE of the previous value (or of the floor given
+# here, for small values) do not count as changes.
+SAMPLE_CHANGE = 0.1
+SAMPLE_FLOORS = {"cpu": 100, "rss": 64 * 1024 * 1024}
+
+PROC = "/proc"
+CGROUP_ROOTS = ("/sys/fs/cgroup", "/sys/fs/cgroup/unified")
+try:
+  CLOCK_TICKS = os.sysconf("SC_CLK_TCK")
+  PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+except (ValueError, OSError, AttributeError):
+  CLOCK_TICKS, PAGE_SIZE = 100, 4096
+_cgroup_counter = itertools.count()
+
+
+def read_proc_stat(pid):
+  """Parse /proc/<pid>/stat.
+
+  Returns (ppid, state, cpu seconds, threads, vms, rss, start time), where
+  the CPU time includes the children pid has waited for, or None if pid is
+  gone. The start time, in clock ticks since boot, tells a process from a
+  later one with the same pid.
+  """
+  try:
+    with open("%s/%d/stat" % (PROC, pid), "rb") as stat:
+      data = stat.read()
+  except OSError:
+    return None
+  # The command name, in parentheses, may contain spaces and parentheses.
+  fields = data[data.rfind(b")") + 2:].split()
+  try:
+    return (int(fields[1]), fields[0].decode(),
+            sum(int(x) for x in fields[11:15]) / CLOCK_TICKS,
+            int(fields[17]), int(fields[20]), int(fields[21]) * PAGE_SIZE, int(fields[19]))
+  except (IndexError, ValueError):
+    return None
+
+
+class _Monitor:
+  """Per build state, common to all backends."""
+
+  def __init__(self, pid) -> None:
+    self.pid = pid
+    self.lastCpu = 0.0
+    self.lastTime = time()
+
+  def cpuPercent(self, cpuSeconds):
+    now = time()
+    # Processes reaped by someone outside of the build take their CPU time
+    # away, never report a negative usage because of that.
+    percent = max(0.0, cpuSeconds - self.lastCpu) * 100 / max(now - self.lastTime, 1e-3)
+    self.lastCpu, self.lastTime = cpuSeconds, now
+    return int(percent)
+
+  def running(self):
+    info = read_proc_stat(self.pid)
+    return info is not None and info[1] != "Z"
+
+
+class ProcMonitor(_Monitor):
+  def __init__(self, pid) -> None:
+    super().__init__(pid)
+    # (pid, start time) of the processes which were not part of the build
+    # when last seen. A process never moves into the build, so they are left
+    # out of its tree. The start time tells them from later processes reusing
+    # their pid, which may be part of the build.
+    self.outside = set()
+
+  def tree(self):
+    """Stats of the processes of the build, by pid."""
+    procs = {}
+    children = {}
+    listed = set()
+    for entry in os.listdir(PROC):
+      if not entry.isdigit():
+        continue
+      pid = int(entry)
+      info = read_proc_stat(pid)
+      if not info:
+        continue
+      listed.add((pid, info[6]))
+      if (pid, info[6]) in self.outside:
+        continue
+      procs[pid] = info
+      children.setdefault(info[0], []).append(pid)
+    tree = {}
+    todo = [self.pid] if self.pid in procs else []
+    while todo:
+      pid = todo.pop()
+      tree[pid] = procs[pid]
+      todo.extend(children.get(pid, ()))
+    # Forget processes which are gone, or whose pid now belongs to another one.
+    self.outside.intersection_update(listed)
+    self.outside.update((pid, info[6]) for pid, info in procs.items() if pid not in tree)
+    return tree
+
+  def sample(self):
+    tree = self.tree()
+    if not tree:
+      return {}
+    return {
+      "rss": sum(info[5] for info in tree.values()),
+      "vms": sum(info[4] for info in tree.values()),
+      "num_threads": sum(info[3] for info in tree.values()),
+      "processes": len(tree) - 1,
+      "cpu": self.cpuPercent(sum(info[2] for info in tree.values())),
+    }
+
+
+def _read_keyed(path):
+  with open(path) as f:
+    return {key: int(value) for key, value in (line.split() for line in f if line.strip())}
+
+
+class CgroupMonitor(_Monitor):
+  def __init__(self, pid, path) -> None:
+    super().__init__(pid)
+    self.path = path
+    # Used if the build could not be moved to its cgroup.
+    self.proc = ProcMonitor(pid)
+
+  def sample(self):
+    try:
+      usage = _read_keyed(join(self.path, "cpu.stat")).get("usage_usec", 0)
+      with open(join(self.path, "cgroup.procs")) as procs:
+        pids = [int(pid) for pid in procs.read().split()]
+    except (OSError, ValueError):
+      return self.proc.sample()
+    if not pids and not usage:
+      return self.proc.sample()
+    infos = [info for info in map(read_proc_stat, pids) if info]
+    stats = {
+      "rss": sum(info[5] for info in infos),
+      "vms": sum(info[4] for info in infos),
+      "num_threads": sum(info[3] for info in infos),
+      "processes": max(0, len(pids) - 1),
+      "cpu": self.cpuPercent(usage / 1e6),
+    }
+    # memory.current also counts the page cache, which a build fills up with
+    # the files it writes, anonymous memory is what the processes use.
+    try:
+      stats["rss"] = _read_keyed(join(self.path, "memory.stat"))["anon"]
+    except (OSError, ValueError, KeyError):
+      pass
+    try:
+      with open(join(self.path, "io.stat")) as io:
+        for line in io:
+          for key, value in (field.split("=") for field in line.split()[1:]):
+            if key in ("rbytes", "wbytes"):
+              stats[key] = stats.get(key, 0) + int(value)
+    except (OSError, ValueError):
+      pass
     return stats
 
-def monitor_stats(p_id, stats_file_name):
-    stime = int(time())
-    p = psutil.Process(p_id)
-    data = []
-    while p.is_running():
-        stats = update_monitor_stats(p)
-        if not stats:
-            sleep(SAMPLE_INTERVAL)
-            continue
-        stats['time'] = int(time()-stime)
-        data.append(stats)
-    with open(stats_file_name, "w") as sf:
-        json_dump(data, sf)
-    return
-
-
-def run_monitor_on_command(command, stats_file_name, printer, timeout=None):
+
+class PsutilMonitor(_Monitor):
+  def __init__(self, pid) -> None:
+    super().__init__(pid)
+    self.proc = psutil.Process(pid)
+
+  def running(self):
+    try:
+      return self.proc.status() != psutil.STATUS_ZOMBIE
+    except psutil.Error:
+      return False
+
+  def sample(self):
+    stats = {"rss": 0, "vms": 0, "num_threads": 0, "processes": 0}
+    cpu = 0.0
+    try:
+      procs = [self.proc] + self.proc.children(recursive=True)
+    except psutil.Error:
+      return {}
+    for p in procs:
+      try:
+        with p.oneshot():
+          times = p.cpu_times()
+          cpu += times.user + times.system + times.children_user + times.children_system
+          mem = p.memory_info()
+          stats["rss"] += mem.rss
+          stats["vms"] += mem.vms
+          stats["num_threads"] += p.num_threads()
+          stats["processes"] += 1
+      except psutil.Error:
+        continue
+    stats["processes"] = max(0, stats["processes"] - 1)
+    stats["cpu"] = self.cpuPercent(cpu)
+    return stats
+
+
+def monitoring_available():
+  return isdir(join(PROC, str(os.getpid()))) or psutil is not None
+
+
+def create_monitor(pid, cgroup=None):
+  if cgroup:
+    return CgroupMonitor(pid, cgroup)
+  if isdir(join(PROC, str(pid))):
+    return ProcMonitor(pid)
+  if psutil:
+    return PsutilMonitor(pid)
+  return None
+
+
+@lru_cache(maxsize=None)
+def delegated_cgroup():
+  """The cgroup v2 directory of this process, if we may create cgroups in it."""
+  try:
+    with open(join(PROC, "self", "cgroup")) as f:
+      path = [line[3:].strip() for line in f if line.startswith("0::")][0]
+  except (OSError, IndexError):
+    return None
+  for root in CGROUP_ROOTS:
+    base = root + path.rstrip("/")
+    if os.path.exists(join(root, "cgroup.controllers")) and \
+       os.access(base, os.W_OK) and os.access(join(base, "cgroup.procs"), os.W_OK):
+      return base
+  return None
+
+
+def create_build_cgroup():
+  """Create a cgroup for one build. Returns its path, or None if we cannot."""
+  base = delegated_cgroup()
+  if not base:
+    return None
+  path = join(base, "bits-%d-%d" % (os.getpid(), next(_cgroup_counter)))
+  try:
+    os.mkdir(path)
+  except OSError as e:
+    debug("Cannot create cgroup %s: %s", path, e)
+    return None
+  return path
+
+
+def remove_build_cgroup(path):
+  try:
+    os.rmdir(path)
+  except OSError as e:
+    # Most likely some process started by the build is still running.
+    debug("Cannot remove cgroup %s: %s", path, e)
+
+
+def changed(previous, stats):
+  return any(abs(stats.get(key, 0) - previous.get(key, 0)) > SAMPLE_CHANGE * max(previous.get(key, 0), floor)
+             for key, floor in SAMPLE_FLOORS.items())
+
+
+def next_interval(interval, previous, stats):
+  return SAMPLE_INTERVAL if changed(previous, stats) else min(2 * interval, MAX_SAMPLE_INTERVAL)
+
+
+class SampleWriter:
+  """Append samples to a JSON Lines file as they come.
+
+  Of consecutive similar samples only the first and the last ones are
+  written, the last one when the usage changes or the writer is closed.
+  Whatever is computed from the samples must weight each of them by the
+  time until the next one, see build_stats.summarise_samples().
+  """
+
+  def __init__(self, path) -> None:
+    self.file = open(path, "w", buffering=1)
+    self.written = None
+    self.pending = None
+
+  def _write(self, stats):
+    self.file.write(json.dumps(stats, sort_keys=True) + "\n")
+    self.written = stats
+
+  def write(self, stats):
+    if self.written is not None and not changed(self.written, stats):
+      self.pending = stats
+      return
+    if self.pending is not None:
+      self._write(self.pending)
+      self.pending = None
+    self._write(stats)
+
+  def close(self):
+    if self.pending is not None:
+      self._write(self.pending)
+      self.pending = None
+    self.file.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.close()
+
+
+def read_samples(path):
+  """Samples in the monitoring file path, as a list of dicts.
+
+  Both JSON Lines and the JSON lists written by older versions are read. A
+  line truncated by an interrupted build is ignored.
+  """
+  with open(path) as f:
+    content = f.read()
+  if content.lstrip().startswith("["):
+    return json.loads(content)
+  samples = []
+  for line in content.splitlines():
+    try:
+      samples.append(json.loads(line))
+    except ValueError:
+      continue
+  return samples
+
+
+def read_columns(path):
+  """Samples in the monitoring file path, as one array per quantity.
+
+  Arrays are numpy arrays if numpy is available, array.array otherwise.
+  Quantities missing from a sample are 0.
+  """
+  samples = read_samples(path)
+  keys = sorted(set(key for sample in samples for key in sample))
+  columns = {key: array("d", (sample.get(key, 0) for sample in samples)) for key in keys}
+  if numpy is not None:
+    columns = {key: numpy.frombuffer(column, dtype=float) for key, column in columns.items()}
+  return columns
+
+
+# If given, callback is called with each sample while the process runs, e.g.
+# to feed live usage back to the scheduler. Monitoring stops once done is set
+# or, without it, once the process has exited.
+def monitor_stats(p_id, stats_file_name, callback=None, done=None, cgroup=None):
+  stime = time()
+  monitor = create_monitor(p_id, cgroup)
+  interval = SAMPLE_INTERVAL
+  previous = {}
+  with SampleWriter(stats_file_name) as writer:
+    while monitor:
+      if done is not None:
+        if done.wait(interval):
+          break
+      else:
+        sleep(interval)
+        if not monitor.running():
+          break
+      stats = monitor.sample()
+      if not stats:
+        continue
+      interval = next_interval(interval, previous, stats)
+      previous = dict(stats)
+      stats["time"] = int(time() - stime)
+      writer.write(stats)
+      if callback:
+        callback(stats)
+    # The cgroup accounting outlives the processes, so that even builds
+    # shorter than a sample get one.
+    if monitor and cgroup:
+      stats = monitor.sample()
+      if stats:
+        stats["time"] = int(time() - stime)
+        writer.write(stats)
+
+
+def run_monitor_on_command(command, stats_file_name, printer, timeout=None, callback=None):
+  cgroup = create_build_cgroup()
+  if cgroup:
+    # The shell moves itself to the cgroup before starting anything.
+    command = "echo $$ > %s 2>/dev/null; %s" % (quote(join(cgroup, "cgroup.procs")), command)
   popen = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, close_fds= True)
-  mon_thd = Thread(target=monitor_stats, args=(popen.pid, stats_file_name,))
+  done = Event()
+  mon_thd = Thread(target=monitor_stats, args=(popen.pid, stats_file_name, callback),
+                   kwargs={"done": done, "cgroup": cgroup})
   mon_thd.start()
-  returncode = monitor_progress(popen, printer, timeout)
-  mon_thd.join() # wait for monitoring thread to write its output
+  try:
+    returncode = monitor_progress(popen, printer, timeout)
+  finally:
+    done.set()
+    mon_thd.join() # wait for monitoring thread to write its output
+    if cgroup:
+      remove_build_cgroup(cgroup)
   return returncode
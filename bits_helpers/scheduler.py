@@ -1,8 +1,11 @@
+import heapq
+import itertools
 import json
-from queue import Queue, PriorityQueue
+import time
+from collections import deque
+from queue import Queue, PriorityQueue, Empty
 from io import StringIO
 from threading import Thread
-from time import sleep
 import threading
 import traceback
 from bits_helpers.resource_manager import ResourceManager
@@ -12,91 +15,173 @@ from bits_helpers.resource_manager import ResourceManager
 class _SchedulerQuitCommand:
   pass
 
-def transition(what, fromList, toList):
-  try:
-    fromList.remove(what)
-  except ValueError as e:
-    print (what + " not in source list")
-    raise e
-  toList.append(what)
-
 class Scheduler:
-  # A simple job scheduler.
+  # A simple, event driven, job scheduler.
   # Workers queue is to specify to threads what to do. Results
-  # queue is whatched by the master thread to wait for results
-  # of workers computations.
+  # queue is watched by the master thread, which blocks on it until a worker
+  # reports something (a finished job, a log message, ...).
   # All worker threads begin trying to fetch from the command queue (and are
   # therefore blocked).
-  # Master thread does the scheduling and then sits waiting for results.
-  # Scheduling implies iterating on the list of jobs and creates an entry
-  # in the parallel queue for all the jobs which does not have any dependency
-  # which is not done.
-  # If a job has dependencies which did not build, move it do the failed queue.
-  # Post an appropriate build command for all the new jobs which got added.
-  # If there are jobs still to be done, post a reschedule job on the command queue
-  # if there are no jobs left, post the "kill worker" task.
+  # Every job keeps a counter of the dependencies which did not complete yet
+  # and every job knows which other jobs are waiting for it. When a job
+  # completes, only its dependents are visited: their counter is decremented
+  # and the ones which reach zero become ready. Parallel jobs which are ready
+  # are posted to the workers queue (subject to the build / download / fetch limits
+  # and to the resource manager), serial jobs which are ready are executed by
+  # the master thread itself.
+  # If a job has dependencies which did not build, it is moved to the broken
+  # jobs, together with everything which depends on it.
   # There is one, special, "final-job" which depends on all the scheduled jobs
-  # either parallel or serial. This job is guaranteed to be executed last and
-  # avoids having deadlocks due to all the queues having been disposed.
-  def __init__(self, parallelThreads, logDelegate=None, buildStats=None, parallelDownloads=2):
+  # either parallel or serial. This job is guaranteed to be executed last.
+  # Once no job is pending anymore, the "kill worker" task is posted to all
+  # the workers and the master waits for them to quit.
+  # With priority="critical-path" ready jobs are started by decreasing length
+  # of the longest chain of jobs which still has to run after them, weighted
+  # by the build times recorded in buildStats (or by one per build when no
+  # stats are available), so that long chains of dependencies start first.
+  def __init__(self, parallelThreads, logDelegate=None, buildStats=None, parallelDownloads=2, priority="default",
+               parallelFetches=2, jobs=None):
     self.workersQueue = PriorityQueue()
     self.resultsQueue = Queue()
-    self.notifyQueue = Queue()
     self.rescheduleParallel = False
     self.jobs = {}
-    self.pendingJobs = []
-    self.runningJobs = []
-    self.runningJobsCache = []
-    self.doneJobs = []
-    self.brokenJobs = []
-    self.parallelThreads = parallelThreads+parallelDownloads
+    # Job states. Done and broken jobs are kept in dictionaries (used as
+    # ordered sets) so that the completion order is preserved.
+    self.pendingJobs = set()
+    self.runningJobs = set()
+    self.doneJobs = {}
+    self.brokenJobs = {}
+    # Parallel jobs whose dependencies are all done, in the order in which
+    # they became ready, and serial jobs ready to be run by the master.
+    self.readyJobs = {}
+    self.serialQueue = deque()
+    # Reverse dependencies: for each job, the jobs waiting for it.
+    self.dependents = {}
+    self.parallelThreads = parallelThreads+parallelDownloads+parallelFetches
     self.logDelegate = logDelegate
     self.resourceManager = None
-    self.runningJobsCount = {"build": 0, "fetch": 0, "download": 0, "max_build": parallelThreads, "max_download": parallelDownloads}
+    self.runningJobsCount = {"build": 0, "fetch": 0, "download": 0, "max_build": parallelThreads,
+                             "max_download": parallelDownloads, "max_fetch": parallelFetches}
     self.errors = {}
+    self.quitting = False
+    # Compilation processes available to all the builds, and how many of them
+    # each running build was given.
+    self.maxJobs = jobs
+    self.assignedJobs = {}
+    # When simulating, the heap of (end time, sequence, taskId) of the running
+    # parallel jobs and the virtual clock.
+    self.simulation = None
+    self.simulationClock = 0
+    self.simulationSeq = itertools.count()
+    self.jobDuration = None
+    self.priority = priority
+    self.criticalPathChanged = False
     if buildStats:
-      with open(buildStats) as ref:
-        self.resourceManager = ResourceManager(json.load(ref), self)
+      if not isinstance(buildStats, dict):
+        with open(buildStats) as ref:
+          buildStats = json.load(ref)
+      self.resourceManager = ResourceManager(buildStats, self)
+      if priority == "critical-path":
+        # Keep the order computed by the scheduler rather than sorting by time.
+        self.resourceManager.priorityList = []
     # Add a final job, which will depend on any spawned task so that we do not
     # terminate until we are completely done.
     self.finalJobDeps = []
-    self.finalJobSpec = [self.doSerial, "final-job", self.finalJobDeps] + [self.__doLog, "Nothing else to be done, exiting."]
-    self.resultsQueue.put((threading.currentThread(), self.finalJobSpec))
-    self.jobs["final-job"] = {"scheduler": "serial", "deps": self.finalJobSpec, "spec": self.finalJobSpec}
-    self.pendingJobs.append("final-job")
+    self.__addJob("final-job", {"scheduler": "serial", "deps": self.finalJobDeps,
+                                "spec": [self.__doLog, "Nothing else to be done, exiting."]})
 
   def run(self):
-    all_threads = []
     for i in range(self.parallelThreads):
       t = Thread(target=self.__createWorker())
-      all_threads.append(t)
       t.daemon = True
       t.start()
 
-    self.__doRescheduleParallel()
+    self.rescheduleParallel = True
     # Wait until all the workers are done.
     while self.parallelThreads:
       try:
-        self.__doNotifications()
-        who, item = self.resultsQueue.get()
-        item[0](*item[1:])
-        sleep(0.1)
-        if not any([True for t in all_threads if t.is_alive()]):
-          break
+        self.__doSerialJobs()
+        if self.rescheduleParallel:
+          self.__doRescheduleParallel()
+        if not self.serialQueue:
+          self.__processEvents()
       except KeyboardInterrupt:
         print ("Ctrl-c received, waiting for workers to finish")
-        while self.workersQueue.full():
-          self.workersQueue.get(False)
-        self.shout(self.quit)
+        self.__drainWorkersQueue()
+        self.pendingJobs.clear()
+        self.readyJobs.clear()
+        self.serialQueue.clear()
+        self.__quit()
 
     # Prune the queue.
-    self.__doNotifications ()
-    while self.resultsQueue.full():
-      item = self.resultsQueue.get()
-      item[0](*item[1:])
-    self.__doNotifications ()
+    self.__processEvents(block=False)
     return
 
+  # Run the scheduled jobs on a virtual clock instead of executing them:
+  # parallel jobs last duration(taskId) seconds, serial jobs take no time.
+  # The scheduling decisions are the same as in run(). Returns the simulated
+  # time it took to complete all the jobs.
+  def simulate(self, duration):
+    self.simulation = []
+    self.simulationClock = 0
+    self.jobDuration = duration
+    for taskId in itertools.chain(self.readyJobs, self.serialQueue):
+      self.jobs[taskId]["readyAt"] = 0
+    self.rescheduleParallel = True
+    while True:
+      self.__doSerialJobs()
+      if self.rescheduleParallel:
+        self.__doRescheduleParallel()
+      self.__processEvents(block=False)
+      if self.serialQueue:
+        continue
+      if not self.simulation:
+        break
+      # Advance the clock to the end of the first running job, and complete
+      # all the ones ending at the same time.
+      self.simulationClock = self.simulation[0][0]
+      while self.simulation and self.simulation[0][0] == self.simulationClock:
+        self.__updateJobStatus(heapq.heappop(self.simulation)[2], None)
+    return self.simulationClock
+
+  # Live resource usage of a running job, as sampled by resource_monitor.
+  # Can be called from any thread.
+  def updateResourceUsage(self, taskId, sample):
+    if self.resourceManager:
+      self.notifyMaster(self.__updateResourceUsage, taskId, sample)
+
+  def __updateResourceUsage(self, taskId, sample):
+    self.resourceManager.updateUsage(taskId, sample)
+    self.rescheduleParallel = True
+
+  # The scheduled jobs and their dependencies, e.g. to replay them with
+  # simulate().
+  def graph(self):
+    return {taskId: {"taskType": job.get("taskType", job["scheduler"]), "deps": list(job["deps"])}
+            for taskId, job in self.jobs.items() if taskId != "final-job" and "scheduler" in job}
+
+  # Current time, virtual when simulating.
+  def now(self):
+    return self.simulationClock if self.simulation is not None else time.time()
+
+  # Wait for at least one event from the workers (unless block is False) and
+  # then process all the events which are already queued.
+  def __processEvents(self, block=True):
+    try:
+      who, item = self.resultsQueue.get(block)
+      while True:
+        item[0](*item[1:])
+        who, item = self.resultsQueue.get_nowait()
+    except Empty:
+      pass
+
+  def __drainWorkersQueue(self):
+    try:
+      while True:
+        self.workersQueue.get_nowait()
+    except Empty:
+      pass
+
   # Create a worker.
   def __createWorker(self):
     def worker():
@@ -104,7 +189,9 @@ class Scheduler:
         pri, taskId, item = self.workersQueue.get()
         try:
           result = item[0](*item[1:])
-        except Exception as e:
+        except (Exception, SystemExit) as e:
+          # Tasks may call dieOnError: report it as a failure of the task,
+          # rather than silently losing the worker.
           s = StringIO()
           traceback.print_exc(file=s)
           result = s.getvalue()
@@ -114,80 +201,182 @@ class Scheduler:
           return
         self.debug(taskId + ":" + str(item[0]) + " done")
         self.notifyMaster(self.__updateJobStatus, taskId, result)
-        if (taskId in self.jobs) and ("taskType" in self.jobs[taskId]):
-          taskType = self.jobs[taskId]["taskType"]
-          if self.resourceManager and taskType == "build":
-            self.notifyMaster(self.resourceManager.releaseResourcesForExternal, taskId)
-        self.notifyMaster(self.__rescheduleParallel)
     return worker
 
-  def __doNotifications(self):
-    self.rescheduleParallel = False
-    while self.notifyQueue.qsize():
-      who, item = self.notifyQueue.get()
-      item[0](*item[1:])
-    if self.rescheduleParallel:
-       self.__doRescheduleParallel()
-
   def __releaseWorker(self):
     self.parallelThreads -= 1
 
+  # Register a new job and hook it to its dependencies. Every job, but the
+  # final one, is also a dependency of the final job.
+  def __addJob(self, taskId, job):
+    job["pendingDeps"] = 0
+    job["brokenDeps"] = []
+    self.jobs[taskId] = job
+    self.criticalPathChanged = True
+    self.pendingJobs.add(taskId)
+    for dep in job["deps"]:
+      self.__addDependency(taskId, dep)
+    if taskId != "final-job":
+      self.finalJobDeps.append(taskId)
+      self.__addDependency("final-job", taskId)
+    self.__checkReady(taskId)
+
+  def __addDependency(self, taskId, dep):
+    if dep in self.doneJobs:
+      return
+    job = self.jobs[taskId]
+    if dep in self.brokenJobs:
+      job["brokenDeps"].append(dep)
+      return
+    # The dependency is pending, running or not even known yet.
+    job["pendingDeps"] += 1
+    self.dependents.setdefault(dep, []).append(taskId)
+
+  # Decide what to do with a pending job after one of its dependencies
+  # changed state.
+  def __checkReady(self, taskId):
+    job = self.jobs[taskId]
+    if taskId not in self.pendingJobs:
+      return
+    if job["scheduler"] == "parallel":
+      # Parallel jobs are broken as soon as any dependency is broken.
+      if job["brokenDeps"]:
+        self.__markBroken(taskId)
+      elif not job["pendingDeps"]:
+        job["readyAt"] = self.now()
+        self.readyJobs[taskId] = None
+        self.rescheduleParallel = True
+    elif not job["pendingDeps"]:
+      # Serial jobs wait for all their dependencies before deciding, so that
+      # the error reports all the dependencies which could not complete.
+      if job["brokenDeps"]:
+        self.__markBroken(taskId)
+      else:
+        job["readyAt"] = self.now()
+        self.serialQueue.append(taskId)
+
+  def __markBroken(self, taskId):
+    self.pendingJobs.discard(taskId)
+    self.readyJobs.pop(taskId, None)
+    self.errors[taskId] = "The following dependencies could not complete:\n%s" % \
+      "\n".join(self.jobs[taskId]["brokenDeps"])
+    self.__completed(taskId, self.brokenJobs)
+
+  # Record the final state of a job and release its dependents.
+  def __completed(self, taskId, stateJobs):
+    self.jobs[taskId]["endAt"] = self.now()
+    stateJobs[taskId] = None
+    broken = stateJobs is self.brokenJobs
+    for dependent in self.dependents.pop(taskId, ()):
+      job = self.jobs[dependent]
+      job["pendingDeps"] -= 1
+      if broken:
+        job["brokenDeps"].append(taskId)
+      self.__checkReady(dependent)
+    if not self.pendingJobs and not self.runningJobs:
+      self.__quit()
+
+  def __quit(self):
+    if self.quitting:
+      return
+    self.quitting = True
+    if self.simulation is None:
+      self.shout(self.quit)
+
   def parallel(self, taskId, deps, taskType, *spec):
     if taskId in self.jobs: return
-    self.jobs[taskId] = {"taskType": taskType, "scheduler": "parallel", "deps": deps, "spec":spec, "priorty": 1}
+    job = {"taskType": taskType, "scheduler": "parallel", "deps": deps, "spec":spec, "priorty": 1}
     if taskType in ["build", "download", "fetch"]:
       try:
-          self.jobs[taskId]["priorty"] = 100000-spec[1].requiredBy
+          job["priorty"] = 100000-spec[1].requiredBy
       except:
-          self.jobs[taskId]["priorty"] = 1
-    self.pendingJobs.append(taskId)
-    self.finalJobDeps.append(taskId)
+          job["priorty"] = 1
+    self.__addJob(taskId, job)
+
+  # Time it takes to run a job, as far as the critical path is concerned.
+  def __jobDuration(self, taskId):
+    job = self.jobs[taskId]
+    if "duration" not in job:
+      job["duration"] = 0
+      if job.get("taskType") == "build":
+        job["duration"] = 1
+        if self.resourceManager:
+          job["duration"] = self.resourceManager.getStats(taskId).get("time", 1)
+    return job["duration"]
+
+  # Set the priority of every pending job to minus the length of the longest
+  # path from the job to the end of the build. Only the dependents of pending
+  # jobs are known, hence the graph walked is exactly what is left to do.
+  def __updateCriticalPath(self):
+    self.criticalPathChanged = False
+    remaining = {}
+    seen = set()
+    for start in self.pendingJobs:
+      if start in seen:
+        continue
+      # Iterative post-order visit, stacks can be deep for large builds.
+      stack = [(start, False)]
+      while stack:
+        taskId, visited = stack.pop()
+        if taskId in remaining:
+          continue
+        dependents = [d for d in self.dependents.get(taskId, ()) if d in self.pendingJobs]
+        if not visited:
+          # Jobs seen but not completed are part of a cycle: skip them.
+          if taskId in seen:
+            continue
+          seen.add(taskId)
+          stack.append((taskId, True))
+          stack.extend((d, False) for d in dependents if d not in remaining)
+          continue
+        remaining[taskId] = self.__jobDuration(taskId) + \
+          max((remaining.get(d, 0) for d in dependents), default=0)
+    for taskId, length in remaining.items():
+      if self.jobs[taskId]["scheduler"] == "parallel":
+        self.jobs[taskId]["priorty"] = -length
 
   # Does the rescheduling of tasks. Derived class should call it.
   def __rescheduleParallel(self):
     self.rescheduleParallel = True
 
   def __doRescheduleParallel(self):
-    parallelJobs = [j for j in self.pendingJobs if self.jobs[j]["scheduler"] == "parallel"]
-    # First of all clean up the pending parallel jobs from all those
-    # which have broken dependencies.
-    for taskId in parallelJobs:
-      brokenDeps = [dep for dep in self.jobs[taskId]["deps"] if dep in self.brokenJobs]
-      if not brokenDeps:
-        continue
-      transition(taskId, self.pendingJobs, self.brokenJobs)
-      self.errors[taskId] = "The following dependencies could not complete:\n%s" % "\n".join(brokenDeps)
-
-    # If no tasks left, quit. Notice we need to check also for serial jobs
-    # since they might queue more parallel payloads.
-    if not self.pendingJobs:
-      self.shout(self.quit)
-      self.notifyTaskMaster(self.quit)
+    self.rescheduleParallel = False
+    # If there are jobs still pending, but nothing is running or can be run,
+    # they are waiting for jobs which were never scheduled (or for each
+    # other). Give up on them rather than waiting forever.
+    if self.pendingJobs and not (self.runningJobs or self.readyJobs or self.serialQueue):
+      for taskId in sorted(self.pendingJobs, key=lambda k: (k == "final-job", k)):
+        if taskId not in self.pendingJobs:
+          continue
+        job = self.jobs[taskId]
+        job["brokenDeps"] += [dep for dep in job["deps"]
+                              if dep not in self.doneJobs and dep not in self.brokenJobs]
+        self.__markBroken(taskId)
       return
 
-    # Otherwise do another round of scheduling of all the tasks. In this
-    # case we only queue parallel jobs to the parallel queue.
-    if self.runningJobsCache != self.runningJobs:
-      self.runningJobsCache = self.runningJobs[:]
+    if self.priority == "critical-path" and self.criticalPathChanged:
+      self.__updateCriticalPath()
 
-    allJobs =[]
-    for taskId in parallelJobs:
-      pendingDeps = [dep for dep in self.jobs[taskId]["deps"] if not dep in self.doneJobs]
-      if pendingDeps:
-        continue
-      allJobs.append({"id": taskId, "priorty": self.jobs[taskId]["priorty"]})
+    # Only the jobs whose dependencies are done are considered. Sorting is
+    # stable, so jobs with the same priority keep the order in which they
+    # became ready.
     buildJobs =[]
     downloadJobs = []
+    fetchJobs = []
     forceJobs = []
     bldCount = self.runningJobsCount["max_build"]-self.runningJobsCount["build"]
     dwnCount = self.runningJobsCount["max_download"]-self.runningJobsCount["download"]
-    for task in sorted(allJobs, key=lambda k: k['priorty']):
-      taskId = task["id"]
+    fchCount = self.runningJobsCount["max_fetch"]-self.runningJobsCount["fetch"]
+    for taskId in sorted(self.readyJobs, key=lambda k: self.jobs[k]["priorty"]):
       taskType = self.jobs[taskId]["taskType"]
       if taskType == "download":
         if dwnCount>0:
           downloadJobs.append(taskId)
           dwnCount -= 1
+      elif taskType == "fetch":
+        if fchCount>0:
+          fetchJobs.append(taskId)
+          fchCount -= 1
       elif taskType == "build":
         if bldCount>0: #include all build jobs so that we can match those which can be run
           buildJobs.append(taskId)
@@ -198,27 +387,91 @@ class Scheduler:
         buildJobs = self.resourceManager.allocResourcesForExternals(buildJobs, count=bldCount)
       else:
         buildJobs = buildJobs[:bldCount]
-    for taskId in forceJobs + downloadJobs + buildJobs:
+    startJobs = forceJobs + downloadJobs + fetchJobs + buildJobs
+    for taskId in startJobs:
       taskType = self.jobs[taskId]["taskType"]
       if taskType in self.runningJobsCount:
         self.runningJobsCount[taskType] += 1
-      transition(taskId, self.pendingJobs, self.runningJobs)
+      del self.readyJobs[taskId]
+      self.pendingJobs.discard(taskId)
+      self.runningJobs.add(taskId)
+      self.jobs[taskId]["startAt"] = self.now()
+    self.__assignBuildJobs(buildJobs)
+    for taskId in startJobs:
       self.__scheduleParallel(taskId, self.jobs[taskId]["spec"], priorty=self.jobs[taskId]["priorty"])
 
+  # Decide how many compilation processes each of the builds being started
+  # can use, so that all together they do not oversubscribe the machine.
+  # Builds get the CPU share they were admitted with by the resource manager
+  # (or an equal share of the build slots), and once nothing else is waiting
+  # to be built, the last builds also get whatever is left.
+  def __assignBuildJobs(self, buildJobs):
+    if not self.maxJobs or not buildJobs:
+      return
+    for taskId in buildJobs:
+      if self.resourceManager:
+        share = self.resourceManager.allocated[taskId]["cpu"] // 100
+      else:
+        share = self.maxJobs // self.runningJobsCount["max_build"]
+      self.assignedJobs[taskId] = min(self.maxJobs, max(1, int(share)))
+    if not any(self.jobs[t].get("taskType") == "build" for t in self.pendingJobs):
+      idle = max(0, self.maxJobs - sum(self.assignedJobs.values()))
+      for i, taskId in enumerate(buildJobs):
+        self.assignedJobs[taskId] += idle // len(buildJobs) + (1 if i < idle % len(buildJobs) else 0)
+    self.debug("Compilation jobs assigned: %s" % ", ".join(
+      "%s=%d" % (t, self.assignedJobs[t]) for t in buildJobs))
+
+  # Number of compilation processes a running build can use, or default if
+  # the scheduler does not know how many processes are available.
+  def buildJobs(self, taskId, default=None):
+    return self.assignedJobs.get(taskId, default)
+
+  # Run, on the master thread, all the serial jobs which are ready.
+  def __doSerialJobs(self):
+    while self.serialQueue:
+      taskId = self.serialQueue.popleft()
+      # A job might have got new dependencies since it was queued (e.g. the
+      # final job). It will be queued again once they are done.
+      if taskId not in self.pendingJobs or self.jobs[taskId]["pendingDeps"]:
+        continue
+      self.pendingJobs.discard(taskId)
+      self.runningJobs.add(taskId)
+      self.jobs[taskId]["startAt"] = self.now()
+      if self.simulation is not None:
+        self.__updateJobStatus(taskId, None)
+        continue
+      commandSpec = self.jobs[taskId]["spec"]
+      try:
+        result = commandSpec[0](*commandSpec[1:])
+      except Exception as e:
+        s = StringIO()
+        traceback.print_exc(file=s)
+        result = s.getvalue()
+      self.__updateJobStatus(taskId, result)
+
   # Update the job with the result of running.
   def __updateJobStatus(self, taskId, error):
     if "taskType" in self.jobs[taskId]:
       taskType = self.jobs[taskId]["taskType"]
       if taskType in self.runningJobsCount:
         self.runningJobsCount[taskType] -= 1
+      if self.resourceManager and taskType == "build":
+        self.resourceManager.releaseResourcesForExternal(taskId)
+      self.assignedJobs.pop(taskId, None)
+    self.runningJobs.discard(taskId)
+    self.rescheduleParallel = True
     if not error:
-      transition(taskId, self.runningJobs, self.doneJobs)
+      self.__completed(taskId, self.doneJobs)
       return
-    transition(taskId, self.runningJobs, self.brokenJobs)
     self.errors[taskId] = error
+    self.__completed(taskId, self.brokenJobs)
 
   # One task at the time.
   def __scheduleParallel(self, taskId, commandSpec, priorty=1):
+    if self.simulation is not None:
+      heapq.heappush(self.simulation, (self.simulationClock + self.jobDuration(taskId),
+                                       next(self.simulationSeq), taskId))
+      return
     self.workersQueue.put((priorty, taskId, commandSpec))
 
   # Helper to enqueue commands for all the threads.
@@ -228,55 +481,21 @@ class Scheduler:
 
   # Helper to enqueu replies to the master thread.
   def notifyTaskMaster(self, *commandSpec):
-    self.resultsQueue.put((threading.currentThread(), commandSpec))
+    self.resultsQueue.put((threading.current_thread(), commandSpec))
 
   def notifyMaster(self, *commandSpec):
-    self.notifyQueue.put((threading.currentThread(), commandSpec))
+    self.resultsQueue.put((threading.current_thread(), commandSpec))
 
   def forceDone(self, taskId):
     if taskId in self.doneJobs: return
-    if not taskId in self.jobs: self.jobs[taskId]={}
-    if not taskId in self.pendingJobs: self.pendingJobs.append(taskId)
-    transition(taskId, self.pendingJobs, self.doneJobs)
+    if not taskId in self.jobs: self.jobs[taskId]={"deps": []}
+    self.pendingJobs.discard(taskId)
+    self.readyJobs.pop(taskId, None)
+    self.__completed(taskId, self.doneJobs)
 
   def serial(self, taskId, deps, *commandSpec):
     if taskId in self.jobs: return
-    spec = [self.doSerial, taskId, deps] + list(commandSpec)
-    self.resultsQueue.put((threading.currentThread(), spec))
-    self.jobs[taskId] = {"scheduler": "serial", "deps": deps, "spec": spec}
-    self.pendingJobs.append(taskId)
-    self.finalJobDeps.append(taskId)
-
-  def doSerial(self, taskId, deps, *commandSpec):
-    pendingDeps = [dep for dep in deps if not dep in self.doneJobs]
-    brokenDeps = [dep for dep in deps if dep in self.brokenJobs]
-    if brokenDeps:
-      #put back if there are other pending tasks
-      if [dep for dep in pendingDeps if not dep in brokenDeps]:
-        self.resultsQueue.put((threading.currentThread(), [self.doSerial, taskId, deps] + list(commandSpec)))
-        return
-      transition(taskId, self.pendingJobs, self.brokenJobs)
-      self.errors[taskId] = "The following dependencies could not complete:\n%s" % "\n".join(brokenDeps)
-      # Remember to do the scheduling again!
-      self.notifyMaster(self.__rescheduleParallel)
-      return
-
-    # Put back the task on the queue, since it has pending dependencies.
-    if pendingDeps:
-      self.resultsQueue.put((threading.currentThread(), [self.doSerial, taskId, deps] + list(commandSpec)))
-      return
-    # No broken dependencies and no pending ones. Run the job.
-    if not (taskId in self.doneJobs):
-      transition(taskId, self.pendingJobs, self.runningJobs)
-      try:
-        result = commandSpec[0](*commandSpec[1:])
-      except Exception as e:
-        s = StringIO()
-        traceback.print_exc(file=s)
-        result = s.getvalue()
-      self.__updateJobStatus(taskId, result)
-    # Remember to do the scheduling again!
-    self.notifyMaster(self.__rescheduleParallel)
+    self.__addJob(taskId, {"scheduler": "serial", "deps": deps, "spec": list(commandSpec)})
 
   # Helper method to do logging:
   def log(self, s):
@@ -302,4 +521,3 @@ class Scheduler:
 
   def reschedule(self):
     self.notifyMaster(self.__rescheduleParallel)
-
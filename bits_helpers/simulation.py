@@ -0,0 +1,157 @@
+"""Replay build schedules on a virtual clock.
+
+The jobs of a build (either a synthetic graph, or the one written by
+`bits build --schedule-graph FILE`) are fed to the real Scheduler and
+ResourceManager, which are then run with Scheduler.simulate(): nothing is
+executed, each job simply lasts as long as the build stats say. This allows
+comparing scheduling policies and numbers of builders in seconds, e.g.:
+
+  python -m bits_helpers.simulation --synthetic 5000 --builders 4,8,16 \\
+    --priority default,critical-path
+"""
+import argparse
+import copy
+import json
+import random
+import time
+from bits_helpers.scheduler import Scheduler
+
+
+class _Quiet:
+  def info(self, *args):
+    pass
+
+  def debug(self, *args):
+    pass
+
+
+def synthetic_graph(count, maxDeps=5, seed=1):
+  """Random dependency graph of count builds, shaped like a software stack.
+
+  Packages mostly depend on recently defined ones, which gives a few long
+  chains and a lot of independent leaves, as in real stacks.
+  """
+  rnd = random.Random(seed)
+  names = []
+  graph = {}
+  for i in range(count):
+    name = "build:package%d" % i
+    window = names[-50:]
+    deps = rnd.sample(window, min(len(window), rnd.randint(0, maxDeps)))
+    if names and rnd.random() < 0.1:
+      deps.append(rnd.choice(names))
+    graph[name] = {"taskType": "build", "deps": sorted(set(deps))}
+    names.append(name)
+  return graph
+
+
+def synthetic_stats(graph, cores=64, seed=1):
+  """Build stats, in the format of --resources, for the packages in graph."""
+  rnd = random.Random(seed)
+  packages = {}
+  for taskId in graph:
+    packages[taskId.split(":", 1)[-1]] = {
+      "cpu": rnd.choice([100, 100, 200, 400, 800, 1600]),
+      "rss": rnd.choice([512, 1024, 2048, 8192]),
+      # Most packages build quickly, a few take a long time.
+      "time": int(rnd.lognormvariate(4, 1.2)) + 1,
+    }
+  return {
+    "defaults": {"cpu": [100, 400], "rss": [1024, 4096], "time": [60, 600]},
+    "resources": {"cpu": cores * 100, "rss": cores * 4096},
+    "packages": {"build": packages},
+    "known": [],
+  }
+
+
+def simulate(graph, stats=None, builders=1, priority="default", jobs=None, fetchJobs=2):
+  """Simulate the build of graph and return a report on how it went.
+
+  graph maps each job to its type ("build", "download", "fetch" or "serial")
+  and dependencies. A job takes the time given in its "time" entry, if any,
+  otherwise the time in stats for build jobs (one second without stats) and
+  no time at all for the others.
+  """
+  scheduler = Scheduler(builders, logDelegate=_Quiet(), buildStats=copy.deepcopy(stats),
+                        parallelDownloads=fetchJobs, parallelFetches=fetchJobs,
+                        priority=priority, jobs=jobs)
+  for taskId, job in graph.items():
+    if job["taskType"] == "serial":
+      scheduler.serial(taskId, job["deps"], None)
+    else:
+      scheduler.parallel(taskId, job["deps"], job["taskType"], None)
+
+  resourceManager = scheduler.resourceManager
+  def duration(taskId):
+    job = graph.get(taskId, {})
+    if "time" in job:
+      return job["time"]
+    if job.get("taskType") != "build":
+      return 0
+    return resourceManager.getStats(taskId)["time"] if resourceManager else 1
+
+  makespan = scheduler.simulate(duration)
+  builds = [(taskId, job) for taskId, job in scheduler.jobs.items()
+            if job.get("taskType") == "build" and "startAt" in job]
+  busy = sum(job["endAt"] - job["startAt"] for _, job in builds)
+  waits = [job["startAt"] - job["readyAt"] for _, job in builds]
+  report = {
+    "builders": builders,
+    "priority": priority,
+    "jobs": len(graph),
+    "broken": len(scheduler.brokenJobs) - ("final-job" in scheduler.brokenJobs),
+    "makespan": makespan,
+    "slotUtilisation": busy / (makespan * builders) if makespan else 0,
+    "coreUtilisation": None,
+    "meanQueueing": sum(waits) / len(waits) if waits else 0,
+    "maxQueueing": max(waits, default=0),
+  }
+  if resourceManager and makespan:
+    cores = resourceManager.machineResources["cpu"]
+    used = sum((job["endAt"] - job["startAt"]) * resourceManager.getStats(taskId)["cpu"]
+               for taskId, job in builds)
+    report["coreUtilisation"] = used / (makespan * cores)
+  return report
+
+
+def main():
+  parser = argparse.ArgumentParser(description="Simulate bits builds on a virtual clock.")
+  source = parser.add_mutually_exclusive_group(required=True)
+  source.add_argument("--graph", help="JSON file written by bits build --schedule-graph.")
+  source.add_argument("--synthetic", type=int, metavar="N", help="Use a random graph of N builds.")
+  parser.add_argument("--resources", help="JSON file with the build stats, as for bits build --resources.")
+  parser.add_argument("--cores", type=int, default=64,
+                      help="Cores of the simulated machine, for synthetic stats. Default: %(default)s.")
+  parser.add_argument("--builders", default="1,2,4,8",
+                      help="Comma separated numbers of builders to try. Default: %(default)s.")
+  parser.add_argument("--priority", default="default,critical-path",
+                      help="Comma separated scheduling priorities to try. Default: %(default)s.")
+  args = parser.parse_args()
+
+  if args.graph:
+    with open(args.graph) as ref:
+      graph = json.load(ref)
+  else:
+    graph = synthetic_graph(args.synthetic)
+  stats = None
+  if args.resources:
+    with open(args.resources) as ref:
+      stats = json.load(ref)
+  elif args.synthetic:
+    stats = synthetic_stats(graph, cores=args.cores)
+
+  print("%8s %-14s %10s %8s %8s %10s %10s %8s" % ("builders", "priority", "makespan", "slots",
+                                                  "cores", "mean wait", "max wait", "seconds"))
+  for priority in args.priority.split(","):
+    for builders in [int(x) for x in args.builders.split(",")]:
+      start = time.time()
+      report = simulate(graph, stats, builders=builders, priority=priority)
+      coreUtilisation = report["coreUtilisation"]
+      print("%8d %-14s %10d %7.1f%% %8s %10.1f %10d %8.2f" % (
+        builders, priority, report["makespan"], 100 * report["slotUtilisation"],
+        "%.1f%%" % (100 * coreUtilisation) if coreUtilisation is not None else "-",
+        report["meanQueueing"], report["maxQueueing"], time.time() - start))
+
+
+if __name__ == "__main__":
+  main()
@@ -4,35 +4,59 @@ import glob
 import os
 import os.path
 import re
+import shutil
 import sys
+import threading
 import time
 import requests
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import FIRST_EXCEPTION, ThreadPoolExecutor, as_completed, wait
+from requests.adapters import HTTPAdapter
 from requests.exceptions import RequestException
+from subprocess import Popen, PIPE
 from urllib.parse import quote
 
+from bits_helpers.archive import ARCHIVE_EXTENSION, DEFAULT_ARCHIVE_FORMAT, archive_format, \
+  extract_command, preferred_formats, sort_tarballs, stored_tarball
 from bits_helpers.cmd import execute
 from bits_helpers.log import debug, info, error, dieOnError, ProgressPrint
 from bits_helpers.utilities import resolve_store_path, resolve_links_path, symlink
 
+# Connections kept open to the HTTP remote store, at least as many as the
+# tarballs downloaded at the same time, times their segments.
+HTTP_POOL_SIZE = 16
+# Tarballs larger than this are downloaded as several byte ranges at the same
+# time, if the remote store supports range requests.
+HTTP_SEGMENT_THRESHOLD = 256 * 1024 * 1024
+HTTP_SEGMENTS = 4
+HTTP_CHUNK_SIZE = 32768
 
-def remote_from_url(read_url, write_url, architecture, work_dir, insecure=False):
-  """Parse remote store URLs and return the correct RemoteSync instance for them."""
+
+def remote_from_url(read_url, write_url, architecture, work_dir, insecure=False,
+                    archiveFormat=DEFAULT_ARCHIVE_FORMAT):
+  """Parse remote store URLs and return the correct RemoteSync instance for them.
+
+  archiveFormat is the format of the tarballs of the packages built and
+  uploaded, and the one preferred when the store has several.
+  """
   if read_url.startswith("http"):
-    return HttpRemoteSync(read_url, architecture, work_dir, insecure)
-  if read_url.startswith("s3://"):
-    return S3RemoteSync(read_url, write_url, architecture, work_dir)
-  if read_url.startswith("b3://"):
-    return Boto3RemoteSync(read_url, write_url, architecture, work_dir)
-  if read_url.startswith("cvmfs://"):
-    return CVMFSRemoteSync(read_url, None, architecture, work_dir)
-  if read_url:
-    return RsyncRemoteSync(read_url, write_url, architecture, work_dir)
-  return NoRemoteSync()
+    syncer = HttpRemoteSync(read_url, architecture, work_dir, insecure)
+  elif read_url.startswith("s3://"):
+    syncer = S3RemoteSync(read_url, write_url, architecture, work_dir)
+  elif read_url.startswith("b3://"):
+    syncer = Boto3RemoteSync(read_url, write_url, architecture, work_dir)
+  elif read_url.startswith("cvmfs://"):
+    syncer = CVMFSRemoteSync(read_url, None, architecture, work_dir)
+  elif read_url:
+    syncer = RsyncRemoteSync(read_url, write_url, architecture, work_dir)
+  else:
+    syncer = NoRemoteSync()
+  syncer.archiveFormat = archiveFormat
+  return syncer
 
 
 class NoRemoteSync:
   """Helper class which does not do anything to sync"""
+  archiveFormat = DEFAULT_ARCHIVE_FORMAT
   def fetch_symlinks(self, spec) -> None:
     pass
   def fetch_tarball(self, spec) -> None:
@@ -49,6 +73,8 @@ class PartialDownloadError(Exception):
 
 
 class HttpRemoteSync:
+  archiveFormat = DEFAULT_ARCHIVE_FORMAT
+
   def __init__(self, remoteStore, architecture, workdir, insecure) -> None:
     self.remoteStore = remoteStore
     self.writeStore = ""
@@ -58,6 +84,25 @@ class HttpRemoteSync:
     self.httpTimeoutSec = 15
     self.httpConnRetries = 4
     self.httpBackoff = 0.4
+    self.httpSegmentThreshold = HTTP_SEGMENT_THRESHOLD
+    self.httpSegments = HTTP_SEGMENTS
+    self._session = None
+    self._sessionLock = threading.Lock()
+
+  @property
+  def session(self):
+    """Keep-alive session shared by all the requests to the remote store.
+
+    Created on first use, with a connection pool large enough for the
+    downloads done at the same time by TarballPrefetch.
+    """
+    with self._sessionLock:
+      if self._session is None:
+        self._session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE)
+        self._session.mount("http://", adapter)
+        self._session.mount("https://", adapter)
+      return self._session
 
   def getRetry(self, url, dest=None, returnResult=False, log=True, session=None, progress=debug):
     get = session.get if session is not None else requests.get
@@ -79,15 +124,35 @@ class HttpRemoteSync:
         if dest or returnResult:
           # Destination specified -- file (dest) or buffer (returnResult).
           # Use requests in stream mode
-          resp = get(url, stream=True, verify=not self.insecure, timeout=self.httpTimeoutSec)
+          # After a failure, carry on from what was already downloaded.
+          offset = self.partialSize(dest) if dest and i > 0 else 0
+          resp = None
+          if offset:
+            resp = get(url, stream=True, headers={"Range": "bytes=%d-" % offset},
+                       verify=not self.insecure, timeout=self.httpTimeoutSec)
+            if resp.status_code == 206:
+              debug("GET %s: resuming from byte %d", url, offset)
+            else:  # the range was not honoured, start from scratch
+              resp.close()
+              resp, offset = None, 0
+          if resp is None:
+            resp = get(url, stream=True, verify=not self.insecure, timeout=self.httpTimeoutSec)
           size = int(resp.headers.get("content-length", "-1"))
-          downloaded = 0
+          if size != -1:
+            size += offset
+          if dest and not offset and size >= self.httpSegmentThreshold and \
+             resp.headers.get("accept-ranges") == "bytes":
+            resp.close()
+            self.getSegments(get, url, dest, size, progress if log else None)
+            os.rename(dest+".tmp", dest)
+            return True
+          downloaded = offset
           reportTime = time.time()
           result = []
 
           try:
-            destFp = open(dest+".tmp", "wb") if dest else None
-            for chunk in filter(bool, resp.iter_content(chunk_size=32768)):
+            destFp = open(dest+".tmp", "ab" if offset else "wb") if dest else None
+            for chunk in filter(bool, resp.iter_content(chunk_size=HTTP_CHUNK_SIZE)):
               if destFp:
                 destFp.write(chunk)
               if returnResult:
@@ -133,13 +198,108 @@ class HttpRemoteSync:
       except (RequestException,ValueError,PartialDownloadError) as e:
         if i == self.httpConnRetries-1:
           error("GET %s failed: %s", url, e)
-        if dest:
+        # Keep what we have to resume from it, unless we are giving up.
+        if dest and i == self.httpConnRetries-1:
           try:
             os.unlink(dest+".tmp")
           except Exception:
             pass
     return None
 
+  @staticmethod
+  def partialSize(dest):
+    try:
+      return os.path.getsize(dest+".tmp")
+    except OSError:
+      return 0
+
+  def getSegments(self, get, url, dest, size, progress=None):
+    """Download url into dest.tmp as httpSegments byte ranges at the same time.
+
+    Each range is retried from where it stopped. If one of them cannot be
+    completed, dest.tmp is removed and PartialDownloadError is raised.
+    """
+    tmp = dest + ".tmp"
+    with open(tmp, "wb") as destFp:
+      destFp.truncate(size)
+    step = -(-size // self.httpSegments)
+    lock = threading.Lock()
+    downloaded = [0]
+
+    def segment(start):
+      end = min(start + step, size)
+      position = start
+      for attempt in range(self.httpConnRetries):
+        if attempt > 0:
+          time.sleep(self.httpBackoff * (2 ** (attempt - 1)))
+        try:
+          resp = get(url, stream=True, headers={"Range": "bytes=%d-%d" % (position, end - 1)},
+                     verify=not self.insecure, timeout=self.httpTimeoutSec)
+          if resp.status_code != 206:
+            raise PartialDownloadError(position - start, end - start)
+          with open(tmp, "r+b") as destFp:
+            destFp.seek(position)
+            for chunk in filter(bool, resp.iter_content(chunk_size=HTTP_CHUNK_SIZE)):
+              chunk = chunk[:end - position]
+              destFp.write(chunk)
+              position += len(chunk)
+              with lock:
+                downloaded[0] += len(chunk)
+              if position == end:
+                return
+        except (RequestException, PartialDownloadError) as e:
+          debug("GET %s bytes %d-%d failed: %s", url, position, end - 1, e)
+      raise PartialDownloadError(position - start, end - start)
+
+    debug("GET %s: downloading %d bytes in %d segments", url, size, self.httpSegments)
+    with ThreadPoolExecutor(max_workers=self.httpSegments) as executor:
+      futures = [executor.submit(segment, start) for start in range(0, size, step)]
+      pending = futures
+      while pending:
+        finished, pending = wait(pending, timeout=1, return_when=FIRST_EXCEPTION)
+        if any(f.exception() for f in finished):
+          break
+        if progress and pending:
+          progress("[%.0f%%] downloaded...", 100 * downloaded[0] / size)
+      failed = [f.exception() for f in futures if f.done() and f.exception()]
+      if failed:
+        for f in futures:
+          f.cancel()
+    if failed:
+      os.unlink(tmp)
+      raise PartialDownloadError(downloaded[0], size)
+    if progress:
+      progress("[100%%] Download complete")
+
+  def find_tarball(self, spec, arch):
+    """Return the store path and name of the first remote tarball matching any hash of spec."""
+    debug("Updating remote store for package %s; trying hashes %s",
+          spec["package"], ", ".join(spec["remote_hashes"]))
+    store_path = None
+    for pkg_hash in spec["remote_hashes"]:
+      store_path = resolve_store_path(arch, pkg_hash)
+      tarballs = self.getRetry("{}/{}/".format(self.remoteStore, store_path),
+                               session=self.session)
+      tarballs = sort_tarballs((t["name"] for t in tarballs or ()), self.archiveFormat)
+      if tarballs:
+        return store_path, tarballs[0]
+    return store_path, None
+
+  def open_tarball(self, spec):
+    """Start downloading the remote tarball of spec, without storing it.
+
+    Returns its store path, its name and an iterator over its bytes, or None
+    if the remote store has no tarball for spec.
+    """
+    arch = spec["architecture"] if spec["architecture"] is not None else self.architecture
+    store_path, use_tarball = self.find_tarball(spec, arch)
+    if use_tarball is None:
+      return None
+    url = quote("/".join((self.remoteStore, store_path, use_tarball)), safe=":/")
+    resp = self.session.get(url, stream=True, verify=not self.insecure, timeout=self.httpTimeoutSec)
+    resp.raise_for_status()
+    return store_path, use_tarball, resp.iter_content(chunk_size=HTTP_CHUNK_SIZE)
+
   def fetch_tarball(self, spec) -> None:
     arch = spec["architecture"] if spec["architecture"] is not None else self.architecture
     # Check for any existing tarballs we can use instead of fetching new ones.
@@ -150,42 +310,38 @@ class HttpRemoteSync:
       except OSError:  # store path not readable
         continue
       for tarball in have_tarballs:
-        if re.match(r"^{package}-{version}-[0-9]+\.{arch}\.tar\.gz$".format(
+        if re.match(r"^{package}-{version}-[0-9]+\.{arch}{extension}$".format(
             package=re.escape(spec["package"]),
             version=re.escape(spec["version"]),
             arch=re.escape(arch),
+            extension=ARCHIVE_EXTENSION,
         ), os.path.basename(tarball)):
           debug("Previously downloaded tarball for %s with hash %s, reusing",
                 spec["package"], pkg_hash)
           return
 
-    with requests.Session() as session:
-      debug("Updating remote store for package %s; trying hashes %s",
-            spec["package"], ", ".join(spec["remote_hashes"]))
-      store_path = use_tarball = None
-      # Find the first tarball that matches any possible hash and fetch it.
-      for pkg_hash in spec["remote_hashes"]:
-        store_path = resolve_store_path(arch, pkg_hash)
-        tarballs = self.getRetry("{}/{}/".format(self.remoteStore, store_path),
-                                 session=session)
-        if tarballs:
-          use_tarball = tarballs[0]["name"]
-          break
-
-      if store_path is None or use_tarball is None:
-        debug("Nothing fetched for %s (%s)", spec["package"],
-              ", ".join(spec["remote_hashes"]))
-        return
+    session = self.session
+    store_path, use_tarball = self.find_tarball(spec, arch)
+    if store_path is None or use_tarball is None:
+      debug("Nothing fetched for %s (%s)", spec["package"],
+            ", ".join(spec["remote_hashes"]))
+      return
 
-      os.makedirs(os.path.join(self.workdir, store_path), exist_ok=True)
+    os.makedirs(os.path.join(self.workdir, store_path), exist_ok=True)
 
-      destPath = os.path.join(self.workdir, store_path, use_tarball)
-      if not os.path.isfile(destPath):   # do not download twice
+    destPath = os.path.join(self.workdir, store_path, use_tarball)
+    if not os.path.isfile(destPath):   # do not download twice
+      if threading.current_thread() is threading.main_thread():
         progress = ProgressPrint("Downloading tarball for %s@%s" %
                                  (spec["package"], spec["version"]), min_interval=5.0)
         progress("[0%%] Starting download of %s", use_tarball)  # initialise progress bar
-        self.getRetry("/".join((self.remoteStore, store_path, use_tarball)),
-                      destPath, session=session, progress=progress)
+      else:
+        # Progress bars of concurrent downloads would overwrite each other.
+        info("Downloading tarball for %s@%s", spec["package"], spec["version"])
+        progress = debug
+      self.getRetry("/".join((self.remoteStore, store_path, use_tarball)),
+                    destPath, session=session, progress=progress)
+      if progress is not debug:
         progress.end("done")
 
   def fetch_symlinks(self, spec) -> None:
@@ -202,37 +358,37 @@ class HttpRemoteSync:
       debug("Found symlink for %s@%s, not updating", spec["package"], spec["version"])
       return
 
-    with requests.Session() as session:
-      # Fetch manifest file with initial symlinks. This file is updated
-      # regularly; we use it to avoid many small network requests.
-      manifest = self.getRetry("{}/{}.manifest".format(self.remoteStore, links_path),
-                               returnResult=True, session=session)
-      symlinks = {
-        linkname.decode("utf-8"): target.decode("utf-8")
-        for linkname, sep, target in (line.partition(b"\t")
-                                      for line in manifest.splitlines())
-        if sep and linkname and target
-      }
-      # Now add any remaining symlinks that aren't in the manifest yet. There
-      # should always be relatively few of these, as the separate network
-      # requests are a bit expensive.
-      for link in self.getRetry("{}/{}/".format(self.remoteStore, links_path),
-                                session=session):
-        linkname = link["name"]
-        if linkname in symlinks:
-          # This symlink is already present in the manifest.
-          continue
-        if os.path.islink(os.path.join(self.workdir, links_path, linkname)):
-          # We have this symlink locally. With local revisions, we won't produce
-          # revisions that will conflict with remote revisions unless we upload
-          # them anyway, so there's no need to redownload.
-          continue
-        # This symlink isn't in the manifest yet, and we don't have it locally,
-        # so download it individually.
-        symlinks[linkname] = \
-            self.getRetry("/".join((self.remoteStore, links_path, linkname)),
-                          returnResult=True, log=False, session=session) \
-                .decode("utf-8").rstrip("\r\n")
+    session = self.session
+    # Fetch manifest file with initial symlinks. This file is updated
+    # regularly; we use it to avoid many small network requests.
+    manifest = self.getRetry("{}/{}.manifest".format(self.remoteStore, links_path),
+                             returnResult=True, session=session)
+    symlinks = {
+      linkname.decode("utf-8"): target.decode("utf-8")
+      for linkname, sep, target in (line.partition(b"\t")
+                                    for line in manifest.splitlines())
+      if sep and linkname and target
+    }
+    # Now add any remaining symlinks that aren't in the manifest yet. There
+    # should always be relatively few of these, as the separate network
+    # requests are a bit expensive.
+    for link in self.getRetry("{}/{}/".format(self.remoteStore, links_path),
+                              session=session):
+      linkname = link["name"]
+      if linkname in symlinks:
+        # This symlink is already present in the manifest.
+        continue
+      if os.path.islink(os.path.join(self.workdir, links_path, linkname)):
+        # We have this symlink locally. With local revisions, we won't produce
+        # revisions that will conflict with remote revisions unless we upload
+        # them anyway, so there's no need to redownload.
+        continue
+      # This symlink isn't in the manifest yet, and we don't have it locally,
+      # so download it individually.
+      symlinks[linkname] = \
+          self.getRetry("/".join((self.remoteStore, links_path, linkname)),
+                        returnResult=True, log=False, session=session) \
+              .decode("utf-8").rstrip("\r\n")
     for linkname, target in symlinks.items():
       symlink("../../" + target.lstrip("./"),
               os.path.join(self.workdir, links_path, linkname))
@@ -243,6 +399,7 @@ class HttpRemoteSync:
 
 class RsyncRemoteSync:
   """Helper class to sync package build directory using RSync."""
+  archiveFormat = DEFAULT_ARCHIVE_FORMAT
 
   def __init__(self, remoteStore, writeStore, architecture, workdir) -> None:
     self.remoteStore = re.sub("^ssh://", "", remoteStore)
@@ -257,22 +414,26 @@ class RsyncRemoteSync:
           ", ".join(spec["remote_hashes"]))
     err = execute("""\
     for storePath in {storePaths}; do
-      # Only get the first matching tarball. If there are multiple with the
-      # same hash, we only need one and they should be interchangeable.
-      if tars=$(rsync -s --list-only "{remoteStore}/$storePath/{pkg}-{ver}-*.{arch}.tar.gz" 2>/dev/null) &&
-         # Strip away the metadata in rsync's file listing, leaving only the first filename.
-         tar=$(echo "$tars" | sed -rn '1s#[- a-z0-9,/]* [0-9]{{2}}:[0-9]{{2}}:[0-9]{{2}} ##p') &&
-         mkdir -p "{workDir}/$storePath" &&
-         # If we already have a file with the same name, assume it's up to date
-         # with the remote. In reality, we'll have unpacked, relocated and
-         # repacked the tarball from the remote, so the file differs, but
-         # there's no point in downloading the one from the remote again.
-         rsync -vW --ignore-existing "{remoteStore}/$storePath/$tar" "{workDir}/$storePath/"
-      then
-        break
-      fi
+      # Only get the first matching tarball, in the preferred format. If there
+      # are multiple with the same hash, we only need one and they should be
+      # interchangeable.
+      for format in {formats}; do
+        if tars=$(rsync -s --list-only "{remoteStore}/$storePath/{pkg}-{ver}-*.{arch}.$format" 2>/dev/null) &&
+           # Strip away the metadata in rsync's file listing, leaving only the first filename.
+           tar=$(echo "$tars" | sed -rn '1s#[- a-z0-9,/]* [0-9]{{2}}:[0-9]{{2}}:[0-9]{{2}} ##p') &&
+           mkdir -p "{workDir}/$storePath" &&
+           # If we already have a file with the same name, assume it's up to date
+           # with the remote. In reality, we'll have unpacked, relocated and
+           # repacked the tarball from the remote, so the file differs, but
+           # there's no point in downloading the one from the remote again.
+           rsync -vW --ignore-existing "{remoteStore}/$storePath/$tar" "{workDir}/$storePath/"
+        then
+          break 2
+        fi
+      done
     done
     """.format(pkg=spec["package"], ver=spec["version"], arch=arch,
+               formats=" ".join(preferred_formats(self.archiveFormat)),
                remoteStore=self.remoteStore,
                workDir=self.workdir,
                storePaths=" ".join(resolve_store_path(arch, pkg_hash)
@@ -297,7 +458,7 @@ class RsyncRemoteSync:
     dieOnError(execute("""\
     set -e
     cd {workdir}
-    tarball={package}-{version}-{revision}.{arch}.tar.gz
+    tarball={tarball}
     rsync -avR --ignore-existing "{links_path}/$tarball" {remote}/
     for link_dir in dist dist-direct dist-runtime; do
       rsync -avR --ignore-existing "TARS/{arch}/$link_dir/{package}/{package}-{version}-{revision}/" {remote}/
@@ -308,6 +469,7 @@ class RsyncRemoteSync:
       remote=self.remoteStore,
       store_path=resolve_store_path(arch, spec["hash"]),
       links_path=resolve_links_path(arch, spec["package"]),
+      tarball=stored_tarball(self.workdir, spec, self.archiveFormat, arch),
       arch=arch,
       package=spec["package"],
       version=spec["version"],
@@ -320,6 +482,7 @@ class CVMFSRemoteSync:
       symlink to the remote store in it, so that unpacking really
       means unpacking the symlink to the wanted package.
   """
+  archiveFormat = DEFAULT_ARCHIVE_FORMAT
 
   def __init__(self, remoteStore, writeStore, architecture, workdir) -> None:
     self.remoteStore = re.sub("^cvmfs://", "", remoteStore)
@@ -336,8 +499,8 @@ class CVMFSRemoteSync:
     # If we already have a tarball with any equivalent hash, don't check S3.
     for pkg_hash in spec["remote_hashes"] + spec["local_hashes"]:
       store_path = resolve_store_path(arch, pkg_hash)
-      pattern = os.path.join(self.workdir, store_path, "%s-*.tar.gz" % spec["package"])
-      if glob.glob(pattern):
+      pattern = os.path.join(self.workdir, store_path, "%s-*.tar.*" % spec["package"])
+      if sort_tarballs(glob.glob(pattern)):
         info("Reusing existing tarball for %s@%s", spec["package"], pkg_hash)
         return
     info("Could not find prebuilt tarball for %s@%s-%s, will be rebuilt",
@@ -391,6 +554,7 @@ class S3RemoteSync:
 
   s3cmd must be installed separately in order for this to work.
   """
+  archiveFormat = DEFAULT_ARCHIVE_FORMAT
 
   def __init__(self, remoteStore, writeStore, architecture, workdir) -> None:
     self.remoteStore = re.sub("^s3://", "", remoteStore)
@@ -454,7 +618,7 @@ class S3RemoteSync:
     put () {{
       s3cmd put -s -v --host s3.cern.ch --host-bucket {bucket}.s3.cern.ch "$@" 2>&1
     }}
-    tarball={package}-{version}-{revision}.{arch}.tar.gz
+    tarball={tarball}
     cd {workdir}
 
     # First, upload "main" symlink, to reserve this revision number, in case
@@ -481,6 +645,7 @@ https://s3.cern.ch/swift/v1/{bucket}/$hashedurl" \\
       bucket=self.remoteStore,
       store_path=resolve_store_path(arch, spec["hash"]),
       links_path=resolve_links_path(arch, spec["package"]),
+      tarball=stored_tarball(self.workdir, spec, self.archiveFormat, arch),
       arch=arch,
       package=spec["package"],
       version=spec["version"],
@@ -499,6 +664,7 @@ class Boto3RemoteSync:
   connection to S3 every time, while s3cmd must establish a new connection each
   time.
   """
+  archiveFormat = DEFAULT_ARCHIVE_FORMAT
 
   def __init__(self, remoteStore, writeStore, architecture, workdir) -> None:
     self.remoteStore = re.sub("^b3://", "", remoteStore)
@@ -563,7 +729,7 @@ class Boto3RemoteSync:
     # If we already have a tarball with any equivalent hash, don't check S3.
     for pkg_hash in spec["remote_hashes"]:
       store_path = resolve_store_path(arch, pkg_hash)
-      if glob.glob(os.path.join(self.workdir, store_path, "%s-*.tar.gz" % spec["package"])):
+      if sort_tarballs(glob.glob(os.path.join(self.workdir, store_path, "%s-*.tar.*" % spec["package"]))):
         debug("Reusing existing tarball for %s@%s", spec["package"], pkg_hash)
         return
 
@@ -574,7 +740,7 @@ class Boto3RemoteSync:
       # the first existing one from the remote, if possible. (Downloading more
       # than one is a waste of time as they should be equivalent and we only
       # ever use one anyway.)
-      for tarball in self._s3_listdir(store_path):
+      for tarball in sort_tarballs(self._s3_listdir(store_path), self.archiveFormat):
         debug("Fetching tarball %s", tarball)
         progress = ProgressPrint("Downloading tarball for %s@%s" %
                                  (spec["package"], spec["version"]), min_interval=5.0)
@@ -594,6 +760,20 @@ class Boto3RemoteSync:
     debug("Remote has no tarballs for %s with hashes %s", spec["package"],
           ", ".join(spec["remote_hashes"]))
 
+  def open_tarball(self, spec):
+    """Start downloading the remote tarball of spec, without storing it.
+
+    Returns its store path, its name and an iterator over its bytes, or None
+    if the remote store has no tarball for spec.
+    """
+    arch = spec["architecture"] if spec["architecture"] is not None else self.architecture
+    for pkg_hash in spec["remote_hashes"]:
+      store_path = resolve_store_path(arch, pkg_hash)
+      for tarball in sort_tarballs(self._s3_listdir(store_path), self.archiveFormat):
+        body = self.s3.get_object(Bucket=self.remoteStore, Key=tarball)["Body"]
+        return store_path, os.path.basename(tarball), body.iter_chunks(chunk_size=HTTP_CHUNK_SIZE)
+    return None
+
   def fetch_symlinks(self, spec) -> None:
     arch = spec["architecture"] if spec["architecture"] is not None else self.architecture
     from botocore.exceptions import ClientError
@@ -680,8 +860,7 @@ class Boto3RemoteSync:
 
       dist_symlinks[link_dir] = symlinks
 
-    tarball = "{package}-{version}-{revision}.{architecture}.tar.gz" \
-      .format(**spec)
+    tarball = stored_tarball(self.workdir, spec, self.archiveFormat, arch)
     tar_path = os.path.join(resolve_store_path(arch, spec["hash"]),
                             tarball)
     link_path = os.path.join(resolve_links_path(arch, spec["package"]),
@@ -705,8 +884,7 @@ class Boto3RemoteSync:
       os.readlink(os.path.join(self.workdir, link_path))
     except FileNotFoundError:
       os.symlink(
-        os.path.join('../..', arch, 'store', spec["hash"][:2], spec["hash"],
-                     f"{spec['package']}-{spec['version']}-{spec['revision']}.{arch}.tar.gz"),
+        os.path.join('../..', arch, 'store', spec["hash"][:2], spec["hash"], tarball),
         os.path.join(self.workdir, link_path)
       )
 
@@ -758,3 +936,93 @@ class Boto3RemoteSync:
 
     self.s3.upload_file(Bucket=self.writeStore, Key=tar_path,
                         Filename=os.path.join(self.workdir, tar_path))
+
+
+class TarballPrefetch:
+  """Download the tarballs of many packages at the same time.
+
+  Once the build is planned, start() asks the sync backend for the tarball
+  of each package which may have one in the remote store, at most jobs at a
+  time and in build order. The build step of a package waits for its
+  download with wait() instead of fetching the tarball itself.
+  """
+  def __init__(self, syncHelper, jobs) -> None:
+    self.syncHelper = syncHelper
+    self.executor = ThreadPoolExecutor(max_workers=max(1, jobs), thread_name_prefix="prefetch")
+    self.futures = {}
+
+  def start(self, specs):
+    for spec in specs:
+      debug("Prefetching tarball for %s@%s", spec["package"], spec["version"])
+      self.futures[spec["package"]] = self.executor.submit(self.syncHelper.fetch_tarball, spec)
+    return self
+
+  def wait(self, spec):
+    """Wait until the tarball of spec is downloaded, fetching it if it was not prefetched.
+
+    Errors of the download are raised here, as they would be by fetch_tarball.
+    """
+    future = self.futures.pop(spec["package"], None)
+    if future is None:
+      self.syncHelper.fetch_tarball(spec)
+    else:
+      future.result()
+
+  def stop(self):
+    """Cancel the downloads which have not started, without waiting for the others."""
+    for future in self.futures.values():
+      future.cancel()
+    self.executor.shutdown(wait=False)
+
+
+def stream_install(syncHelper, spec, workdir, package_path, keep=False):
+  """Extract the remote tarball of spec into workdir while it is downloaded.
+
+  The tarball is unpacked next to its final place, then package_path (the
+  path of the package in it, relative to workdir) is moved there. The
+  compressed tarball is only written to the store if keep is true. Returns
+  the path of the tarball in the store, or None if nothing was installed, in
+  which case the tarball can still be downloaded with fetch_tarball.
+  """
+  tmp_dir = os.path.join(workdir, "TMP", spec["hash"])
+  shutil.rmtree(tmp_dir, ignore_errors=True)
+  kept = None
+  try:
+    opened = syncHelper.open_tarball(spec)
+    if opened is None:
+      return None
+    store_path, tarball, chunks = opened
+    tarball_path = os.path.join(workdir, store_path, tarball)
+    info("Downloading and unpacking %s@%s", spec["package"], spec["version"])
+    os.makedirs(tmp_dir)
+    if keep:
+      os.makedirs(os.path.dirname(tarball_path), exist_ok=True)
+      kept = open(tarball_path + ".tmp", "wb")
+    tar = Popen(extract_command(archive_format(tarball) or DEFAULT_ARCHIVE_FORMAT, "-", tmp_dir),
+                stdin=PIPE)
+    try:
+      for chunk in filter(bool, chunks):
+        tar.stdin.write(chunk)
+        if kept:
+          kept.write(chunk)
+    finally:
+      tar.stdin.close()
+      err = tar.wait()
+    if err:
+      raise OSError("tar exited with code %d" % err)
+    install_dir = os.path.join(workdir, package_path)
+    shutil.rmtree(install_dir, ignore_errors=True)
+    os.makedirs(os.path.dirname(install_dir), exist_ok=True)
+    os.rename(os.path.join(tmp_dir, package_path), install_dir)
+    if kept:
+      kept.close()
+      os.rename(kept.name, tarball_path)
+    return tarball_path
+  except Exception as e:  # e.g. network, S3 or tar errors
+    debug("Cannot unpack %s@%s while downloading it: %s", spec["package"], spec["version"], e)
+    if kept:
+      kept.close()
+      os.unlink(kept.name)
+    return None
+  finally:
+    shutil.rmtree(tmp_dir, ignore_errors=True)
@@ -0,0 +1,101 @@
+"""On disk cache of the results of system checks.
+
+prefer_system_check and system_requirement_check snippets are shell scripts
+looking at the system, and running all of them takes a while.
+Their results are kept for SYSTEM_CHECK_TTL seconds, or SYSTEM_CHECK_FAILURE_TTL
+for failed checks (e.g. Docker not up yet, a slow mount), keyed by the script
+(which includes the REQUESTED_VERSION of prefer_system_check) and by a
+fingerprint of what they look at: the Docker image they run in, or PATH and
+the modification times of the directories in it and of the package
+databases of the host. Anything installing or removing a package changes the
+fingerprint, and the checks run again.
+
+track_env snippets must not go through this cache: they capture environment
+variables, which are not part of the fingerprint.
+"""
+import hashlib
+import json
+import os
+import time
+from os.path import join
+from bits_helpers.cmd import getstatusoutput
+from bits_helpers.disk_cache import DiskCache
+from bits_helpers.log import debug
+
+SYSTEM_CHECKS_VERSION = 1
+SYSTEM_CHECK_TTL = 24 * 3600
+SYSTEM_CHECK_FAILURE_TTL = 5 * 60
+# Changed when packages are installed or removed.
+PACKAGE_DATABASES = ("/var/lib/rpm", "/var/lib/dpkg/status", "/var/lib/pacman/local",
+                     "/var/lib/apk/db/installed", "/usr/local/Cellar", "/opt/homebrew/Cellar",
+                     "/usr/include", "/usr/lib", "/usr/lib64")
+
+
+def system_checks_path(workDir, architecture):
+  return join(workDir, "SPECS", architecture, "system-checks.json")
+
+
+def system_fingerprint(dockerImage=None, extra=None):
+  """What the results of system checks depend on, other than the checks.
+
+  extra is anything else which changes how checks run, like the environment
+  given to them. None if the Docker image cannot be inspected.
+  """
+  fingerprint = {"extra": extra}
+  if dockerImage:
+    err, out = getstatusoutput(["docker", "image", "inspect", "--format", "{{.Id}}", dockerImage])
+    if err:
+      debug("Cannot inspect Docker image %s, not caching system checks: %s", dockerImage, out)
+      return None
+    fingerprint["image"] = out.strip()
+    return fingerprint
+  path = os.environ.get("PATH", "")
+  fingerprint["PATH"] = path
+  mtimes = fingerprint["mtimes"] = []
+  for d in path.split(os.pathsep) + list(PACKAGE_DATABASES):
+    try:
+      mtimes.append([d, os.stat(d).st_mtime_ns])
+    except OSError:
+      pass
+  return fingerprint
+
+
+class SystemCheckCache(DiskCache):
+  def __init__(self, path, fingerprint, refresh=False, ttl=SYSTEM_CHECK_TTL,
+               failureTtl=SYSTEM_CHECK_FAILURE_TTL) -> None:
+    super().__init__(path, SYSTEM_CHECKS_VERSION)
+    self.fingerprint = fingerprint and json.dumps(fingerprint, sort_keys=True)
+    self.refresh = refresh
+    self.ttl = ttl
+    self.failureTtl = failureTtl
+    self.hits = self.misses = 0
+
+  def _key(self, cmd):
+    return hashlib.sha1(json.dumps([self.fingerprint, cmd]).encode("utf-8")).hexdigest()
+
+  def _valid(self, entry, now):
+    """Whether entry is recent enough. Failures may be transient, they expire sooner."""
+    return now - entry["time"] < (self.ttl if entry["result"][0] == 0 else self.failureTtl)
+
+  def wrap(self, run):
+    """Cached version of run(cmd, **kwargs), a function returning (err, output)."""
+    def cached(cmd, **kwargs):
+      if self.fingerprint is None:
+        return run(cmd, **kwargs)
+      key = self._key(cmd)
+      entry = self.peek(key)
+      if not self.refresh and entry and self._valid(entry, time.time()):
+        with self.lock:
+          self.hits += 1
+        return tuple(entry["result"])
+      result = run(cmd, **kwargs)
+      with self.lock:
+        self.misses += 1
+      self.put(key, {"time": time.time(), "result": list(result)})
+      return result
+    return cached
+
+  def save(self):
+    debug("%d system checks run, %d results reused", self.misses, self.hits)
+    now = time.time()
+    super().save(keep=lambda entry: self._valid(entry, now))
@@ -13,16 +13,27 @@ import sys
 import os
 import re
 import platform
+import concurrent.futures
+import copy
 
 from datetime import datetime
-from collections import OrderedDict
+from collections import OrderedDict, deque
+from functools import lru_cache
 from shlex import quote
 
 from bits_helpers.cmd import getoutput
 from bits_helpers.git import git
+from bits_helpers.hash_cache import file_signature
+from bits_helpers.matchers import RegexList, compiled
 
 from bits_helpers.log import error, warning, dieOnError, debug, banner
 
+# How many recipes getPackageList reads and parses at the same time.
+RECIPE_READERS = 8
+# How many prefer_system_check, system_requirement_check and track_env
+# snippets getPackageList runs at the same time.
+SYSTEM_CHECKS = 8
+
 class SpecError(Exception):
   pass
 
@@ -55,20 +66,31 @@ def topological_sort(specs):
 
   This function returns a generator, yielding package names in order.
 
-  The algorithm used here was adapted from:
-  http://www.stoimen.com/blog/2012/10/01/computer-algorithms-topological-sort-of-a-graph/
+  This is Kahn's algorithm: each package counts how many of its dependencies
+  are still to come, and is ready when none are left. Packages which become
+  ready at the same time come in the order of specs.
   """
-  edges = [(spec["package"], dep) for spec in specs.values() for dep in spec["requires"]]
-  leaves = [spec["package"] for spec in specs.values() if not spec["requires"]]
+  dependents = {}
+  waiting = {}
+  for spec in specs.values():
+    requires = set(spec["requires"])
+    waiting[spec["package"]] = len(requires)
+    for dep in requires:
+      dependents.setdefault(dep, []).append(spec["package"])
+  done = set()
+  leaves = deque(spec["package"] for spec in specs.values() if not spec["requires"])
   while leaves:
-    current_package = leaves.pop(0)
+    current_package = leaves.popleft()
+    done.add(current_package)
     yield current_package
-    # Find every package that depends on the current one.
-    new_leaves = {pkg for pkg, dep in edges if dep == current_package}
-    # Stop blocking packages that depend on the current one...
-    edges = [(pkg, dep) for pkg, dep in edges if dep != current_package]
-    # ...but keep blocking those that still depend on other stuff!
-    leaves.extend(new_leaves - {pkg for pkg, _ in edges})
+    # Stop blocking packages that depend on the current one, but keep
+    # blocking those that still depend on other stuff!
+    for pkg in dependents.pop(current_package, ()):
+      waiting[pkg] -= 1
+      if not waiting[pkg]:
+        leaves.append(pkg)
+  edges = [(spec["package"], dep) for spec in specs.values()
+           for dep in spec["requires"] if dep not in done]
   # If we have any edges left, we have a cycle
   if edges:
     # Find a cycle by following dependencies
@@ -92,6 +114,23 @@ def topological_sort(specs):
     assert False, "Unreachable error: cycle detection failed"
 
 
+def topological_levels(specs):
+  """Group the packages of specs in levels which can be built in parallel.
+
+  Each level is the list of the packages whose dependencies are all in
+  earlier levels, in the order of topological_sort.
+  """
+  requires = {spec["package"]: spec["requires"] for spec in specs.values()}
+  levels = []
+  level = {}
+  for package in topological_sort(specs):
+    level[package] = max((level[dep] + 1 for dep in requires[package]), default=0)
+    if level[package] == len(levels):
+      levels.append([])
+    levels[level[package]].append(package)
+  return levels
+
+
 def resolve_store_path(architecture, spec_hash):
   """Return the path where a tarball with the given hash is to be stored.
 
@@ -320,9 +359,9 @@ def filterByArchitectureDefaults(arch, defaults, requires):
     require, matcher = ":" in r and r.split(":", 1) or (r, ".*")
     if matcher.startswith("defaults="):
       wanted = matcher[len("defaults="):]
-      if re.match(wanted, defaults):
+      if compiled(wanted).match(defaults):
         yield require
-    if re.match(matcher, arch):
+    if compiled(matcher).match(arch):
       yield require
 
 def disabledByArchitectureDefaults(arch, defaults, requires):
@@ -330,9 +369,9 @@ def disabledByArchitectureDefaults(arch, defaults, requires):
     require, matcher = ":" in r and r.split(":", 1) or (r, ".*")
     if matcher.startswith("defaults="):
       wanted = matcher[len("defaults="):]
-      if not re.match(wanted, defaults):
+      if not compiled(wanted).match(defaults):
         yield require
-    elif not re.match(matcher, arch):
+    elif not compiled(matcher).match(arch):
       yield require
 
 def merge_dicts(dict1, dict2, skip_keys=None) -> OrderedDict:
@@ -415,6 +454,9 @@ class GeneratedPackage:
     self.url = obj["url"]
   def __call__(self):
     return  getoutput(self.command).strip()
+  def dependency(self):
+    # We cannot know what the command reads without running it.
+    return None
 
 # Read a recipe from a file
 class FileReader:
@@ -422,6 +464,8 @@ class FileReader:
     self.url = url
   def __call__(self):
     return open(self.url).read()
+  def dependency(self):
+    return ("file", os.path.abspath(self.url))
 
 # Read a recipe from a git repository using git show.
 class GitReader:
@@ -438,26 +482,60 @@ class GitReader:
                          "  cd {dist} && git remote update -p && git fetch --tags"
                          .format(dist=self.configDir, gh=gh, fn=fn))
     return d
+  def dependency(self):
+    fn, gh = re.search(r'^dist:(.*)@([^@]+)$', self.url).groups()
+    return ("git", os.path.abspath(self.configDir), gh, f"{fn.lower()}.sh")
+
+@lru_cache(maxsize=None)
+def gitTreeBlobs(directory, ref):
+  """Blob ids of the files at the top of ref, listed once per reference."""
+  err, out = git(("ls-tree", ref), directory=directory, check=False)
+  if err:
+    return {}
+  return {name: info.split()[2] for info, sep, name in
+          (line.partition("\t") for line in out.splitlines()) if sep}
+
+def dependencySignature(dependency):
+  """What stands for the current content of a recipe dependency.
+
+  dependency is what the dependency() method of a reader returns, or
+  ("file", path) for files included with !include. None if it is gone.
+  """
+  try:
+    if dependency[0] == "git":
+      _, directory, ref, name = dependency
+      blob = gitTreeBlobs(directory, ref).get(name)
+      return blob and "git:" + blob
+    return file_signature(dependency[1])
+  except OSError:
+    return None
 
-def yamlLoad(s):
-  class YamlSafeOrderedLoader(yaml.SafeLoader):
+def trackDependency(dependencies, dependency):
+  if dependencies is not None:
+    dependencies.append(dependency and (dependency, dependencySignature(dependency)))
+
+def makeYamlLoader(base):
+  """Build a loader on top of base, with ordered mappings and `!include`."""
+  class YamlSafeOrderedLoader(base):
     """YAML Loader with `!include` constructor."""
-    
-    def __init__(self, stream: IO) -> None:
+
+    def __init__(self, stream: IO, dependencies=None) -> None:
       """Initialise Loader."""
       try:
         self._root = os.path.split(stream.name)[0]
       except AttributeError:
         self._root = os.path.curdir
+      self._dependencies = dependencies
       super().__init__(stream)
 
   def construct_include(loader: YamlSafeOrderedLoader, node: yaml.Node) -> Any:
     """Include file referenced at node."""
     filename = os.path.abspath(os.path.join(loader._root, loader.construct_scalar(node)))
     extension = os.path.splitext(filename)[1].lstrip('.')
+    trackDependency(loader._dependencies, ("file", filename))
     with open(filename) as f:
       if extension in ('yaml', 'yml'):
-        return yaml.load(f, YamlSafeOrderedLoader)
+        return yamlLoad(f, loader._dependencies, type(loader))
       elif extension in ('json', ):
         return json.load(f)
       else:
@@ -470,7 +548,29 @@ def yamlLoad(s):
   YamlSafeOrderedLoader.add_constructor('!include', construct_include)
   YamlSafeOrderedLoader.add_constructor(yaml.resolver.BaseResolver.DEFAULT_MAPPING_TAG,
                                         construct_mapping)
-  return yaml.load(s, YamlSafeOrderedLoader)
+  return YamlSafeOrderedLoader
+
+# Built once, using libyaml if PyYAML was built with it. The result is the
+# same as with the pure Python yaml.SafeLoader, only faster.
+YamlPureOrderedLoader = makeYamlLoader(yaml.SafeLoader)
+YamlSafeOrderedLoader = makeYamlLoader(yaml.CSafeLoader) if hasattr(yaml, "CSafeLoader") \
+  else YamlPureOrderedLoader
+
+def yamlLoad(s, dependencies=None, loaderClass=YamlSafeOrderedLoader):
+  try:
+    loader = loaderClass(s, dependencies)
+    try:
+      return loader.get_single_data()
+    finally:
+      loader.dispose()
+  except yaml.YAMLError:
+    if loaderClass is YamlPureOrderedLoader:
+      raise
+    # libyaml words its errors differently. Parse again to report them as
+    # we always have, which is cheap as it only happens with broken recipes.
+    if hasattr(s, "seek"):
+      s.seek(0)
+    return yamlLoad(s, dependencies, YamlPureOrderedLoader)
 
 def yamlDump(s):
   class YamlOrderedDumper(yaml.SafeDumper):
@@ -485,13 +585,22 @@ def yamlDump(s):
   YamlOrderedDumper.add_representer(OrderedDict, represent_ordereddict)
   return yaml.dump(s, Dumper=YamlOrderedDumper)
 
-def parseRecipe(reader, generatePackages=None, visited=None):
+def parseRecipe(reader, generatePackages=None, visited=None, dependencies=None):
+  """Parse the recipe returned by reader, returning (err, spec, recipe).
+
+  If dependencies is a list, what the result depends on (the recipe itself,
+  the files it includes and the recipes it inherits from) is appended to it,
+  as (dependency, signature) pairs, or None for what cannot be tracked.
+  """
   assert(reader.__call__)
   err, spec, recipe = (None, None, None)
   try:
+    # Take the signature before reading, so that a concurrent change is not
+    # mistaken for the content we have read.
+    trackDependency(dependencies, getattr(reader, "dependency", lambda: None)())
     d = reader()
     header,recipe = d.split("---", 1)
-    spec = yamlLoad(header)
+    spec = yamlLoad(header, dependencies)
     if spec and "from" in spec:
       basename = os.path.basename(getattr(reader, "url", "") or "")
       filename = basename[:-3] if basename.endswith(".sh") else basename
@@ -504,7 +613,7 @@ def parseRecipe(reader, generatePackages=None, visited=None):
       parent_dir = os.path.join(repoDir, spec["from"])
       base_filename, pkgdir = resolveFilename({}, filename, parent_dir, generatePackages)
       base_reader = getRecipeReader(base_filename, repoDir, generatePackages[parent_dir])
-      err, base_spec, base_recipe = parseRecipe(base_reader, generatePackages, visited)
+      err, base_spec, base_recipe = parseRecipe(base_reader, generatePackages, visited, dependencies)
       spec, recipe_append = handleMergePolicy(spec, base_spec)
       recipe = recipe + base_recipe if recipe_append else recipe
     validateSpec(spec)
@@ -645,7 +754,8 @@ def getConfigPaths(configDir):
         pkgDirs.append(d)
   return pkgDirs
 
-def resolveFilename(taps, pkg, configDir, generatedPackages, ext=".sh"):
+def findFilename(taps, pkg, configDir, generatedPackages):
+  """Same as resolveFilename, but returns (None, None) if pkg is not found."""
   for d in getConfigPaths(configDir):
     if d in generatedPackages and pkg in generatedPackages[d]:
       meta = generatedPackages[d][pkg]
@@ -653,7 +763,12 @@ def resolveFilename(taps, pkg, configDir, generatedPackages, ext=".sh"):
     filename = checkForFilename(taps, pkg, d, ext=".sh")
     if exists(filename):
       return (filename, d)
-  dieOnError(True, "Package {} not found in {}".format(pkg, configDir))
+  return (None, None)
+
+def resolveFilename(taps, pkg, configDir, generatedPackages, ext=".sh"):
+  filename, pkgdir = findFilename(taps, pkg, configDir, generatedPackages)
+  dieOnError(not filename, "Package {} not found in {}".format(pkg, configDir))
+  return (filename, pkgdir)
 
 def resolveDefaultsFilename(defaults, configDir, failOnError=True):
   configPath = os.environ.get("BITS_PATH")
@@ -679,10 +794,59 @@ def resolveDefaultsFilename(defaults, configDir, failOnError=True):
                      for x in glob(join(configDir, "defaults-*.sh")))))
   '''
 
+def recipeName(package, defaults):
+  """Name of the recipe of package, as getPackageList looks for it."""
+  if package == "defaults-release" and defaults:
+    return "defaults-" + defaults[-1]
+  return package.lower()
+
+def applyOverrides(spec, overrides, log, matcher=None):
+  # If an override fully matches a package, we apply it. This means
+  # you can have multiple overrides being applied for a given package.
+  # We downcase the regex in parseDefaults(), so downcase the package name
+  # as well. FIXME: This is probably a bad idea; we should use
+  # re.IGNORECASE instead or just match case-sensitively.
+  matcher = matcher or RegexList(overrides, fullmatch=True)
+  for override in matcher.matching(spec["package"].lower()):
+    log("Overrides for package %s: %s", spec["package"], overrides[override])
+    spec.update(overrides.get(override, {}) or {})
+
+def systemChecks(spec, architecture, preferSystem, noSystem, defaults):
+  """The shell snippets getPackageList runs for spec, as (kind, key, command).
+
+  This follows what getPackageList does for a package, so that the snippets
+  can be started before it gets there.
+  """
+  checks = [("track_env", spec["package"] + env, code)
+            for env, code in spec.get("track_env", {}).items()]
+  noSystemList = [spec["package"]] if noSystem == "*" else noSystem.split(",") if noSystem else []
+  systemExcluded = spec["package"] in noSystemList
+  if ((not systemExcluded or spec.get("allow_system_package_upload", False)) and
+      (preferSystem or re.match(spec.get("prefer_system", "(?!.*)"), architecture))):
+    checks.append(("prefer", spec["package"], "REQUESTED_VERSION={version}\n{check}".format(
+      version=quote(resolve_version(spec, defaults, "unavailable", "unavailable")),
+      check=spec.get("prefer_system_check", "false"),
+    ).strip()))
+  if re.match(spec.get("system_requirement", "(?!.*)"), architecture):
+    checks.append(("requirement", spec["package"], spec.get("system_requirement_check", "false").strip()))
+  return checks
+
 def getPackageList(packages, specs, configDir, preferSystem, noSystem,
                    architecture, disable, defaults, performPreferCheck, performRequirementCheck,
                    performValidateDefaults, overrides, taps, log, force_rebuild=(),
-                   defaultPackageFamily=""):
+                   defaultPackageFamily="", recipeCache=None, concurrentChecks=True,
+                   performTrackEnv=None):
+  """Resolve the recipes of packages and of all their dependencies into specs.
+
+  Packages are resolved breadth first. The recipes of each frontier are read
+  at the same time and, unless concurrentChecks is False, their system checks
+  are started straight away. The outcome is the same as resolving packages
+  one at a time: the result of a check is only used if getPackageList ends up
+  running the very same command for the package.
+
+  track_env snippets are run with performTrackEnv, performPreferCheck if not
+  given.
+  """
   systemPackages = set()
   ownPackages = set()
   failedRequirements = set()
@@ -692,208 +856,260 @@ def getPackageList(packages, specs, configDir, preferSystem, noSystem,
   packages = packages[:]
   generatedPackages = getGeneratedPackages(configDir)
   validDefaults = []  # empty list: all OK; None: no valid default; non-empty list: list of valid ones
-  while packages:
-    p = packages.pop(0)
-    if p in specs:
-      continue
-    skip = False
-    for d in defaults:
-      if p == "defaults-release" and ("defaults-" + d) in specs:
-        skip = True
-        break
-      else:
-        pkg_filename = ("defaults-" + d) if p == "defaults-release" else p.lower()
-    if skip:
-      continue
+  parse = recipeCache.parse if recipeCache is not None else parseRecipe
+  overrideMatcher = RegexList(overrides, fullmatch=True)
 
-    # We rewrite all defaults to "defaults-release", so load the correct
-    # defaults package here.
-    # The reason for this rewriting is (I assume) so that packages that are
-    # not overridden by some defaults can be shared with other defaults, since
-    # they will end up with the same hash. The defaults must be called
-    # "defaults-release" for this to work, since the defaults are a dependency
-    # and all dependencies' names go into a package's hash.
-    filename,pkgdir = resolveFilename(taps, pkg_filename, configDir, generatedPackages)
-
-    dieOnError(not filename, "Package {} not found in {}".format(p, configDir))
-    assert(filename is not None)
-
-    err, spec, recipe = parseRecipe(getRecipeReader(filename, configDir, generatedPackages[pkgdir]), generatedPackages)
-    dieOnError(err, err)
-    # Unless there was an error, both spec and recipe should be valid.
-    # otherwise the error should have been caught above.
-    assert(spec is not None)
-    assert(recipe is not None)
-    dieOnError(spec["package"].lower() != pkg_filename,
-               "{}.sh has different package field: {}".format(p, spec["package"]))
-    spec["pkgdir"] = pkgdir
-
-    if p == "defaults-release":
-      # Re-rewrite the defaults' name to "defaults-release". Everything auto-
-      # depends on "defaults-release", so we need something with that name.
-      spec["package"] = "defaults-release"
-
-      # Never run the defaults' recipe, to match previous behaviour.
-      # Warn if a non-trivial recipe is found (i.e., one with any non-comment lines).
-      for line in map(str.strip, recipe.splitlines()):
-        if line and not line.startswith("#"):
-          warning("%s.sh contains a recipe, which will be ignored", pkg_filename)
-      recipe = ""
-
-    dieOnError(spec["package"] != p,
-               "{} should be spelt {}.".format(p, spec["package"]))
-
-    # If an override fully matches a package, we apply it. This means
-    # you can have multiple overrides being applied for a given package.
-    for override in overrides:
-      # We downcase the regex in parseDefaults(), so downcase the package name
-      # as well. FIXME: This is probably a bad idea; we should use
-      # re.IGNORECASE instead or just match case-sensitively.
-      if not re.fullmatch(override, p.lower()):
-        continue
-      log("Overrides for package %s: %s", spec["package"], overrides[override])
-      spec.update(overrides.get(override, {}) or {})
+  def readRecipe(filename, pkgdir):
+    return parse(getRecipeReader(filename, configDir, generatedPackages[pkgdir]), generatedPackages)
+
+  checkers = {"track_env": performTrackEnv or performPreferCheck, "prefer": performPreferCheck,
+              "requirement": performRequirementCheck}
+  started = {}   # (kind, key) -> (command, future of its result)
 
-    # If --always-prefer-system is passed or if prefer_system is set to true
-    # inside the recipe, use the script specified in the prefer_system_check
-    # stanza to see if we can use the system version of the package.
-    systemRE = spec.get("prefer_system", "(?!.*)")
+  def readRecipeAndCheck(p, filename, pkgdir):
+    result = readRecipe(filename, pkgdir)
+    err, spec, _ = result
     try:
-      systemREMatches = re.match(systemRE, architecture)
-    except TypeError:
-      dieOnError(True, "Malformed entry prefer_system: {} in {}".format(systemRE, spec["package"]))
-
-    noSystemList = []
-    if noSystem == "*":
-      noSystemList = [spec["package"]]
-    elif noSystem is not None:
-      noSystemList = noSystem.split(",")
-    systemExcluded = (spec["package"] in noSystemList)
-    allowSystemPackageUpload = spec.get("allow_system_package_upload", False)
-    # Fill the track env with the actual result from executing the script.
-    for env, trackingCode in spec.get("track_env", {}).items():
-      key = spec["package"] + env
-      if key not in trackingEnvCache:
-        status, out = performPreferCheck(spec, trackingCode)
-        dieOnError(status, f"Error while executing track_env for {key}: {trackingCode} => {out}")
-        trackingEnvCache[key] = out
-      spec["track_env"][env] = trackingEnvCache[key]
-
-    if (not systemExcluded or allowSystemPackageUpload) and  (preferSystem or systemREMatches):
-      requested_version = resolve_version(spec, defaults, "unavailable", "unavailable")
-      cmd = "REQUESTED_VERSION={version}\n{check}".format(
-        version=quote(requested_version),
-        check=spec.get("prefer_system_check", "false"),
-      ).strip()
-      if spec["package"] not in testCache:
-        testCache[spec["package"]] = performPreferCheck(spec, cmd)
-      err, output = testCache[spec["package"]]
-      if err:
-        # prefer_system_check errored; this means we must build the package ourselves.
-        ownPackages.add(spec["package"])
-      else:
-        # prefer_system_check succeeded; this means we should use the system package.
-        match = re.search(r"^bits_system_replace:(?P<key>.*)$", output, re.MULTILINE)
-        if not match and systemExcluded:
-          # No replacement spec name given. Fall back to old system package
-          # behaviour and just disable the package.
+      # Disabled packages are dropped once reached, do not check them ahead.
+      # systemChecks already leaves out what --no-system excludes.
+      if concurrentChecks and not err and p not in disable:
+        spec = copy.deepcopy(spec)
+        if p == "defaults-release":
+          spec["package"] = p
+        applyOverrides(spec, overrides, lambda *args: None, overrideMatcher)
+        for kind, key, cmd in systemChecks(spec, architecture, preferSystem, noSystem, defaults):
+          started.setdefault((kind, key), (cmd, checkPool.submit(checkers[kind], spec, cmd)))
+    except Exception:
+      pass  # Whatever went wrong will be reported when we get to the package.
+    return result
+
+  def runCheck(kind, key, spec, cmd):
+    cmdStarted, result = started.pop((kind, key), (None, None))
+    return result.result() if cmdStarted == cmd else checkers[kind](spec, cmd)
+
+  pool = concurrent.futures.ThreadPoolExecutor(max_workers=RECIPE_READERS)
+  checkPool = concurrent.futures.ThreadPoolExecutor(max_workers=SYSTEM_CHECKS)
+  parsing = {}   # recipe filename -> future of readRecipeAndCheck
+  frontier = 0   # packages left in the frontier being resolved
+  try:
+    while packages:
+      if not frontier:
+        # Read and parse the recipes of the whole frontier of the breadth first
+        # walk at once. They are then dealt with one by one, in the same order
+        # as if they were read here, so that the outcome is the same.
+        frontier = len(packages)
+        for name in packages:
+          if name in specs:
+            continue
+          filename, pkgdir = findFilename(taps, recipeName(name, defaults), configDir, generatedPackages)
+          if filename and filename not in parsing:
+            parsing[filename] = pool.submit(readRecipeAndCheck, name, filename, pkgdir)
+      frontier -= 1
+      p = packages.pop(0)
+      if p in specs:
+        continue
+      skip = False
+      for d in defaults:
+        if p == "defaults-release" and ("defaults-" + d) in specs:
+          skip = True
+          break
+        else:
+          pkg_filename = ("defaults-" + d) if p == "defaults-release" else p.lower()
+      if skip:
+        continue
+
+      # We rewrite all defaults to "defaults-release", so load the correct
+      # defaults package here.
+      # The reason for this rewriting is (I assume) so that packages that are
+      # not overridden by some defaults can be shared with other defaults, since
+      # they will end up with the same hash. The defaults must be called
+      # "defaults-release" for this to work, since the defaults are a dependency
+      # and all dependencies' names go into a package's hash.
+      filename,pkgdir = resolveFilename(taps, pkg_filename, configDir, generatedPackages)
+
+      dieOnError(not filename, "Package {} not found in {}".format(p, configDir))
+      assert(filename is not None)
+
+      future = parsing.pop(filename, None)
+      err, spec, recipe = future.result() if future else readRecipe(filename, pkgdir)
+      dieOnError(err, err)
+      # Unless there was an error, both spec and recipe should be valid.
+      # otherwise the error should have been caught above.
+      assert(spec is not None)
+      assert(recipe is not None)
+      dieOnError(spec["package"].lower() != pkg_filename,
+                 "{}.sh has different package field: {}".format(p, spec["package"]))
+      spec["pkgdir"] = pkgdir
+
+      if p == "defaults-release":
+        # Re-rewrite the defaults' name to "defaults-release". Everything auto-
+        # depends on "defaults-release", so we need something with that name.
+        spec["package"] = "defaults-release"
+
+        # Never run the defaults' recipe, to match previous behaviour.
+        # Warn if a non-trivial recipe is found (i.e., one with any non-comment lines).
+        for line in map(str.strip, recipe.splitlines()):
+          if line and not line.startswith("#"):
+            warning("%s.sh contains a recipe, which will be ignored", pkg_filename)
+        recipe = ""
+
+      dieOnError(spec["package"] != p,
+                 "{} should be spelt {}.".format(p, spec["package"]))
+
+      applyOverrides(spec, overrides, log, overrideMatcher)
+
+      # If --always-prefer-system is passed or if prefer_system is set to true
+      # inside the recipe, use the script specified in the prefer_system_check
+      # stanza to see if we can use the system version of the package.
+      systemRE = spec.get("prefer_system", "(?!.*)")
+      try:
+        systemREMatches = re.match(systemRE, architecture)
+      except TypeError:
+        dieOnError(True, "Malformed entry prefer_system: {} in {}".format(systemRE, spec["package"]))
+
+      noSystemList = []
+      if noSystem == "*":
+        noSystemList = [spec["package"]]
+      elif noSystem is not None:
+        noSystemList = noSystem.split(",")
+      systemExcluded = (spec["package"] in noSystemList)
+      allowSystemPackageUpload = spec.get("allow_system_package_upload", False)
+      # Fill the track env with the actual result from executing the script.
+      for env, trackingCode in spec.get("track_env", {}).items():
+        key = spec["package"] + env
+        if key not in trackingEnvCache:
+          status, out = runCheck("track_env", key, spec, trackingCode)
+          dieOnError(status, f"Error while executing track_env for {key}: {trackingCode} => {out}")
+          trackingEnvCache[key] = out
+        spec["track_env"][env] = trackingEnvCache[key]
+
+      if (not systemExcluded or allowSystemPackageUpload) and  (preferSystem or systemREMatches):
+        requested_version = resolve_version(spec, defaults, "unavailable", "unavailable")
+        cmd = "REQUESTED_VERSION={version}\n{check}".format(
+          version=quote(requested_version),
+          check=spec.get("prefer_system_check", "false"),
+        ).strip()
+        if spec["package"] not in testCache:
+          testCache[spec["package"]] = runCheck("prefer", spec["package"], spec, cmd)
+        err, output = testCache[spec["package"]]
+        if err:
+          # prefer_system_check errored; this means we must build the package ourselves.
           ownPackages.add(spec["package"])
-        elif not match and not systemExcluded:
-          # No replacement spec name given. Fall back to old system package
-          # behaviour and just disable the package.
-          systemPackages.add(spec["package"])
-          disable.append(spec["package"])
-        elif match:
-          # The check printed the name of a replacement; use it.
-          key = match.group("key").strip()
-          replacement = None
-          for replacement_matcher in spec["prefer_system_replacement_specs"]:
-            if re.match(replacement_matcher, key):
-              replacement = spec["prefer_system_replacement_specs"][replacement_matcher]
-              break
-          if replacement:
-            # We must keep the package name the same, since it is used to
-            # specify dependencies.
-            replacement["package"] = spec["package"]
-            # The version is required for all specs. What we put there will
-            # influence the package's hash, so allow the user to override it.
-            replacement.setdefault("version", requested_version)
-            spec = replacement
-            # Allows generalising the version based on the actual key provided
-            spec["version"] = spec["version"].replace("%(key)s", key)
-            # We need the key to inject the version into the replacement recipe later.
-            spec["key"] = key 
-            recipe = replacement.get("recipe", "")
-            # If there's an explicitly-specified recipe, we're still building
-            # the package. If not, Bits will still "build" it, but it's
-            # basically instantaneous, so report to the user that we're taking
-            # it from the system.
-            if recipe:
-              ownPackages.add(spec["package"])
+        else:
+          # prefer_system_check succeeded; this means we should use the system package.
+          match = re.search(r"^bits_system_replace:(?P<key>.*)$", output, re.MULTILINE)
+          if not match and systemExcluded:
+            # No replacement spec name given. Fall back to old system package
+            # behaviour and just disable the package.
+            ownPackages.add(spec["package"])
+          elif not match and not systemExcluded:
+            # No replacement spec name given. Fall back to old system package
+            # behaviour and just disable the package.
+            systemPackages.add(spec["package"])
+            disable.append(spec["package"])
+          elif match:
+            # The check printed the name of a replacement; use it.
+            key = match.group("key").strip()
+            replacement = None
+            for replacement_matcher in spec["prefer_system_replacement_specs"]:
+              if re.match(replacement_matcher, key):
+                replacement = spec["prefer_system_replacement_specs"][replacement_matcher]
+                break
+            if replacement:
+              # We must keep the package name the same, since it is used to
+              # specify dependencies.
+              replacement["package"] = spec["package"]
+              # The version is required for all specs. What we put there will
+              # influence the package's hash, so allow the user to override it.
+              replacement.setdefault("version", requested_version)
+              spec = replacement
+              # Allows generalising the version based on the actual key provided
+              spec["version"] = spec["version"].replace("%(key)s", key)
+              # We need the key to inject the version into the replacement recipe later.
+              spec["key"] = key 
+              recipe = replacement.get("recipe", "")
+              # If there's an explicitly-specified recipe, we're still building
+              # the package. If not, Bits will still "build" it, but it's
+              # basically instantaneous, so report to the user that we're taking
+              # it from the system.
+              if recipe:
+                ownPackages.add(spec["package"])
+              else:
+                systemPackages.add(spec["package"])
             else:
-              systemPackages.add(spec["package"])
-          else:
-            warning(f"Could not find named replacement spec for {spec['package']}: {key}, "
-                    "falling back to building the package ourselves.")
-
-    dieOnError(("system_requirement" in spec) and recipe.strip("\n\t "),
-               "System requirements %s cannot have a recipe" % spec["package"])
-    if re.match(spec.get("system_requirement", "(?!.*)"), architecture):
-      cmd = spec.get("system_requirement_check", "false")
-      if spec["package"] not in requirementsCache:
-        requirementsCache[spec["package"]] = performRequirementCheck(spec, cmd.strip())
-
-      err, output = requirementsCache[spec["package"]]
-      if err:
-        failedRequirements.update([spec["package"]])
-        spec["version"] = "failed"
-      else:
-        disable.append(spec["package"])
+              warning(f"Could not find named replacement spec for {spec['package']}: {key}, "
+                      "falling back to building the package ourselves.")
+
+      dieOnError(("system_requirement" in spec) and recipe.strip("\n\t "),
+                 "System requirements %s cannot have a recipe" % spec["package"])
+      if re.match(spec.get("system_requirement", "(?!.*)"), architecture):
+        cmd = spec.get("system_requirement_check", "false")
+        if spec["package"] not in requirementsCache:
+          requirementsCache[spec["package"]] = runCheck("requirement", spec["package"], spec, cmd.strip())
+
+        err, output = requirementsCache[spec["package"]]
+        if err:
+          failedRequirements.update([spec["package"]])
+          spec["version"] = "failed"
+        else:
+          disable.append(spec["package"])
 
-    spec["disabled"] = list(disable)
-    if spec["package"] in disable:
-      continue
+      spec["disabled"] = list(disable)
+      if spec["package"] in disable:
+        continue
 
-    # Check whether the package is compatible with the specified defaults
-    if validDefaults is not None:
-      (ok,msg,valid) = performValidateDefaults(spec)
-      if valid:
-        validDefaults = [ v for v in validDefaults if v in valid ] if validDefaults else valid[:]
-        if not validDefaults:
-          validDefaults = None  # no valid default works for all current packages
-
-    # For the moment we treat build_requires just as requires.
-    fn = lambda what: disabledByArchitectureDefaults(architecture, defaults, spec.get(what, []))
-    spec["disabled"] += [x for x in fn("requires")]
-    spec["disabled"] += [x for x in fn("build_requires")]
-    fn = lambda what: filterByArchitectureDefaults(architecture, defaults, spec.get(what, []))
-    spec["requires"] = [x for x in fn("requires") if x not in disable]
-    spec["build_requires"] = [x for x in fn("build_requires") if x not in disable]
-    if spec["package"] != "defaults-release":
-      spec["build_requires"].append("defaults-release")
-    spec["runtime_requires"] = spec["requires"]
-    spec["requires"] = spec["runtime_requires"] + spec["build_requires"]
-    # Check that version is a string
-    dieOnError(not isinstance(spec["version"], str),
-               "In recipe \"%s\": version must be a string" % p)
-    spec["tag"] = spec.get("tag", spec["version"])
-    spec["version"] = spec["version"].replace("/", "_")
-    spec["recipe"] = recipe.strip("\n")
-    if spec["package"] in force_rebuild:
-      spec["force_rebuild"] = True
-    # Apply package_family: use spec value, then override value (already merged), then default
-    # Don't apply package_family to defaults-release itself
-    # To opt out of default family, set package_family: ~ (null) or package_family: "" in recipe/override
-    if spec["package"] != "defaults-release":
-      if "package_family" not in spec and defaultPackageFamily:
-        spec["package_family"] = defaultPackageFamily
-      # Normalize None to empty string for consistent handling
-      if spec.get("package_family") is None:
-        spec["package_family"] = ""
-      if spec.get("package_family"):
-        log("Package %s using package_family: %s", spec["package"], spec["package_family"])
-    specs[spec["package"]] = spec
-    packages += spec["requires"]
+      # Check whether the package is compatible with the specified defaults
+      if validDefaults is not None:
+        (ok,msg,valid) = performValidateDefaults(spec)
+        if valid:
+          validDefaults = [ v for v in validDefaults if v in valid ] if validDefaults else valid[:]
+          if not validDefaults:
+            validDefaults = None  # no valid default works for all current packages
+
+      # For the moment we treat build_requires just as requires.
+      fn = lambda what: disabledByArchitectureDefaults(architecture, defaults, spec.get(what, []))
+      spec["disabled"] += [x for x in fn("requires")]
+      spec["disabled"] += [x for x in fn("build_requires")]
+      fn = lambda what: filterByArchitectureDefaults(architecture, defaults, spec.get(what, []))
+      spec["requires"] = [x for x in fn("requires") if x not in disable]
+      spec["build_requires"] = [x for x in fn("build_requires") if x not in disable]
+      if spec["package"] != "defaults-release":
+        spec["build_requires"].append("defaults-release")
+      spec["runtime_requires"] = spec["requires"]
+      spec["requires"] = spec["runtime_requires"] + spec["build_requires"]
+      # Check that version is a string
+      dieOnError(not isinstance(spec["version"], str),
+                 "In recipe \"%s\": version must be a string" % p)
+      spec["tag"] = spec.get("tag", spec["version"])
+      spec["version"] = spec["version"].replace("/", "_")
+      spec["recipe"] = recipe.strip("\n")
+      if spec["package"] in force_rebuild:
+        spec["force_rebuild"] = True
+      # Apply package_family: use spec value, then override value (already merged), then default
+      # Don't apply package_family to defaults-release itself
+      # To opt out of default family, set package_family: ~ (null) or package_family: "" in recipe/override
+      if spec["package"] != "defaults-release":
+        if "package_family" not in spec and defaultPackageFamily:
+          spec["package_family"] = defaultPackageFamily
+        # Normalize None to empty string for consistent handling
+        if spec.get("package_family") is None:
+          spec["package_family"] = ""
+        if spec.get("package_family"):
+          log("Package %s using package_family: %s", spec["package"], spec["package_family"])
+      specs[spec["package"]] = spec
+      packages += spec["requires"]
+  finally:
+    # Recipes and checks for packages which turned out to be skipped, or left
+    # behind by an error, are cancelled if they have not started yet. Those
+    # running are waited for, so that no check is still running during the
+    # build. Recipe readers go first, as they start checks. (shutdown() can
+    # only cancel futures itself from Python 3.9.)
+    for future in parsing.values():
+      future.cancel()
+    pool.shutdown(wait=True)
+    for _, future in started.values():
+      future.cancel()
+    checkPool.shutdown(wait=True)
   return (systemPackages, ownPackages, failedRequirements, validDefaults)
 
 def getGeneratedPackages(configDir):
@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+"""Time the parsing of the headers of all the recipes in a repository.
+
+    python3 tests/benchmark_recipes.py [-n REPEAT] [CONFIG_DIR...]
+
+Each header is parsed with the loader yamlLoad uses and with the pure Python
+one, and the results are checked to be the same. CONFIG_DIR defaults to the
+recipes used by the tests.
+"""
+import argparse
+import glob
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bits_helpers.utilities import yamlLoad, YamlPureOrderedLoader, YamlSafeOrderedLoader  # noqa: E402
+
+
+def load(header, loaderClass):
+    try:
+        return repr(yamlLoad(header, loaderClass=loaderClass))
+    except Exception as e:
+        return "%s: %s" % (type(e).__name__, e)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("-n", dest="repeat", type=int, default=5,
+                        help="how many times to parse each header, default %(default)s")
+    parser.add_argument("configDirs", metavar="CONFIG_DIR", nargs="*",
+                        default=[os.path.join(os.path.dirname(os.path.abspath(__file__)), "testdist")])
+    args = parser.parse_args()
+
+    headers = []
+    for configDir in args.configDirs:
+        for recipe in sorted(glob.glob(os.path.join(configDir, "*.sh"))):
+            with open(recipe) as f:
+                headers.append((recipe, f.read().split("---", 1)[0]))
+    # Includes are relative to the current directory.
+    os.chdir(args.configDirs[0])
+
+    timings = {}
+    for name, loaderClass in (("pure Python", YamlPureOrderedLoader), ("yamlLoad", YamlSafeOrderedLoader)):
+        start = time.perf_counter()
+        for _ in range(args.repeat):
+            for _, header in headers:
+                load(header, loaderClass)
+        timings[name] = time.perf_counter() - start
+        print("%-12s %8.3f s for %d headers x %d" % (name, timings[name], len(headers), args.repeat))
+    if timings["yamlLoad"]:
+        print("speedup      %8.1fx (%s)" % (timings["pure Python"] / timings["yamlLoad"],
+                                           YamlSafeOrderedLoader.__mro__[1].__name__))
+
+    different = [recipe for recipe, header in headers
+                 if load(header, YamlSafeOrderedLoader) != load(header, YamlPureOrderedLoader)]
+    for recipe in different:
+        print("different result for %s" % recipe, file=sys.stderr)
+    return 1 if different else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
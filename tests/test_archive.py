@@ -0,0 +1,57 @@
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+from bits_helpers.archive import archive_format, extract_command, find_tarball, sort_tarballs, \
+  stored_tarball, tarball_name
+
+SPEC = {"package": "zlib", "version": "v1.3.1", "revision": "2", "architecture": "slc9_x86-64",
+        "hash": "deadbeefdeadbeefdeadbeefdeadbeefdeadbeef"}
+
+
+class ArchiveTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+
+    def test_names(self):
+        self.assertEqual(tarball_name(SPEC), "zlib-v1.3.1-2.slc9_x86-64.tar.gz")
+        self.assertEqual(archive_format(tarball_name(SPEC, "tar.zst")), "tar.zst")
+        self.assertIsNone(archive_format("zlib-v1.3.1-2.slc9_x86-64.tar.gz.processing"))
+        names = ["a.tar.zst", "b.tar.gz", "c.tar.gz.tmp", "d.tar.zst"]
+        self.assertEqual(sort_tarballs(names), ["b.tar.gz", "a.tar.zst", "d.tar.zst"])
+        self.assertEqual(sort_tarballs(names, "tar.zst"), ["a.tar.zst", "d.tar.zst", "b.tar.gz"])
+
+    def test_find(self):
+        store = os.path.join(self.tmpdir, "TARS", "slc9_x86-64", "store", "de", SPEC["hash"])
+        os.makedirs(store)
+        # Tarballs which are not there yet are in the preferred format.
+        self.assertIsNone(find_tarball(store, SPEC))
+        self.assertEqual(stored_tarball(self.tmpdir, SPEC, "tar.zst"), tarball_name(SPEC, "tar.zst"))
+        open(os.path.join(store, tarball_name(SPEC, "tar.zst")), "w").close()
+        self.assertEqual(stored_tarball(self.tmpdir, SPEC), tarball_name(SPEC, "tar.zst"))
+        open(os.path.join(store, tarball_name(SPEC)), "w").close()
+        self.assertEqual(find_tarball(store, SPEC), tarball_name(SPEC))
+        self.assertEqual(find_tarball(store, SPEC, "tar.zst"), tarball_name(SPEC, "tar.zst"))
+
+    @unittest.skipUnless(shutil.which("zstd"), "zstd is not installed")
+    def test_extract(self):
+        source = os.path.join(self.tmpdir, "source")
+        os.makedirs(os.path.join(source, "etc"))
+        with open(os.path.join(source, "etc", "zlib.conf"), "w") as conf:
+            conf.write("prefix=/sw\n")
+        for fmt, compress in (("tar.zst", "zstd -T0 -q -c"), ("tar.gz", "gzip -c")):
+            tarball = os.path.join(self.tmpdir, tarball_name(SPEC, fmt))
+            subprocess.check_call("tar -cC %s . | %s > %s" % (source, compress, tarball), shell=True)
+            dest = os.path.join(self.tmpdir, fmt)
+            os.mkdir(dest)
+            with open(tarball, "rb") as stream:
+                subprocess.check_call(extract_command(archive_format(tarball), "-", dest), stdin=stream)
+            with open(os.path.join(dest, "etc", "zlib.conf")) as conf:
+                self.assertEqual(conf.read(), "prefix=/sw\n")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -4,6 +4,8 @@ import os.path
 import platform
 import re
 import sys
+import threading
+import time
 import unittest
 # Assuming you are using the mock library to ... mock things
 from unittest.mock import call, patch, MagicMock, DEFAULT
@@ -243,9 +245,9 @@ class BuildTestCase(unittest.TestCase):
     @patch("os.listdir")
     @patch("bits_helpers.build.glob", new=lambda pattern: {
         "*": ["zlib"],
-        f"/sw/TARS/{TEST_ARCHITECTURE}/store/{TEST_DEFAULT_RELEASE_BUILD_HASH[:2]}/{TEST_DEFAULT_RELEASE_BUILD_HASH}/*gz": [],
-        f"/sw/TARS/{TEST_ARCHITECTURE}/store/{TEST_ZLIB_BUILD_HASH[:2]}/{TEST_ZLIB_BUILD_HASH}/*gz": [],
-        f"/sw/TARS/{TEST_ARCHITECTURE}/store/{TEST_ROOT_BUILD_HASH[:2]}/{TEST_ROOT_BUILD_HASH}/*gz": [],
+        f"/sw/TARS/{TEST_ARCHITECTURE}/store/{TEST_DEFAULT_RELEASE_BUILD_HASH[:2]}/{TEST_DEFAULT_RELEASE_BUILD_HASH}/*.tar.*": [],
+        f"/sw/TARS/{TEST_ARCHITECTURE}/store/{TEST_ZLIB_BUILD_HASH[:2]}/{TEST_ZLIB_BUILD_HASH}/*.tar.*": [],
+        f"/sw/TARS/{TEST_ARCHITECTURE}/store/{TEST_ROOT_BUILD_HASH[:2]}/{TEST_ROOT_BUILD_HASH}/*.tar.*": [],
         f"/sw/TARS/{TEST_ARCHITECTURE}/defaults-release/defaults-release-v1-1.{TEST_ARCHITECTURE}.tar.gz":
         [f"../../{TEST_ARCHITECTURE}/store/{TEST_DEFAULT_RELEASE_BUILD_HASH[:2]}/{TEST_DEFAULT_RELEASE_BUILD_HASH}/defaults-release-v1-1.{TEST_ARCHITECTURE}.tar.gz"],
     }[pattern])
@@ -285,6 +287,7 @@ class BuildTestCase(unittest.TestCase):
             jobs=2,
             annotate={},
             preferSystem=[],
+            refreshSystemChecks=False,
             noSystem=None,
             debug=True,
             dryRun=False,
@@ -358,6 +361,96 @@ class BuildTestCase(unittest.TestCase):
         spec["tag"] = resolve_tag(spec)
         return spec
 
+    @patch("bits_helpers.analytics", new=MagicMock())
+    @patch("requests.Session.get", new=MagicMock())
+    @patch("bits_helpers.sync.execute", new=dummy_execute)
+    @patch("bits_helpers.git.git")
+    @patch("bits_helpers.build.exists", new=MagicMock(side_effect=dummy_exists))
+    @patch("bits_helpers.utilities.exists", new=MagicMock(side_effect=dummy_exists))
+    @patch("os.path.exists", new=MagicMock(side_effect=dummy_exists))
+    @patch("bits_helpers.build.dieOnError", new=MagicMock())
+    @patch("bits_helpers.utilities.dieOnError", new=MagicMock())
+    @patch("bits_helpers.utilities.warning")
+    @patch("bits_helpers.build.readDefaults",
+           new=MagicMock(return_value=(OrderedDict({"package": "defaults-release", "disable": []}), "")))
+    @patch("shutil.rmtree", new=MagicMock(return_value=None))
+    @patch("os.makedirs", new=MagicMock(return_value=None))
+    @patch("bits_helpers.build.makedirs", new=MagicMock(return_value=None))
+    @patch("bits_helpers.build.symlink", new=MagicMock(return_value=None))
+    @patch("bits_helpers.workarea.symlink", new=MagicMock(return_value=None))
+    @patch("bits_helpers.utilities.open", new=lambda x: {
+        "/alidist/root.sh": StringIO(TEST_ROOT_RECIPE),
+        "/alidist/zlib.sh": StringIO(TEST_ZLIB_RECIPE),
+        "/alidist/defaults-release.sh": StringIO(TEST_DEFAULT_RELEASE)
+    }[x])
+    @patch("bits_helpers.sync.open", new=MagicMock(side_effect=dummy_open))
+    @patch("bits_helpers.build.open", new=MagicMock(side_effect=dummy_open))
+    @patch("codecs.open", new=MagicMock(side_effect=dummy_open))
+    @patch("bits_helpers.build.shutil", new=MagicMock())
+    @patch("os.listdir")
+    @patch("bits_helpers.build.glob", new=lambda pattern: {
+        "*": ["zlib"],
+        f"/sw/TARS/{TEST_ARCHITECTURE}/store/{TEST_DEFAULT_RELEASE_BUILD_HASH[:2]}/{TEST_DEFAULT_RELEASE_BUILD_HASH}/*.tar.*": [],
+        f"/sw/TARS/{TEST_ARCHITECTURE}/store/{TEST_ZLIB_BUILD_HASH[:2]}/{TEST_ZLIB_BUILD_HASH}/*.tar.*": [],
+        f"/sw/TARS/{TEST_ARCHITECTURE}/store/{TEST_ROOT_BUILD_HASH[:2]}/{TEST_ROOT_BUILD_HASH}/*.tar.*": [],
+        f"/sw/TARS/{TEST_ARCHITECTURE}/defaults-release/defaults-release-v1-1.{TEST_ARCHITECTURE}.tar.gz":
+        [f"../../{TEST_ARCHITECTURE}/store/{TEST_DEFAULT_RELEASE_BUILD_HASH[:2]}/{TEST_DEFAULT_RELEASE_BUILD_HASH}/defaults-release-v1-1.{TEST_ARCHITECTURE}.tar.gz"],
+    }[pattern])
+    @patch("bits_helpers.build.readlink", new=dummy_readlink)
+    @patch("bits_helpers.build.banner", new=MagicMock(return_value=None))
+    @patch("bits_helpers.build.debug")
+    @patch("bits_helpers.workarea.is_writeable", new=MagicMock(return_value=True))
+    @patch("bits_helpers.build.basename", new=MagicMock(return_value="aliBuild"))
+    @patch("bits_helpers.build.install_wrapper_script", new=MagicMock())
+    @patch("bits_helpers.build.remote_from_url")
+    def test_failed_build_stops_prefetch(self, mock_remote, mock_debug, mock_listdir, mock_warning,
+                                         mock_git_git) -> None:
+        """A failed build does not wait for the tarballs still to download."""
+        mock_git_git.side_effect = dummy_git
+        mock_listdir.side_effect = lambda directory: []
+        os.environ["BITS_NO_ANALYTICS"] = "1"
+        started = threading.Event()
+        release = threading.Event()
+        fetched = []
+
+        def fetch_tarball(spec):
+            fetched.append(spec["package"])
+            if len(fetched) == 2:
+                started.set()
+            release.wait()  # blocks until the end of the test
+
+        def fail_build(*args):
+            # Like dieOnError, once both downloaders are busy.
+            started.wait(10)
+            raise SystemExit(1)
+
+        mock_remote.return_value = MagicMock(remoteStore="https://localhost/store", writeStore="",
+                                             archiveFormat="tar.gz", fetch_tarball=fetch_tarball)
+        args = Namespace(
+            remoteStore="https://localhost/store", writeStore="", referenceSources="/sw/MIRROR",
+            docker=False, dockerImage=None, docker_extra_args=["--network=host"],
+            containerWorkDir=False, architecture=TEST_ARCHITECTURE, workDir="/sw",
+            pkgname=["root"], configDir="/alidist", disable=[], force_rebuild=[],
+            defaults=["release"], jobs=2, annotate={}, preferSystem=[],
+            refreshSystemChecks=False, noSystem=None, debug=True, dryRun=False,
+            aggressiveCleanup=False, environment=[], autoCleanup=False, noDevel=[],
+            onlyDeps=False, fetchRepos=False, forceTracked=False, plugin="legacy",
+            builders=1, resources=None, resourceMonitoring=False, makeflow=False,
+            fetchJobs=2,
+        )
+        start = time.time()
+        try:
+            with patch("bits_helpers.build.fetchCachedTarball", new=fail_build), \
+                 self.assertRaises(SystemExit):
+                doBuild(args, MagicMock())
+            self.assertLess(time.time() - start, 10)
+        finally:
+            release.set()
+        # The downloads which were running are left to finish, the one still
+        # queued was cancelled.
+        time.sleep(0.2)
+        self.assertEqual(fetched, ["defaults-release", "zlib"])
+
     def test_hashing(self) -> None:
         """Check that the hashes assigned to packages remain constant."""
         default = self.setup_spec(TEST_DEFAULT_RELEASE)
@@ -0,0 +1,82 @@
+import os
+import shutil
+import tempfile
+import unittest
+from argparse import Namespace
+from collections import OrderedDict
+from unittest.mock import MagicMock
+
+from bits_helpers.build import planPackage
+
+ARCH = "slc9_x86-64"
+
+
+class BuildPlanTestCase(unittest.TestCase):
+    def setUp(self):
+        self.workDir = tempfile.mkdtemp()
+        self.args = Namespace(workDir=self.workDir, architecture=ARCH, defaults=["release"])
+        self.syncHelper = MagicMock(writeStore="")
+
+    def tearDown(self):
+        shutil.rmtree(self.workDir)
+
+    def specs(self):
+        zlib = {"package": "zlib", "version": "v1.2.13", "recipe": "make install",
+                "commit_hash": "v1.2.13", "tag": "v1.2.13", "is_devel_pkg": False,
+                "architecture": ARCH, "requires": [], "env": OrderedDict()}
+        root = dict(zlib, package="ROOT", version="v6-30", commit_hash="v6-30", tag="v6-30",
+                    requires=["zlib"])
+        return {"zlib": zlib, "ROOT": root}
+
+    def plan(self, specs):
+        return [planPackage(p, specs, self.args, self.syncHelper, self.workDir, None, "", "")
+                for p in ("zlib", "ROOT")]
+
+    def test_build_everything(self):
+        specs = self.specs()
+        zlib, root = self.plan(specs)
+        self.assertEqual((zlib["action"], zlib["revision"]), ("build", "local1"))
+        self.assertEqual(zlib["hash"], specs["zlib"]["local_revision_hash"])
+        self.assertTrue(zlib["tarball"].endswith("/%s/zlib-v1.2.13-local1.%s.tar.gz" % (zlib["hash"], ARCH)))
+        self.assertEqual(root["requires"], ["zlib"])
+        self.assertEqual(specs["ROOT"]["build_family"], "release")
+        # The hashes of ROOT depend on the one of zlib.
+        other = self.specs()
+        other["zlib"]["recipe"] = "make -j install"
+        self.assertNotEqual(self.plan(other)[1]["hash"], root["hash"])
+
+    def test_reuse(self):
+        zlib, _ = self.plan(self.specs())
+        # A tarball of zlib with the right hash, as symlinked by a previous build.
+        os.makedirs(os.path.dirname(zlib["tarball"]))
+        links = os.path.join(self.workDir, "TARS", ARCH, "zlib")
+        os.makedirs(links)
+        target = os.path.relpath(zlib["tarball"], os.path.join(self.workDir, "TARS"))
+        os.symlink(os.path.join("..", "..", target), os.path.join(links, os.path.basename(zlib["tarball"])))
+        self.assertEqual(self.plan(self.specs())[0]["action"], "remote")
+        open(zlib["tarball"], "w").close()
+        self.assertEqual(self.plan(self.specs())[0]["action"], "cached")
+        # Once installed, there is nothing left to do.
+        installed = os.path.join(self.workDir, ARCH, "zlib", "v1.2.13local1")
+        os.makedirs(installed)
+        with open(os.path.join(installed, ".build-hash"), "w") as out:
+            out.write(zlib["hash"])
+        zlib, root = self.plan(self.specs())
+        self.assertEqual((zlib["action"], zlib["revision"], root["action"]), ("installed", "local1", "build"))
+
+    def test_reuse_other_format(self):
+        zlib, _ = self.plan(self.specs())
+        # Tarballs are reused whatever their format.
+        tarball = zlib["tarball"].replace(".tar.gz", ".tar.zst")
+        os.makedirs(os.path.dirname(tarball))
+        open(tarball, "w").close()
+        links = os.path.join(self.workDir, "TARS", ARCH, "zlib")
+        os.makedirs(links)
+        target = os.path.relpath(tarball, os.path.join(self.workDir, "TARS"))
+        os.symlink(os.path.join("..", "..", target), os.path.join(links, os.path.basename(tarball)))
+        zlib, _ = self.plan(self.specs())
+        self.assertEqual((zlib["action"], zlib["tarball"]), ("cached", tarball))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,74 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from bits_helpers.build_stats import record_build, collect, stats_store_path, summarise_samples
+from bits_helpers.resource_manager import ResourceManager
+from bits_helpers.scheduler import Scheduler
+
+MB = 1024 * 1024
+
+
+def samples(cpus, rss, duration):
+    return [{"cpu": cpu, "rss": rss * MB, "time": duration * (i + 1) / len(cpus)}
+            for i, cpu in enumerate(cpus)]
+
+
+class BuildStatsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.workDir = tempfile.mkdtemp()
+        self.store = stats_store_path(self.workDir, "slc9_x86-64")
+
+    def tearDown(self):
+        shutil.rmtree(self.workDir)
+
+    def monitorFile(self, package, revision, data):
+        path = os.path.join(self.workDir, "SPECS", "slc9_x86-64", package,
+                            "1.0-%d" % revision, package + ".json")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as out:
+            json.dump(data, out)
+        os.utime(path, (revision, revision))
+        return path
+
+    def test_summarise(self):
+        self.assertIsNone(summarise_samples([]))
+        summary = summarise_samples(samples(list(range(1, 101)), 100, 50))
+        self.assertEqual(summary, {"cpu": 95, "rss": 100, "time": 50})
+        # Samples count for as long as they last: a long stretch of one core,
+        # compacted to its first and last samples, outweighs a short spike.
+        flat = [{"cpu": 100, "rss": MB, "time": 0}, {"cpu": 100, "rss": MB, "time": 9 * 3600}]
+        spike = [{"cpu": 800, "rss": MB, "time": 9 * 3600 + 10 * i} for i in range(1, 61)]
+        self.assertEqual(summarise_samples(flat + spike)["cpu"], 100)
+        self.assertEqual(summarise_samples(spike)["cpu"], 800)
+
+    def test_record(self):
+        record_build(self.store, "ROOT", self.monitorFile("ROOT", 1, samples([400] * 10, 2000, 100)))
+        record_build(self.store, "ROOT", self.monitorFile("ROOT", 2, samples([200] * 10, 3000, 200)))
+        self.assertIsNone(record_build(self.store, "ROOT", self.monitorFile("ROOT", 3, [])))
+        with open(self.store) as ref:
+            store = json.load(ref)
+        self.assertEqual({k: store["packages"]["build"]["root"][k] for k in ("cpu", "rss", "time")},
+                         {"cpu": 400, "rss": 3000, "time": 150})
+        self.assertEqual(len(store["packages"]["build"]["root"]["history"]), 2)
+        self.assertEqual(store["resources"]["cpu"], os.cpu_count() * 100)
+        # What we write is what the ResourceManager expects.
+        manager = ResourceManager(store, Scheduler(1))
+        self.assertEqual(manager.getStats("build:ROOT")["rss"], 3000)
+        self.assertEqual(manager.getStats("build:zlib")["time"], 600)
+
+    def test_collect(self):
+        for revision in range(1, 8):
+            self.monitorFile("zlib", revision, samples([100], revision, 10 * revision))
+        collect(self.workDir, "slc9_x86-64")
+        with open(self.store) as ref:
+            zlib = json.load(ref)["packages"]["build"]["zlib"]
+        # Only the last builds count.
+        self.assertEqual(len(zlib["history"]), 5)
+        self.assertEqual(zlib["rss"], 7)
+
+
+if __name__ == '__main__':
+    unittest.main()
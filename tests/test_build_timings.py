@@ -0,0 +1,66 @@
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+from collections import defaultdict
+
+from bits_helpers.build_timings import format_summary, phase, read_timings, summarise_timings, timings_path
+
+TEMPLATE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                        "bits_helpers", "build_template.sh")
+
+
+class BuildTimingsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.buildRoot = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.buildRoot)
+
+    def test_read_and_summarise(self):
+        with open(timings_path(self.buildRoot), "w") as out:
+            out.write('{"phase": "setup", "start": 0, "end": 1}\n'
+                      '{"phase": "build", "start": 1, "end": 7.5}\n'
+                      '{"phase": "rsync", "start": 8, "end": 10, "background": true}\n'
+                      '{"phase": "setup", "start": 7.5, "end": 8}\n'
+                      '{"phase": "archive", "start": 8, "end": 9}\n'
+                      '{"phase": "reloc')
+        timings = read_timings(timings_path(self.buildRoot))
+        self.assertEqual(len(timings), 5)
+        summary = summarise_timings(timings)
+        self.assertEqual(summary["phases"], {"setup": 1.5, "build": 6.5, "archive": 1, "rsync": 2})
+        self.assertEqual(summary["background"], ["rsync"])
+        self.assertEqual(summary["total"], 9)
+        self.assertEqual(read_timings(os.path.join(self.buildRoot, "missing")), [])
+
+    def test_phase(self):
+        spec = {}
+        with self.assertRaises(RuntimeError):
+            with phase(spec, "checkout"):
+                raise RuntimeError("failed")
+        self.assertEqual([timing["phase"] for timing in spec["phaseTimings"]], ["checkout"])
+        self.assertLessEqual(spec["phaseTimings"][0]["start"], spec["phaseTimings"][0]["end"])
+
+    def test_format_summary(self):
+        self.assertEqual(format_summary({"zlib": summarise_timings([])}), "")
+        summary = format_summary({
+            "zlib": summarise_timings([{"phase": "build", "start": 0, "end": 6},
+                                       {"phase": "checkout", "start": 0, "end": 2}]),
+            "ROOT": summarise_timings([{"phase": "build", "start": 0, "end": 2}]),
+        }).splitlines()
+        # Phases come in the order they happen.
+        self.assertTrue(summary[1].startswith("checkout"))
+        self.assertIn("80.0%", summary[2])
+        self.assertIn("(2 packages)", summary[-1])
+
+    def test_template_syntax(self):
+        # The template is %-formatted, the phase helpers must survive it.
+        script = os.path.join(self.buildRoot, "build.sh")
+        with open(TEMPLATE) as ref, open(script, "w") as out:
+            out.write(ref.read() % defaultdict(lambda: "true"))
+        subprocess.check_call(["bash", "-n", script])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,3 +1,4 @@
+import glob
 import os
 import tempfile
 
@@ -5,7 +6,7 @@ import unittest
 import yaml
 import bits_helpers.utilities
 from bits_helpers.utilities import merge_dicts
-from bits_helpers.utilities import yamlLoad
+from bits_helpers.utilities import yamlLoad, YamlPureOrderedLoader
 
 class TestYamlLoadIncludes(unittest.TestCase):
 
@@ -87,6 +88,22 @@ class TestYamlLoadIncludes(unittest.TestCase):
 
         self.assertEqual(data["child"]["v"], 99)
 
+    def test_same_as_pure_python_loader(self):
+        # The libyaml based loader gives exactly what yaml.SafeLoader gives,
+        # errors included.
+        def load(header, **kwargs):
+            try:
+                return repr(yamlLoad(header, **kwargs))
+            except yaml.YAMLError as e:
+                return str(e)
+        included = self._write("included.yaml", "b: [1, 2.5, yes, ~]\nwhen: 2024-01-01\n")
+        headers = ["z: 1\na: &x {k: v}\nc: *x\nd: !include %s\n" % included, "a: b: c"]
+        for recipe in glob.glob(os.path.join(os.path.dirname(__file__), "testdist", "*.sh")):
+            with open(recipe) as f:
+                headers.append(f.read().split("---", 1)[0])
+        for header in headers:
+            self.assertEqual(load(header), load(header, loaderClass=YamlPureOrderedLoader))
+
     def test_order_preservation(self):
         included = self._write("included.yaml", r"""
             x: 1
@@ -0,0 +1,45 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from bits_helpers.disk_cache import DiskCache
+
+
+class DiskCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, "SPECS", "cache.json")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_lru(self):
+        for binary in (False, True):
+            cache = DiskCache(self.path, 1, maxEntries=2, binary=binary)
+            cache.put("a", [1])
+            cache.put("b", [2])
+            self.assertEqual(cache.get("a"), [1])
+            cache.put("c", [3])
+            cache.save()
+            # The least recently used entry was dropped.
+            self.assertEqual(DiskCache(self.path, 1, binary=binary).entries, {"a": [1], "c": [3]})
+            # Nothing is written if nothing changed.
+            os.unlink(self.path)
+            cache.save()
+            self.assertFalse(os.path.exists(self.path))
+
+    def test_invalid(self):
+        cache = DiskCache(self.path, 1)
+        cache.put("old", {"valid": False})
+        cache.put("new", {"valid": True})
+        cache.save(keep=lambda entry: entry["valid"])
+        self.assertEqual(list(DiskCache(self.path, 1).entries), ["new"])
+        # Caches of other versions, or which cannot be read, are ignored.
+        self.assertEqual(DiskCache(self.path, 2).entries, {})
+        self.assertEqual(DiskCache(self.path, 1, binary=True).entries, {})
+        self.assertEqual(os.listdir(os.path.dirname(self.path)), ["cache.json"])
+
+
+if __name__ == '__main__':
+    unittest.main()
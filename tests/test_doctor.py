@@ -3,6 +3,8 @@ from io import StringIO
 
 from bits_helpers.doctor import doDoctor
 from argparse import Namespace
+import shutil
+import tempfile
 import unittest
 
 RECIPE_DEFAULTS_RELEASE = """package: defaults-release
@@ -80,13 +82,17 @@ class DoctorTestCase(unittest.TestCase):
     mockPrintWarning.side_effect = lambda e, *a: out["warning"].write((e%a)+"\n")
     mockPrintBanner.side_effect  = lambda e, *a: out["banner"].write((e%a)+"\n")
 
-    args = Namespace(workDir="/work",
+    # The results of system checks are kept in the work directory.
+    workDir = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, workDir)
+    args = Namespace(workDir=workDir,
                      configDir="/dist",
                      docker=False,
                      dockerImage=None,
                      docker_extra_args=["--network=host"],
                      debug=False,
                      preferSystem=[],
+                     refreshSystemChecks=False,
                      noSystem="*",
                      architecture="osx_x86-64",
                      disable=[],
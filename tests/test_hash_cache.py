@@ -0,0 +1,66 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from bits_helpers.build import storeHashes
+from bits_helpers.hash_cache import HashCache, MAX_ENTRIES
+
+
+class HashCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.cacheFile = os.path.join(self.tmpdir, "SPECS", "slc9_x86-64", "hash-cache.json")
+        os.makedirs(os.path.join(self.tmpdir, "patches"))
+        self.writePatch("zlib-fix.patch", "--- a\n+++ b\n")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def writePatch(self, name, content):
+        with open(os.path.join(self.tmpdir, "patches", name), "w") as out:
+            out.write(content)
+
+    def hashes(self, cache=None, **extra):
+        spec = dict({"package": "zlib", "version": "v1.2.13", "recipe": "make install",
+                     "commit_hash": "v1.2.13", "tag": "v1.2.13", "is_devel_pkg": False,
+                     "pkgdir": self.tmpdir, "patches": ["zlib-fix.patch"]}, **extra)
+        storeHashes("zlib", {"zlib": spec}, considerRelocation=False, cache=cache)
+        return {key: spec[key] for key in ("remote_hashes", "local_hashes", "deps_hash")}
+
+    def test_same_hashes(self):
+        reference = self.hashes()
+        cache = HashCache(self.cacheFile)
+        self.assertEqual(self.hashes(cache), reference)
+        cache.save()
+        # The second time round, the patch is not read at all.
+        with patch("bits_helpers.build.readHashInput", side_effect=AssertionError("patch read")):
+            self.assertEqual(self.hashes(HashCache(self.cacheFile)), reference)
+
+    def test_changes(self):
+        cache = HashCache(self.cacheFile)
+        reference = self.hashes(cache)
+        # A change in the recipe or in the patch gives new hashes.
+        self.assertNotEqual(self.hashes(cache, recipe="make -j install"), reference)
+        self.writePatch("zlib-fix.patch", "--- a/zlib.c\n+++ b/zlib.c\n")
+        changed = self.hashes(cache)
+        self.assertNotEqual(changed, reference)
+        self.assertEqual(changed, self.hashes())
+
+    def test_limits(self):
+        cache = HashCache(self.cacheFile)
+        for i in range(MAX_ENTRIES + 10):
+            cache.put(str(i), {})
+        self.assertEqual(cache.get("0"), None)
+        self.assertEqual(cache.get("10"), {})
+        cache.save()
+        self.assertEqual(len(HashCache(self.cacheFile).entries), MAX_ENTRIES)
+        # A damaged cache is simply ignored.
+        with open(self.cacheFile, "w") as out:
+            out.write("{")
+        self.assertEqual(HashCache(self.cacheFile).entries, {})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,80 @@
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+import unittest
+
+from bits_helpers.jobserver import JobServer
+
+# The same snippet build_template.sh uses to hand the jobserver to make,
+# followed by a recipe opting in to it.
+MAKE_WITH_JOBSERVER = """
+if [ -n "$BITS_JOBSERVER" ] && [ -p "$BITS_JOBSERVER" ]; then
+  exec 7<>"$BITS_JOBSERVER"
+  export BITS_MAKEFLAGS="-j --jobserver-fds=7,7 --jobserver-auth=7,7${MAKEFLAGS:+ $MAKEFLAGS}"
+fi
+test "$JOBS" = 8
+MAKEFLAGS="${BITS_MAKEFLAGS:--j$JOBS}" make
+"""
+
+
+class JobServerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.fifo = os.path.join(self.tmpdir, "jobserver")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def readTokens(self):
+        fd = os.open(self.fifo, os.O_RDWR | os.O_NONBLOCK)
+        try:
+            return os.read(fd, 4096)
+        except BlockingIOError:
+            return b""
+        finally:
+            os.close(fd)
+
+    def test_host_and_join(self):
+        with JobServer(self.fifo, 3) as host:
+            self.assertTrue(host.hosting)
+            with JobServer(self.fifo, 10) as other:
+                # Only the first one fills the pipe.
+                self.assertFalse(other.hosting)
+            self.assertEqual(self.readTokens(), b"+++")
+        # Once the host is gone, the next one takes over with its own tokens.
+        with JobServer(self.fifo, 2) as host:
+            self.assertTrue(host.hosting)
+            self.assertEqual(self.readTokens(), b"++")
+
+    def test_stale_tokens(self):
+        os.mkfifo(self.fifo)
+        keep = os.open(self.fifo, os.O_RDWR | os.O_NONBLOCK)
+        os.write(keep, b"+" * 5)
+        try:
+            with JobServer(self.fifo, 1):
+                self.assertEqual(self.readTokens(), b"+")
+        finally:
+            os.close(keep)
+
+    @unittest.skipUnless(shutil.which("make"), "make is not available")
+    def test_make(self):
+        with open(os.path.join(self.tmpdir, "Makefile"), "w") as makefile:
+            makefile.write("all: a b c d\na b c d:\n\t@sleep 0.5\n")
+        with JobServer(self.fifo, 1):
+            start = time.time()
+            subprocess.check_call(["bash", "-c", MAKE_WITH_JOBSERVER], cwd=self.tmpdir,
+                                  env=dict(os.environ, BITS_JOBSERVER=self.fifo, JOBS="8"))
+            elapsed = time.time() - start
+        # With one token, make runs two targets at a time, rather than all four.
+        self.assertGreater(elapsed, 0.9)
+        # Without the jobserver, the recipe runs make -j$JOBS.
+        start = time.time()
+        subprocess.check_call(["bash", "-c", MAKE_WITH_JOBSERVER], cwd=self.tmpdir,
+                              env=dict(os.environ, JOBS="8"))
+        self.assertLess(time.time() - start, 0.9)
+
+
+if __name__ == '__main__':
+    unittest.main()
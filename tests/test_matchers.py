@@ -0,0 +1,39 @@
+import re
+import unittest
+
+from bits_helpers.matchers import RegexList
+
+
+class RegexListTestCase(unittest.TestCase):
+    PATTERNS = ["root", "(ali)?root", "(?P<name>py)thon.*", "ali.*", ".*-(\\w+)-\\w+", "o2.*"]
+    NAMES = ["root", "aliroot", "python-modules", "alien", "o2", "o2physics", "x-y-z", "zlib", ""]
+
+    def test_same_as_one_by_one(self):
+        for fullmatch in (False, True):
+            match = re.fullmatch if fullmatch else re.match
+            matcher = RegexList(self.PATTERNS, fullmatch=fullmatch)
+            self.assertIsNotNone(matcher.combined)
+            for name in self.NAMES:
+                expected = [p for p in self.PATTERNS if match(p, name)]
+                self.assertEqual(matcher.matching(name), expected)
+                self.assertEqual(matcher.first(name),
+                                 self.PATTERNS.index(expected[0]) if expected else None)
+
+    def test_not_combined(self):
+        # Back references, conditionals and global flags cannot be combined,
+        # they are still matched.
+        for patterns, name in ((["(a)\\1", "(b)\\1"], "bb"), (["(?i)root", "zlib"], "zlib"),
+                               (["root", "(?i)zlib"], "ZLIB"), (["(a)?(?(1)b|c)", "(x)?(?(1)y|z)"], "z"),
+                               (["(?P<x>a)", "(?P<x>b)"], "b")):
+            matcher = RegexList(patterns, fullmatch=True)
+            self.assertIsNone(matcher.combined)
+            self.assertEqual(matcher.first(name), 1)
+        # A flag in one pattern does not apply to the others.
+        self.assertIsNone(RegexList(["root", "(?i)zlib"], fullmatch=True).first("ROOT"))
+        # Scoped flags are fine.
+        self.assertIsNotNone(RegexList(["root", "(?i:zlib)"]).combined)
+        self.assertEqual(RegexList([]).matching("root"), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
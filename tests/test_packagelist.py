@@ -1,11 +1,13 @@
 from textwrap import dedent
 import os
+import sys
 import unittest
 from unittest import mock
 from unittest.mock import patch
 import tempfile
 
 from bits_helpers.cmd import getstatusoutput
+from bits_helpers.system_checks import SystemCheckCache
 from bits_helpers.utilities import getPackageList
 
 
@@ -63,12 +65,38 @@ RECIPES = {
         : magic sentinel command
     ---
     """),
+    "CONFIG_DIR/breadth.sh": dedent("""\
+    package: breadth
+    version: v1
+    requires:
+      - disable
+      - with-replacement
+      - sentinel-command
+      - force-rebuild
+    track_env:
+      BREADTH_ENV: echo tracked
+    ---
+    """),
     "CONFIG_DIR/force-rebuild.sh": dedent("""\
     package: force-rebuild
     version: v1
     force_rebuild: true
     ---
     """),
+    "CONFIG_DIR/tracking-env.sh": dedent("""\
+    package: tracking-env
+    version: v1
+    track_env:
+      TRACKED: echo "$TRACKED_ENV"
+    ---
+    """),
+    "CONFIG_DIR/slow-check.sh": dedent("""\
+    package: slow-check
+    version: v1
+    prefer_system: '.*'
+    prefer_system_check: sleep 0.5
+    ---
+    """),
     "CONFIG_DIR/dirty_prefer_system_check.sh": dedent("""\
     package: dirty_prefer_system_check
     version: v1
@@ -89,11 +117,17 @@ class MockReader:
         return self._contents
 
 
-def getPackageListWithDefaults(packages, force_rebuild=()):
+def getPackageListWithDefaults(packages, force_rebuild=(), concurrentChecks=True, checks=None,
+                               finished=None, disable=()):
     specs = {}   # getPackageList will mutate this
     def performPreferCheckWithTempDir(pkg, cmd):
+      if checks is not None:
+        checks.append((pkg["package"], cmd))
       with tempfile.TemporaryDirectory(prefix=f"bits_prefer_check_{pkg['package']}_") as temp_dir:
-        return getstatusoutput(cmd, cwd=temp_dir)
+        result = getstatusoutput(cmd, cwd=temp_dir)
+      if finished is not None:
+        finished.append((pkg["package"], cmd))
+      return result
     return_values = getPackageList(
         packages=packages,
         specs=specs,
@@ -104,7 +138,7 @@ def getPackageListWithDefaults(packages, force_rebuild=()):
         preferSystem=True,
         noSystem=None,
         architecture="ARCH",
-        disable=[],
+        disable=list(disable),
         defaults=["release"],
         # Mock recipes just run "echo" or ":", so this is safe.
         performPreferCheck=performPreferCheckWithTempDir,
@@ -114,6 +148,7 @@ def getPackageListWithDefaults(packages, force_rebuild=()):
         taps={},
         log=lambda *_: None,
         force_rebuild=force_rebuild,
+        concurrentChecks=concurrentChecks,
     )
     return (specs, *return_values)
 
@@ -212,6 +247,64 @@ class ForceRebuildTestCase(unittest.TestCase):
         self.assertTrue(specs["defaults-release"]["force_rebuild"])
 
 
+@mock.patch("bits_helpers.utilities.getRecipeReader", new=MockReader)
+@mock.patch("bits_helpers.utilities.exists", new=lambda f: f in RECIPES)
+class ConcurrentChecksTestCase(unittest.TestCase):
+    """Test that running the system checks concurrently changes nothing."""
+
+    def test_same_outcome(self) -> None:
+        serialChecks, concurrentChecks = [], []
+        serial = getPackageListWithDefaults(["breadth"], concurrentChecks=False, checks=serialChecks)
+        concurrent = getPackageListWithDefaults(["breadth"], checks=concurrentChecks)
+        self.assertEqual(serial, concurrent)
+        self.assertEqual(list(serial[0]), ["breadth", "with-replacement", "force-rebuild",
+                                           "defaults-release"])
+        self.assertEqual(serial[0]["breadth"]["track_env"], {"BREADTH_ENV": "tracked"})
+        # Each check runs once, whatever the order.
+        self.assertEqual(sorted(serialChecks), sorted(concurrentChecks))
+        self.assertEqual(len(set(concurrentChecks)), len(concurrentChecks))
+
+    @patch("bits_helpers.utilities.dieOnError", new=lambda err, msg: err and sys.exit(1))
+    def test_no_check_left_running(self) -> None:
+        # The check of slow-check is started ahead, then getPackageList fails
+        # on the missing package before using it.
+        checks, finished = [], []
+        with self.assertRaises(SystemExit):
+            getPackageListWithDefaults(["breadth", "missing", "slow-check"], checks=checks, finished=finished)
+        self.assertIn(("slow-check", "REQUESTED_VERSION=v1\nsleep 0.5"), checks)
+        self.assertEqual(sorted(checks), sorted(finished))
+        # Disabled packages are not checked ahead.
+        checks = []
+        with self.assertRaises(SystemExit):
+            getPackageListWithDefaults(["breadth", "missing", "slow-check"], checks=checks,
+                                       disable=["slow-check"])
+        self.assertNotIn("slow-check", [package for package, _ in checks])
+
+
+@mock.patch("bits_helpers.utilities.getRecipeReader", new=MockReader)
+@mock.patch("bits_helpers.utilities.exists", new=lambda f: f in RECIPES)
+class TrackEnvTestCase(unittest.TestCase):
+    def test_not_cached(self) -> None:
+        """track_env follows the environment, even if system checks are cached."""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            def tracked(value):
+                cache = SystemCheckCache(os.path.join(tmpdir, "system-checks.json"), {"image": "test"})
+                cached = cache.wrap(lambda cmd: getstatusoutput(cmd))
+                specs = {}
+                with patch.dict(os.environ, {"TRACKED_ENV": value}):
+                    getPackageList(packages=["tracking-env"], specs=specs, configDir="CONFIG_DIR",
+                                   preferSystem=False, noSystem=None, architecture="ARCH", disable=[],
+                                   defaults=["release"],
+                                   performPreferCheck=lambda pkg, cmd: cached(cmd),
+                                   performRequirementCheck=lambda pkg, cmd: cached(cmd),
+                                   performTrackEnv=lambda pkg, cmd: getstatusoutput(cmd),
+                                   performValidateDefaults=lambda spec: (True, "", ["release"]),
+                                   overrides={"defaults-release": {}}, taps={}, log=lambda *_: None)
+                cache.save()
+                return specs["tracking-env"]["track_env"]["TRACKED"]
+
+            self.assertEqual(tracked("foo"), "foo")
+            self.assertEqual(tracked("bar"), "bar")
 
 
 if __name__ == '__main__':
@@ -0,0 +1,79 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from bits_helpers.recipe_cache import RecipeCache, recipe_cache_path
+from bits_helpers.utilities import FileReader, GeneratedPackage
+
+
+class RecipeCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.cacheFile = recipe_cache_path(self.tmpdir)
+        self.baseDir = os.path.join(self.tmpdir, "repo", "base")
+        os.makedirs(self.baseDir)
+        self.generated = {self.baseDir: {}}
+        self.write("zlib.sh", "package: zlib\nversion: v1\nextra: !include %s\n---\n./configure\n" %
+                   os.path.join(self.tmpdir, "extra.yaml"))
+        self.write("extra.yaml", "flags: -O2\n")
+        self.write("repo/base/root.sh", "package: ROOT\nversion: v6\nrequires:\n  - zlib\n---\nmake\n")
+        self.write("root.sh", "package: ROOT\nversion: v6-30\nfrom: base\n---\n")
+        env = patch.dict(os.environ, {"BITS_REPO_DIR": os.path.join(self.tmpdir, "repo")})
+        env.start()
+        self.addCleanup(env.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write(self, name, content):
+        with open(os.path.join(self.tmpdir, name), "w") as out:
+            out.write(content)
+
+    def parse(self, name, cache=None):
+        cache = cache or RecipeCache(self.cacheFile)
+        result = cache.parse(FileReader(os.path.join(self.tmpdir, name)), self.generated)
+        cache.save()
+        return result
+
+    def test_reuse(self):
+        err, spec, recipe = self.parse("zlib.sh")
+        self.assertEqual((err, spec["extra"]["flags"], recipe), (None, "-O2", "\n./configure\n"))
+        with patch("bits_helpers.recipe_cache.parseRecipe", side_effect=AssertionError("parsed")):
+            cache = RecipeCache(self.cacheFile)
+            self.assertEqual(self.parse("zlib.sh", cache), (err, spec, recipe))
+            # Each caller gets a copy it can modify.
+            self.parse("zlib.sh", cache)[1]["version"] = "v2"
+            self.assertEqual(self.parse("zlib.sh", cache)[1]["version"], "v1")
+        self.assertEqual(cache.hits, 3)
+
+    def test_invalidation(self):
+        self.assertEqual(self.parse("zlib.sh")[1]["extra"]["flags"], "-O2")
+        # Included files are part of the recipe.
+        self.write("extra.yaml", "flags: -O3 -g\n")
+        self.assertEqual(self.parse("zlib.sh")[1]["extra"]["flags"], "-O3 -g")
+        # So are the recipes it inherits from.
+        self.assertEqual(self.parse("root.sh")[1]["requires"], ["zlib"])
+        self.write("repo/base/root.sh", "package: ROOT\nversion: v6\nrequires:\n  - zlib\n  - xz\n---\nmake\n")
+        self.assertEqual(self.parse("root.sh")[1]["requires"], ["zlib", "xz"])
+        self.write("root.sh", "package: ROOT\nversion: v6-32-00\nfrom: base\n---\n")
+        self.assertEqual(self.parse("root.sh")[1]["version"], "v6-32-00")
+
+    def test_not_cached(self):
+        # Errors and generated recipes are not cached.
+        self.write("broken.sh", "package: broken\n")
+        self.assertIsNotNone(self.parse("broken.sh")[0])
+        cache = RecipeCache(self.cacheFile)
+        reader = GeneratedPackage({"command": "printf 'package: gen\\nversion: v1\\n---\\n'", "url": "gen"})
+        self.assertEqual(cache.parse(reader)[1]["package"], "gen")
+        self.assertEqual(cache.entries, {})
+        # A damaged cache is simply ignored.
+        os.makedirs(os.path.dirname(self.cacheFile))
+        with open(self.cacheFile, "w") as out:
+            out.write("garbage")
+        self.assertEqual(RecipeCache(self.cacheFile).entries, {})
+
+
+if __name__ == '__main__':
+    unittest.main()
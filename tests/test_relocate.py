@@ -0,0 +1,102 @@
+import json
+import os
+import shutil
+import stat
+import subprocess
+import tempfile
+import unittest
+
+from bits_helpers import relocate
+
+OLD = "/build/sw"
+HASH = "0123abcd"
+OLD_LONG = OLD + "/INSTALLROOT/" + HASH
+PKGPATH = "slc9_x86-64/zlib/v1.3-1"
+
+
+class RelocateTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.root = os.path.join(self.tmpdir, "INSTALLROOT", HASH, PKGPATH)
+        self.files = {
+            "bin/config": "prefix=%s/%s\nlibdir=%s/%s/lib %s/other\n" % (OLD_LONG, PKGPATH, OLD, PKGPATH, OLD),
+            "etc/modulefiles/zlib": "set version @@PKGREVISION@%s@@\n" % HASH,
+            "share/README": "nothing to relocate\n",
+        }
+        for name, content in self.files.items():
+            self.write(name, content.encode())
+        # Binary files and symlinks are left alone.
+        self.write("lib/libz.so", b"\x7fELF\0" + OLD.encode())
+        os.symlink("config", os.path.join(self.root, "bin", "link"))
+        os.chmod(os.path.join(self.root, "bin/config"), 0o755)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write(self, name, data):
+        path = os.path.join(self.root, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as out:
+            out.write(data)
+
+    def read(self, name):
+        with open(os.path.join(self.root, name), "rb") as f:
+            return f.read()
+
+    def test_scan(self):
+        relocate.write_scan(self.root, [OLD, "@@PKGREVISION@%s@@" % HASH], jobs=2)
+        with open(os.path.join(self.root, relocate.RELOCATE_LIST)) as listing:
+            self.assertEqual(listing.read(), "bin/config\netc/modulefiles/zlib\n")
+        with open(os.path.join(self.root, relocate.RELOCATE_OFFSETS)) as offsets:
+            recorded = json.load(offsets)
+        self.assertEqual(recorded["pattern"], OLD)
+        content = self.files["bin/config"]
+        self.assertEqual(recorded["files"]["bin/config"],
+                         [len(content), [i for i in range(len(content)) if content.startswith(OLD, i)]])
+        self.assertEqual(recorded["files"]["etc/modulefiles/zlib"], [len(self.files["etc/modulefiles/zlib"]), []])
+
+    def test_apply_same_as_sed(self):
+        relocate.write_scan(self.root, [OLD, "@@PKGREVISION@%s@@" % HASH])
+        original = self.read("bin/config")
+        # Offsets cannot be used when the new path could make new matches
+        # of the old one appear.
+        for new, usable in (("/cvmfs/sw", True), ("/opt", True), ("/b", False), (OLD + "/x", False)):
+            self.assertEqual(relocate.offsets_usable(OLD_LONG.encode(), OLD.encode(), new.encode()), usable)
+            self.write("bin/config", original)
+            relocate.apply(self.root, OLD_LONG, OLD, new, jobs=1)
+            self.assertEqual(self.read("bin/config"),
+                             original.replace(OLD_LONG.encode(), new.encode()).replace(OLD.encode(), new.encode()))
+        self.assertEqual(stat.S_IMODE(os.stat(os.path.join(self.root, "bin/config")).st_mode), 0o755)
+        self.assertTrue(os.path.islink(os.path.join(self.root, "bin", "link")))
+        self.assertEqual(self.read("lib/libz.so"), b"\x7fELF\0" + OLD.encode())
+        # Offsets which no longer match the file are not used.
+        changed = b"#!/bin/sh\n" + original
+        self.write("bin/config", changed)
+        relocate.apply(self.root, OLD_LONG, OLD, "/cvmfs/sw")
+        self.assertEqual(self.read("bin/config"), changed.replace(OLD_LONG.encode(), b"/cvmfs/sw")
+                                                         .replace(OLD.encode(), b"/cvmfs/sw"))
+
+    def test_relocate_me(self):
+        # relocate-me.sh gives the same result with and without relocate-me.py.
+        helpers = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "bits_helpers")
+        relocate.write_scan(self.root, [OLD, "@@PKGREVISION@%s@@" % HASH])
+        with open(os.path.join(self.root, "etc/profile.d/.bits-pkginfo"), "w") as pkginfo:
+            pkginfo.write("OP=%s\nPP=${PKGPATH:-%s}\nPH=%s\nPF=\nPKG_DIR=\"%s\"\n" % (PKGPATH, PKGPATH, HASH, OLD))
+        shutil.copy(os.path.join(helpers, "relocate-me.sh"), self.root)
+        results = []
+        for script in (True, False):
+            workDir = os.path.join(self.tmpdir, "python" if script else "sed")
+            shutil.copytree(self.root, os.path.join(workDir, PKGPATH), symlinks=True)
+            if script:
+                shutil.copy(os.path.join(helpers, "relocate.py"), os.path.join(workDir, PKGPATH, "relocate-me.py"))
+            subprocess.check_call(["bash", os.path.join(workDir, PKGPATH, "relocate-me.sh")],
+                                  env=dict(os.environ, WORK_DIR=workDir))
+            with open(os.path.join(workDir, PKGPATH, "bin/config"), "rb") as f:
+                results.append(f.read().replace(workDir.encode(), b"WORK_DIR"))
+            self.assertEqual(sorted(os.listdir(os.path.join(workDir, PKGPATH, "bin"))), ["config", "link"])
+        self.assertEqual(results[0], results[1])
+        self.assertNotIn(OLD.encode(), results[0])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,130 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from bits_helpers import resource_monitor
+from bits_helpers.resource_monitor import (ProcMonitor, SAMPLE_INTERVAL, MAX_SAMPLE_INTERVAL, SampleWriter,
+                                           next_interval, read_columns, read_proc_stat, read_samples,
+                                           run_monitor_on_command)
+
+HAS_PROC = os.path.isdir("/proc/%d" % os.getpid())
+# Sequential processes, each shorter than a sample.
+SHORT_LIVED = "for i in 1 2 3 4 5 6 7 8 9 10; do python3 -c 'for i in range(2000000): pass'; done"
+
+
+class ResourceMonitorTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_read_proc_stat(self):
+        os.makedirs(os.path.join(self.tmpdir, "42"))
+        with open(os.path.join(self.tmpdir, "42", "stat"), "w") as stat:
+            stat.write("42 (cc1plus (x) y) R 7 42 42 0 -1 4194304 100 0 0 0 "
+                       "300 100 50 50 20 0 3 0 1000 8192000 256 18446744073709551615\n")
+        with patch.object(resource_monitor, "PROC", self.tmpdir), \
+             patch.object(resource_monitor, "CLOCK_TICKS", 100), \
+             patch.object(resource_monitor, "PAGE_SIZE", 4096):
+            self.assertEqual(read_proc_stat(42), (7, "R", 5.0, 3, 8192000, 256 * 4096, 1000))
+            self.assertIsNone(read_proc_stat(43))
+
+    def writeStat(self, pid, ppid, start):
+        os.makedirs(os.path.join(self.tmpdir, str(pid)), exist_ok=True)
+        with open(os.path.join(self.tmpdir, str(pid), "stat"), "w") as stat:
+            stat.write("%d (cc1) R %d 1 1 0 -1 0 0 0 0 0 100 0 0 0 20 0 1 0 %d 4096 1 0\n" % (pid, ppid, start))
+
+    def test_pid_reuse(self):
+        # A process outside of the build exits, and a compiler started by the
+        # build gets its pid.
+        self.writeStat(10, 1, 100)
+        self.writeStat(20, 1, 200)
+        with patch.object(resource_monitor, "PROC", self.tmpdir):
+            monitor = ProcMonitor(10)
+            self.assertEqual(set(monitor.tree()), {10})
+            self.assertEqual(monitor.outside, {(20, 200)})
+            self.writeStat(20, 10, 300)
+            self.assertEqual(set(monitor.tree()), {10, 20})
+            self.assertEqual(monitor.outside, set())
+
+    def test_next_interval(self):
+        stats = {"cpu": 400, "rss": 1024 ** 3}
+        self.assertEqual(next_interval(SAMPLE_INTERVAL, {}, stats), SAMPLE_INTERVAL)
+        interval = SAMPLE_INTERVAL
+        for _ in range(10):
+            interval = next_interval(interval, stats, dict(stats, cpu=410))
+        self.assertEqual(interval, MAX_SAMPLE_INTERVAL)
+        self.assertEqual(next_interval(interval, stats, dict(stats, rss=2 * 1024 ** 3)), SAMPLE_INTERVAL)
+
+    def test_sample_writer(self):
+        path = os.path.join(self.tmpdir, "samples.jsonl")
+        cpus = [100, 800, 800, 810, 800, 100, 100]
+        with SampleWriter(path) as writer:
+            for time, cpu in enumerate(cpus):
+                writer.write({"cpu": cpu, "rss": 1024, "time": time})
+                # Every sample is on disk as soon as it is written, except
+                # the ones in the middle of a flat stretch.
+                if time == 1:
+                    self.assertEqual(len(read_samples(path)), 2)
+        # Only the ends of the flat stretches are kept.
+        self.assertEqual([sample["time"] for sample in read_samples(path)], [0, 1, 4, 5, 6])
+        columns = read_columns(path)
+        self.assertEqual(list(columns["cpu"]), [100, 800, 800, 100, 100])
+        self.assertEqual(len(columns["rss"]), 5)
+
+    def test_read_samples(self):
+        path = os.path.join(self.tmpdir, "samples.json")
+        with open(path, "w") as out:
+            json.dump([{"cpu": 100, "time": 0}, {"cpu": 200, "time": 1}], out)
+        self.assertEqual(list(read_columns(path)["cpu"]), [100, 200])
+        # The last line of an interrupted build may be incomplete.
+        with open(path, "w") as out:
+            out.write('{"cpu": 100, "time": 0}\n{"cpu": 200, "rss": 1, "time": 1}\n{"cpu": 3')
+        self.assertEqual(len(read_samples(path)), 2)
+        self.assertEqual(list(read_columns(path)["rss"]), [0, 1])
+
+    @unittest.skipUnless(HAS_PROC, "/proc is not available")
+    def test_proc_short_lived(self):
+        monitorFile = os.path.join(self.tmpdir, "proc.jsonl")
+        # Never use a cgroup, to check the /proc backend on its own.
+        with patch.object(resource_monitor, "create_build_cgroup", lambda: None):
+            samples = []
+            err = run_monitor_on_command(SHORT_LIVED, monitorFile, printer=lambda *args: None,
+                                         callback=samples.append)
+        self.assertEqual(err, 0)
+        data = read_samples(monitorFile)
+        # Similar samples may have been left out.
+        self.assertTrue(data)
+        self.assertTrue(all(sample in samples for sample in data))
+        # The shell itself uses no CPU, the time of its children is counted.
+        self.assertGreater(max(sample["cpu"] for sample in data), 50)
+        self.assertTrue(all(sample["rss"] > 0 for sample in data))
+
+    @unittest.skipUnless(HAS_PROC, "/proc is not available")
+    def test_separate_monitors(self):
+        # Each monitor keeps its own state, a new one starts from scratch.
+        first, second = ProcMonitor(os.getpid()), ProcMonitor(os.getpid())
+        self.assertTrue(first.sample())
+        self.assertTrue(first.outside)
+        self.assertFalse(second.outside)
+        self.assertTrue(first.running())
+        self.assertFalse(ProcMonitor(2 ** 22 + 1).sample())
+
+    @unittest.skipUnless(resource_monitor.delegated_cgroup(), "cannot create cgroups")
+    def test_cgroup(self):
+        monitorFile = os.path.join(self.tmpdir, "cgroup.jsonl")
+        before = set(os.listdir(resource_monitor.delegated_cgroup()))
+        err = run_monitor_on_command("python3 -c 'pass'", monitorFile, printer=lambda *args: None)
+        self.assertEqual(err, 0)
+        data = read_samples(monitorFile)
+        # Even a build shorter than a sample gets one.
+        self.assertEqual(len(data), 1)
+        self.assertEqual(set(os.listdir(resource_monitor.delegated_cgroup())), before)
+
+
+if __name__ == '__main__':
+    unittest.main()
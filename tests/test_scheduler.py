@@ -66,6 +66,172 @@ def test_resource_monitor():
     assert(len(scheduler.resourceManager.allocated)==0)
   return
 
+def test_dependencies():
+  scheduler = Scheduler(4)
+  scheduler.parallel("test3", ["test2"], "build", dummyTask)
+  scheduler.parallel("test2", ["test1"], "build", dummyTask)
+  scheduler.parallel("test1", [], "build", dummyTask)
+  scheduler.serial("test4", ["test3"], dummyTask)
+  scheduler.run()
+  assert(list(scheduler.doneJobs) == ["test1", "test2", "test3", "test4", "final-job"])
+  assert(not scheduler.brokenJobs)
+  assert(not scheduler.pendingJobs and not scheduler.runningJobs)
+
+def test_broken_dependencies():
+  scheduler = Scheduler(2)
+  scheduler.parallel("test0", [], "build", dummyTask)
+  scheduler.parallel("test1", [], "build", exceptionTask)
+  scheduler.parallel("test2", ["test1"], "build", dummyTask)
+  scheduler.serial("test3", ["test0", "test2"], dummyTask)
+  scheduler.run()
+  assert(list(scheduler.doneJobs) == ["test0"])
+  assert(list(scheduler.brokenJobs) == ["test1", "test2", "test3", "final-job"])
+  assert("Exception: foo" in scheduler.errors["test1"])
+  assert(scheduler.errors["test3"].endswith("\ntest2"))
+
+def test_missing_dependency():
+  # A job waiting for something which is never scheduled must not hang.
+  scheduler = Scheduler(2)
+  scheduler.parallel("test0", [], "build", dummyTask)
+  scheduler.parallel("test1", ["never-scheduled"], "build", dummyTask)
+  scheduler.run()
+  assert(list(scheduler.doneJobs) == ["test0"])
+  assert(sorted(scheduler.brokenJobs) == ["final-job", "test1"])
+
+def test_serial_scheduling_more():
+  scheduler = Scheduler(3)
+  scheduler.serial("check-pkg", [], scheduleMore, scheduler)
+  scheduler.run()
+  assert(list(scheduler.doneJobs) == ["check-pkg", "download", "build", "install", "final-job"])
+
+def test_critical_path_priority():
+  pkg_resources_file = join(dirname(dirname(abspath(__file__))), "tests", "package_resources.json")
+  for buildStats in [None, pkg_resources_file]:
+    scheduler = Scheduler(1, buildStats=buildStats, priority="critical-path")
+    scheduler.parallel("build:package1", [], "build", dummyTask)
+    scheduler.parallel("build:package2", [], "build", dummyTask)
+    scheduler.parallel("build:package10", [], "build", dummyTask)
+    scheduler.parallel("build:package11", ["build:package10"], "build", dummyTask)
+    scheduler.parallel("build:package12", ["build:package11"], "build", dummyTask)
+    scheduler.run()
+    # The head of the longest chain is built first, even if it was
+    # scheduled last.
+    assert(list(scheduler.doneJobs)[:2] == ["build:package10", "build:package11"])
+    assert(len(scheduler.doneJobs) == 6)
+
+def test_stage_limits():
+  import threading
+  lock = threading.Lock()
+  running = {"download": 0, "fetch": 0, "build": 0}
+  peak = dict(running)
+  def stageTask(stage):
+    with lock:
+      running[stage] += 1
+      peak[stage] = max(peak[stage], running[stage])
+    sleep(0.05)
+    with lock:
+      running[stage] -= 1
+  scheduler = Scheduler(2, parallelDownloads=1, parallelFetches=3)
+  for x in range(6):
+    pkg = "package%d" % x
+    scheduler.parallel("download:" + pkg, [], "download", stageTask, "download")
+    scheduler.parallel("fetch:" + pkg, ["download:" + pkg], "fetch", stageTask, "fetch")
+    scheduler.parallel("build:" + pkg, ["fetch:" + pkg], "build", stageTask, "build")
+  scheduler.run()
+  assert(len(scheduler.doneJobs) == 19)
+  assert(peak["download"] == 1 and peak["fetch"] <= 3 and peak["build"] <= 2)
+
+def test_system_exit_in_task():
+  import sys
+  scheduler = Scheduler(2)
+  scheduler.parallel("test0", [], "build", sys.exit, 1)
+  scheduler.run()
+  assert(sorted(scheduler.brokenJobs) == ["final-job", "test0"])
+  assert("SystemExit" in scheduler.errors["test0"])
+
+def test_build_jobs():
+  pkg_resources_file = join(dirname(dirname(abspath(__file__))), "tests", "package_resources.json")
+  for buildStats in [None, pkg_resources_file]:
+    scheduler = Scheduler(2, buildStats=buildStats, jobs=8)
+    assigned = {}
+    def buildTask(taskId):
+      assigned[taskId] = scheduler.buildJobs(taskId)
+      sleep(0.1)
+    # package10 to package13 need 10% of a CPU each, package1 two CPUs.
+    for pkg in ["package10", "package11", "package12"]:
+      scheduler.parallel("build:" + pkg, [], "build", buildTask, "build:" + pkg)
+    scheduler.parallel("build:package1", ["build:package10", "build:package11", "build:package12"],
+                       "build", buildTask, "build:package1")
+    scheduler.run()
+    assert(len(scheduler.doneJobs) == 5)
+    assert(all(1 <= j <= 8 for j in assigned.values()))
+    if buildStats:
+      assert(assigned["build:package10"] == 1)
+    else:
+      assert(assigned["build:package10"] == 4)
+    # Nothing else is left to build: the last one gets all the processes.
+    assert(assigned["build:package1"] == 8)
+    assert(not scheduler.assignedJobs)
+    assert(Scheduler(2).buildJobs("build:package1", 3) == 3)
+
+def test_backfill():
+  # Small builds, ending at different times, keep the machine busy. The big
+  # one should start as soon as enough of them are done, rather than waiting
+  # for all of them.
+  packages = {"big": {"cpu": 400, "rss": 1, "time": 50}}
+  for x in range(12):
+    packages["small%d" % x] = {"cpu": 100, "rss": 1, "time": 10 + x % 4}
+  stats = {"defaults": {"cpu": [100], "rss": [1], "time": [1]}, "known": [],
+           "resources": {"cpu": 400, "rss": 100}, "packages": {"build": packages}}
+  starts = {}
+  for backfill in [True, False]:
+    scheduler = Scheduler(8, buildStats=json.loads(json.dumps(stats)))
+    scheduler.resourceManager.backfill = backfill
+    scheduler.parallel("download:big", [], "download", None)
+    scheduler.parallel("build:big", ["download:big"], "build", None)
+    for x in range(12):
+      scheduler.parallel("build:small%d" % x, [], "build", None)
+    scheduler.simulate(lambda taskId: 5 if taskId == "download:big" else
+                       scheduler.resourceManager.getStats(taskId)["time"])
+    assert(len(scheduler.doneJobs) == 15)
+    assert(scheduler.resourceManager.machineResources == stats["resources"])
+    starts[backfill] = scheduler.jobs["build:big"]["startAt"]
+  assert(starts[True] == 13)
+  assert(starts[False] > starts[True])
+
+def test_live_usage():
+  MB = 1024 * 1024
+  packages = {"pkg%d" % x: {"cpu": 100, "rss": 4000, "time": 100} for x in range(3)}
+  packages["small"] = {"cpu": 100, "rss": 100, "time": 10}
+  stats = {"defaults": {"cpu": [100], "rss": [1], "time": [1]}, "known": [],
+           "resources": {"cpu": 800, "rss": 10000}, "packages": {"build": packages}}
+  scheduler = Scheduler(4, buildStats=stats)
+  clock = [0]
+  scheduler.now = lambda: clock[0]
+  manager = scheduler.resourceManager
+  assert(manager.allocResourcesForExternals(["build:pkg0", "build:pkg1", "build:pkg2"]) == ["build:pkg0", "build:pkg1"])
+  # Using more than estimated: the difference is not available anymore.
+  manager.updateUsage("build:pkg0", {"cpu": 100, "rss": 5000 * MB})
+  assert(manager.allocated["build:pkg0"]["rss"] == 6000)
+  assert(manager.machineResources["rss"] == 0)
+  # Using less than estimated: only released once the build ran for a while.
+  manager.updateUsage("build:pkg1", {"cpu": 50, "rss": 1000 * MB})
+  assert(manager.allocated["build:pkg1"]["rss"] == 4000)
+  clock[0] = 60
+  manager.updateUsage("build:pkg1", {"cpu": 50, "rss": 1000 * MB})
+  assert(manager.allocated["build:pkg1"]["rss"] == 2000)
+  assert(manager.allocResourcesForExternals(["build:pkg2"]) == [])
+  # Close to the machine limit, nothing new starts even if it would fit.
+  manager.memoryPressure = 0.5
+  manager.updateUsage("build:pkg0", {"cpu": 100, "rss": 4000 * MB})
+  assert(manager.allocResourcesForExternals(["build:small"]) == [])
+  manager.memoryPressure = 0.9
+  assert(manager.allocResourcesForExternals(["build:small"]) == ["build:small"])
+  for taskId in ["build:pkg0", "build:pkg1", "build:small"]:
+    manager.releaseResourcesForExternal(taskId)
+  assert(manager.machineResources == {"cpu": 800, "rss": 10000})
+  assert(not manager.liveUsage and not manager.estimates)
+
 if __name__ == "__main__":
   scheduler = Scheduler(10)
   scheduler.run()
@@ -110,7 +276,7 @@ if __name__ == "__main__":
   scheduler.parallel("test2", ["test1"], "build", dummyTask)
   scheduler.parallel("test1", [], "build", dummyTaskLong)
   scheduler.run()
-  assert(scheduler.doneJobs == ["test1", "test2", "final-job"])
+  assert(list(scheduler.doneJobs) == ["test1", "test2", "final-job"])
 
   # Check dependency actually works.
   scheduler = Scheduler(10)
@@ -118,8 +284,8 @@ if __name__ == "__main__":
   scheduler.parallel("test2", ["test1"], "build",errorTask)
   scheduler.parallel("test1", [], "build",dummyTaskLong)
   scheduler.run()
-  assert(scheduler.doneJobs == ["test1"])
-  assert(scheduler.brokenJobs == ["test2", "test3", "final-job"])
+  assert(list(scheduler.doneJobs) == ["test1"])
+  assert(list(scheduler.brokenJobs) == ["test2", "test3", "final-job"])
 
   # Check ctrl-C will exit properly.
   scheduler = Scheduler(2)
@@ -147,7 +313,7 @@ if __name__ == "__main__":
   scheduler = Scheduler(2)
   scheduler.serial("test0", [], dummyTask)
   scheduler.run()
-  assert(scheduler.doneJobs == ["test0", "final-job"])
+  assert(list(scheduler.doneJobs) == ["test0", "final-job"])
 
   # Handle serial execution tasks, one depends from
   # the previous one.
@@ -155,14 +321,14 @@ if __name__ == "__main__":
   scheduler.serial("test0", [], dummyTask)
   scheduler.serial("test1", ["test0"], dummyTask)
   scheduler.run()
-  assert(scheduler.doneJobs == ["test0", "test1", "final-job"])
+  assert(list(scheduler.doneJobs) == ["test0", "test1", "final-job"])
 
   # Serial tasks depending on one another.
   scheduler = Scheduler(2)
   scheduler.serial("test1", ["test0"], dummyTask)
   scheduler.serial("test0", [], dummyTask)
   scheduler.run()
-  assert(scheduler.doneJobs == ["test0", "test1", "final-job"])
+  assert(list(scheduler.doneJobs) == ["test0", "test1", "final-job"])
 
   # Serial and parallel tasks being scheduled at the same time.
   scheduler = Scheduler(2)
@@ -171,8 +337,7 @@ if __name__ == "__main__":
   scheduler.parallel("test2", [], "build",dummyTask)
   scheduler.parallel("test3", [], "build",dummyTask)
   scheduler.run()
-  scheduler.doneJobs.sort()
-  assert(scheduler.doneJobs == ["final-job", "test0", "test1", "test2", "test3"])
+  assert(sorted(scheduler.doneJobs) == ["final-job", "test0", "test1", "test2", "test3"])
 
   # Serial and parallel tasks. Parallel depends on serial.
   scheduler = Scheduler(2)
@@ -181,7 +346,7 @@ if __name__ == "__main__":
   scheduler.parallel("test2", ["test1"], "build",dummyTask)
   scheduler.parallel("test3", ["test2"], "build",dummyTask)
   scheduler.run()
-  assert(scheduler.doneJobs == ["test0", "test1", "test2", "test3", "final-job"])
+  assert(list(scheduler.doneJobs) == ["test0", "test1", "test2", "test3", "final-job"])
 
   # Serial task scheduling two parallel task and another dependent
   # serial task. This is actually what needs to be done for building
@@ -192,7 +357,7 @@ if __name__ == "__main__":
   scheduler = Scheduler(3)
   scheduler.serial("check-pkg", [], scheduleMore, scheduler)
   scheduler.run()
-  assert(scheduler.doneJobs == ["check-pkg", "download", "build", "install", "final-job"])
+  assert(list(scheduler.doneJobs) == ["check-pkg", "download", "build", "install", "final-job"])
 
   # Handle tests with build resources (cpu, rss) requirement
   test_resource_monitor()
@@ -0,0 +1,54 @@
+import time
+from bits_helpers.simulation import simulate, synthetic_graph, synthetic_stats
+
+def chain(*names, **kw):
+  graph = {}
+  for i, name in enumerate(names):
+    graph[name] = {"taskType": "build", "deps": list(names[:i][-1:]), **kw}
+  return graph
+
+def test_makespan():
+  # Three builds in a chain take three times as long as one.
+  report = simulate(chain("build:a", "build:b", "build:c", time=10), builders=4)
+  assert(report["makespan"] == 30)
+  assert(report["broken"] == 0)
+  # Independent builds are limited by the number of builders.
+  graph = {"build:p%d" % i: {"taskType": "build", "deps": [], "time": 10} for i in range(4)}
+  report = simulate(graph, builders=2)
+  assert(report["makespan"] == 20)
+  assert(report["slotUtilisation"] == 1)
+  assert(report["maxQueueing"] == 10)
+
+def test_stages():
+  # Downloads and checkouts of later packages overlap with earlier builds.
+  graph = {}
+  for pkg, deps in [("a", []), ("b", ["a"])]:
+    graph["download:" + pkg] = {"taskType": "download", "deps": [], "time": 5}
+    graph["fetch:" + pkg] = {"taskType": "fetch", "deps": ["download:" + pkg], "time": 5}
+    graph["build:" + pkg] = {"taskType": "build", "deps": ["fetch:" + pkg] + ["build:" + d for d in deps], "time": 10}
+  assert(simulate(graph, builders=1)["makespan"] == 30)
+
+def test_critical_path():
+  # A long chain scheduled after many short independent builds: with
+  # critical-path priority, the chain starts first and finishes sooner.
+  graph = {"build:leaf%d" % i: {"taskType": "build", "deps": [], "time": 10} for i in range(4)}
+  graph.update(chain("build:c1", "build:c2", "build:c3", "build:c4", time=10))
+  default = simulate(graph, builders=2)
+  critical = simulate(graph, builders=2, priority="critical-path")
+  assert(critical["makespan"] == 40)
+  assert(default["makespan"] > critical["makespan"])
+
+def test_resources():
+  graph = synthetic_graph(200)
+  stats = synthetic_stats(graph, cores=8)
+  report = simulate(graph, stats, builders=4, priority="critical-path")
+  assert(report["broken"] == 0)
+  assert(0 < report["coreUtilisation"] <= 1)
+  assert(0 < report["slotUtilisation"] <= 1)
+
+def test_large_graph():
+  graph = synthetic_graph(5000)
+  start = time.time()
+  report = simulate(graph, synthetic_stats(graph), builders=8)
+  assert(report["jobs"] == 5000 and report["broken"] == 0)
+  assert(time.time() - start < 30)
@@ -1,10 +1,16 @@
 import os
 import os.path
+import shutil
 import sys
+import tarfile
+import tempfile
+import threading
 import unittest
 from io import BytesIO
+from subprocess import Popen, DEVNULL
 
 from unittest.mock import patch, MagicMock
+from requests.exceptions import ChunkedEncodingError
 
 from bits_helpers import sync
 from bits_helpers.utilities import resolve_links_path, resolve_store_path
@@ -169,6 +175,164 @@ class SyncTestCase(unittest.TestCase):
             syncer.fetch_tarball(MISSING_SPEC)
 
 
+class TarballPrefetchTestCase(unittest.TestCase):
+    def test_concurrent(self):
+        """Tarballs are downloaded at the same time, up to the given limit."""
+        barrier = threading.Barrier(2, timeout=10)
+        fetched = []
+
+        class Syncer:
+            def fetch_tarball(self, spec):
+                if spec["package"] != "unplanned":
+                    barrier.wait()  # only returns if both run at once
+                fetched.append(spec["package"])
+                if spec["package"] == "broken":
+                    raise RuntimeError("download failed")
+
+        specs = [{"package": p, "version": "v1"} for p in ("zlib", "broken")]
+        prefetch = sync.TarballPrefetch(Syncer(), 2).start(specs)
+        prefetch.wait(specs[0])
+        with self.assertRaises(RuntimeError):
+            prefetch.wait(specs[1])
+        # Packages which were not prefetched are downloaded when needed.
+        prefetch.wait({"package": "unplanned", "version": "v1"})
+        prefetch.stop()
+        self.assertEqual(sorted(fetched), ["broken", "unplanned", "zlib"])
+
+    def test_http_session(self):
+        """All the requests to an HTTP store share one session."""
+        syncer = sync.HttpRemoteSync(remoteStore="https://localhost/test",
+                                     architecture=ARCHITECTURE,
+                                     workdir="/sw", insecure=False)
+        self.assertIs(syncer.session, syncer.session)
+        self.assertEqual(syncer.session.get_adapter("https://localhost/")._pool_maxsize,
+                         sync.HTTP_POOL_SIZE)
+
+
+class RangeResponse:
+    """Response of a store serving payload, which supports range requests."""
+    def __init__(self, payload, headers, breakAfter=None) -> None:
+        self.headers = {"content-length": str(len(payload)), "accept-ranges": "bytes"}
+        self.status_code = 200
+        rangeHeader = (headers or {}).get("Range")
+        if rangeHeader:
+            start, _, end = rangeHeader[len("bytes="):].partition("-")
+            payload = payload[int(start):int(end) + 1 if end else None]
+            self.status_code = 206
+            self.headers["content-length"] = str(len(payload))
+        self.payload = payload
+        self.breakAfter = breakAfter
+
+    def iter_content(self, chunk_size=10):
+        for i in range(0, len(self.payload), chunk_size):
+            if self.breakAfter is not None and i >= self.breakAfter:
+                raise ChunkedEncodingError("connection broken")
+            yield self.payload[i:i + chunk_size]
+
+    def close(self):
+        pass
+
+
+@patch("bits_helpers.sync.debug", new=MagicMock())
+class RangeDownloadTestCase(unittest.TestCase):
+    PAYLOAD = bytes(range(256)) * 1000
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.dest = os.path.join(self.tmpdir, "zlib.tar.gz")
+        self.ranges = []
+        self.brokenRequest = 1
+        self.syncer = sync.HttpRemoteSync(remoteStore="https://localhost/test",
+                                          architecture=ARCHITECTURE,
+                                          workdir=self.tmpdir, insecure=False)
+        self.syncer.httpBackoff = 0  # speed up tests
+
+    def get(self, url, headers=None, **kw):
+        self.ranges.append((headers or {}).get("Range"))
+        # One of the requests breaks after a few chunks.
+        return RangeResponse(self.PAYLOAD, headers,
+                             breakAfter=2 * sync.HTTP_CHUNK_SIZE
+                             if len(self.ranges) == self.brokenRequest else None)
+
+    def download(self):
+        self.assertTrue(self.syncer.getRetry("https://localhost/test/zlib.tar.gz",
+                                             self.dest, session=MagicMock(get=self.get)))
+        with open(self.dest, "rb") as downloaded:
+            self.assertEqual(downloaded.read(), self.PAYLOAD)
+        self.assertFalse(os.path.exists(self.dest + ".tmp"))
+
+    def test_resume(self):
+        """After a failure, the download carries on from where it stopped."""
+        self.download()
+        self.assertEqual(len(self.ranges), 2)
+        self.assertEqual(self.ranges[1], "bytes=%d-" % (2 * sync.HTTP_CHUNK_SIZE))
+
+    def test_segments(self):
+        """Large tarballs are downloaded as several ranges at the same time."""
+        self.syncer.httpSegmentThreshold = 1000
+        self.syncer.httpSegments = 3
+        self.brokenRequest = 2
+        self.download()
+        # The first request only tells the size of the tarball. One of the
+        # segments fails once, and is resumed.
+        self.assertIsNone(self.ranges[0])
+        bounds = [(0, 85333), (85334, 170667), (170668, 255999)]
+        segments = {"bytes=%d-%d" % b for b in bounds}
+        self.assertEqual(len(self.ranges), 5)
+        self.assertEqual(segments - set(self.ranges), set())
+        resumed, = set(self.ranges[1:]) - segments
+        self.assertIn(resumed, {"bytes=%d-%d" % (start + 2 * sync.HTTP_CHUNK_SIZE, end)
+                                for start, end in bounds})
+
+
+class StreamInstallTestCase(unittest.TestCase):
+    PACKAGE_PATH = os.path.join(ARCHITECTURE, PACKAGE, "v1.3.1-1")
+    STORE_PATH = resolve_store_path(ARCHITECTURE, GOOD_HASH)
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.workdir)
+        # Tarballs contain the installation relative to the work directory.
+        root = os.path.join(self.workdir, "INSTALLROOT")
+        os.makedirs(os.path.join(root, self.PACKAGE_PATH, "etc"))
+        with open(os.path.join(root, self.PACKAGE_PATH, "etc", "zlib.conf"), "w") as conf:
+            conf.write("prefix=/sw\n")
+        buffer = BytesIO()
+        with tarfile.open(fileobj=buffer, mode="w:gz") as tar:
+            tar.add(root, arcname=".")
+        shutil.rmtree(root)
+        self.tarball = buffer.getvalue()
+
+    def install(self, data, keep=False):
+        syncer = MagicMock()
+        syncer.open_tarball.return_value = \
+            (self.STORE_PATH, tarball_name(GOOD_SPEC),
+             (data[i:i + 1000] for i in range(0, len(data), 1000)))
+        with patch("bits_helpers.sync.info"), patch("bits_helpers.sync.debug"):
+            return sync.stream_install(syncer, GOOD_SPEC, self.workdir, self.PACKAGE_PATH, keep=keep)
+
+    def test_install(self):
+        stored = os.path.join(self.workdir, self.STORE_PATH, tarball_name(GOOD_SPEC))
+        self.assertEqual(self.install(self.tarball), stored)
+        with open(os.path.join(self.workdir, self.PACKAGE_PATH, "etc", "zlib.conf")) as conf:
+            self.assertEqual(conf.read(), "prefix=/sw\n")
+        self.assertFalse(os.path.exists(stored))
+        self.assertFalse(os.path.exists(os.path.join(self.workdir, "TMP", GOOD_HASH)))
+        # The tarball is only kept if asked to.
+        self.assertEqual(self.install(self.tarball, keep=True), stored)
+        with open(stored, "rb") as kept:
+            self.assertEqual(kept.read(), self.tarball)
+
+    def test_failure(self):
+        """Nothing is left behind if the tarball cannot be unpacked."""
+        with patch("bits_helpers.sync.Popen", side_effect=lambda *a, **kw: Popen(*a, stderr=DEVNULL, **kw)):
+            self.assertIsNone(self.install(self.tarball[:len(self.tarball) // 2], keep=True))
+        self.assertEqual(os.listdir(os.path.join(self.workdir, self.STORE_PATH)), [])
+        self.assertFalse(os.path.exists(os.path.join(self.workdir, self.PACKAGE_PATH)))
+        self.assertEqual(os.listdir(os.path.join(self.workdir, "TMP")), [])
+
+
 @unittest.skipIf(sys.version_info < (3, 6), "python >= 3.6 is required for boto3")
 @patch("os.makedirs", new=MagicMock(return_value=None))
 @patch("bits_helpers.sync.symlink", new=MagicMock(return_value=None))
@@ -0,0 +1,76 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from unittest.mock import patch
+
+from bits_helpers.system_checks import SystemCheckCache, system_fingerprint
+
+
+class SystemCheckCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.cacheFile = os.path.join(self.tmpdir, "SPECS", "slc9_x86-64", "system-checks.json")
+        self.calls = []
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def run_check(self, cmd, cwd=None):
+        self.calls.append(cmd)
+        return (0 if "true" in cmd else 1, "output of " + cmd)
+
+    def check(self, cmd, fingerprint={"image": "sha256:1"}, **kwargs):
+        cache = SystemCheckCache(self.cacheFile, fingerprint, **kwargs)
+        result = cache.wrap(self.run_check)(cmd, cwd=self.tmpdir)
+        cache.save()
+        return result
+
+    def test_reuse(self):
+        self.assertEqual(self.check("true"), (0, "output of true"))
+        self.assertEqual(self.check("false"), (1, "output of false"))
+        self.assertEqual(self.check("true"), (0, "output of true"))
+        self.assertEqual(self.calls, ["true", "false"])
+        # Results depend on what the checks look at.
+        self.check("true", fingerprint={"image": "sha256:2"})
+        self.assertEqual(len(self.calls), 3)
+        # Checks can be forced to run again, and results expire.
+        self.check("true", refresh=True)
+        self.assertEqual(len(self.calls), 4)
+        with patch("bits_helpers.system_checks.time.time", return_value=time.time() + 2 * 24 * 3600):
+            self.check("true")
+        self.assertEqual(len(self.calls), 5)
+        # Nothing is cached if what the checks depend on is not known.
+        self.check("true", fingerprint=None)
+        self.check("true", fingerprint=None)
+        self.assertEqual(len(self.calls), 7)
+
+    def test_failures_expire(self):
+        # Failures may be transient, they are only reused for a few minutes.
+        self.check("true")
+        self.check("false")
+        self.check("false")
+        self.assertEqual(self.calls, ["true", "false"])
+        with patch("bits_helpers.system_checks.time.time", return_value=time.time() + 600):
+            self.check("true")
+            self.check("false")
+        self.assertEqual(self.calls, ["true", "false", "false"])
+
+    def test_fingerprint(self):
+        binDir = os.path.join(self.tmpdir, "bin")
+        os.mkdir(binDir)
+        with patch.dict(os.environ, {"PATH": binDir}):
+            fingerprint = system_fingerprint(extra=["KEY=VALUE"])
+            self.assertEqual(system_fingerprint(extra=["KEY=VALUE"]), fingerprint)
+            self.assertNotEqual(system_fingerprint(extra=["KEY=OTHER"]), fingerprint)
+            # Installing something in PATH changes the fingerprint.
+            open(os.path.join(binDir, "cmake"), "w").close()
+            os.utime(binDir, ns=(0, os.stat(binDir).st_mtime_ns + 1000))
+            self.assertNotEqual(system_fingerprint(extra=["KEY=VALUE"]), fingerprint)
+        with patch("bits_helpers.system_checks.getstatusoutput", return_value=(1, "No such image")):
+            self.assertIsNone(system_fingerprint("missing-image"))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -8,7 +8,7 @@ from bits_helpers.utilities import Hasher
 from bits_helpers.utilities import asList
 from bits_helpers.utilities import prunePaths
 from bits_helpers.utilities import resolve_version
-from bits_helpers.utilities import topological_sort
+from bits_helpers.utilities import topological_sort, topological_levels
 from bits_helpers.utilities import resolveFilename, resolveDefaultsFilename
 import bits_helpers
 import bits_helpers.log
@@ -397,5 +397,34 @@ class TestTopologicalSort(unittest.TestCase):
         self.assertEqual({"A", "B", "C"}, set(result))
         self.assertEqual(3, len(result))
 
+    def test_order(self) -> None:
+        """Packages which become ready at the same time come in the order of specs."""
+        self.assertEqual(["base", "b", "a", "top"], list(topological_sort({
+            "top": {"package": "top", "requires": ["a", "b", "b"]},
+            "b": {"package": "b", "requires": ["base"]},
+            "a": {"package": "a", "requires": ["base"]},
+            "base": {"package": "base", "requires": []},
+        })))
+
+    def test_levels(self) -> None:
+        """Test that packages are grouped by how deep they are in the graph."""
+        self.assertEqual([["c", "d"], ["b"], ["a"]], topological_levels({
+            "a": {"package": "a", "requires": ["b", "d"]},
+            "b": {"package": "b", "requires": ["c"]},
+            "c": {"package": "c", "requires": []},
+            "d": {"package": "d", "requires": []},
+        }))
+        self.assertEqual([], topological_levels({}))
+
+    def test_large_graph(self) -> None:
+        """Test that large graphs are sorted quickly, and correctly."""
+        count = 10000
+        specs = {"p%d" % i: {"package": "p%d" % i,
+                             "requires": ["p%d" % j for j in range(max(0, i - 5), i)]}
+                 for i in reversed(range(count))}
+        order = list(topological_sort(specs))
+        self.assertEqual(order, ["p%d" % i for i in range(count)])
+        self.assertEqual(len(topological_levels(specs)), count)
+
 if __name__ == '__main__':
     unittest.main()